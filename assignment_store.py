@@ -0,0 +1,107 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from typing import List, Dict, Any, Optional, Iterable
+
+from email_record import EmailRecord
+
+def message_key(email: EmailRecord) -> str:
+    """Stable per-message key: the Message-ID header, or the UID when the header is missing"""
+    return email.message_id or f"uid:{email.uid or email.id}"
+
+class AssignmentStore:
+    """Persistent per-account cluster set plus per-message cluster assignments and signatures"""
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path or os.getenv("ASSIGNMENT_STORE_PATH", "assignments.db")
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS cluster_sets (
+                account TEXT PRIMARY KEY,
+                version INTEGER NOT NULL,
+                prompt_version TEXT NOT NULL,
+                data TEXT NOT NULL,
+                created_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS assignments (
+                account TEXT NOT NULL,
+                message_key TEXT NOT NULL,
+                version INTEGER NOT NULL,
+                cluster INTEGER NOT NULL,
+                signature TEXT NOT NULL,
+                PRIMARY KEY (account, message_key)
+            );
+        """)
+        self._conn.commit()
+
+    def get_cluster_set(self, account: str, prompt_version: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT version, data, created_at FROM cluster_sets WHERE account = ? AND prompt_version = ?",
+                (account, prompt_version)
+            ).fetchone()
+        if not row:
+            return None
+        data = json.loads(row[1])
+        for cluster in data["clusters"]:
+            cluster["centroid"] = {int(k): v for k, v in cluster["centroid"].items()}
+        data["idf"] = {int(k): v for k, v in data["idf"].items()}
+        data["version"] = row[0]
+        data["created_at"] = row[2]
+        return data
+
+    def save_cluster_set(self, account: str, prompt_version: str, data: Dict[str, Any], assignments: List[tuple]) -> int:
+        """Replace the account's cluster set; assignments are (message_key, cluster, signature) tuples"""
+        with self._lock:
+            row = self._conn.execute("SELECT version FROM cluster_sets WHERE account = ?", (account,)).fetchone()
+            version = (row[0] if row else 0) + 1
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cluster_sets VALUES (?, ?, ?, ?, ?)",
+                (account, version, prompt_version, json.dumps(data), time.time())
+            )
+            self._conn.execute("DELETE FROM assignments WHERE account = ?", (account,))
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO assignments VALUES (?, ?, ?, ?, ?)",
+                [(account, key, version, cluster, signature) for key, cluster, signature in assignments]
+            )
+            self._conn.commit()
+        return version
+
+    def get_assignments(self, account: str, version: int, keys: Iterable[str]) -> Dict[str, tuple]:
+        """Return {message_key: (cluster, signature)} for the keys assigned under this cluster set version"""
+        keys = list(keys)
+        found = {}
+        with self._lock:
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                rows = self._conn.execute(
+                    f"SELECT message_key, cluster, signature FROM assignments WHERE account = ? AND version = ? "
+                    f"AND message_key IN ({','.join('?' * len(batch))})",
+                    [account, version, *batch]
+                ).fetchall()
+                for key, cluster, signature in rows:
+                    found[key] = (cluster, signature)
+        return found
+
+    def add_assignments(self, account: str, version: int, assignments: List[tuple]):
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO assignments VALUES (?, ?, ?, ?, ?)",
+                [(account, key, version, cluster, signature) for key, cluster, signature in assignments]
+            )
+            self._conn.commit()
+
+# Global store instance
+assignment_store: Optional[AssignmentStore] = None
+
+def init_assignment_store():
+    """Initialize global assignment store"""
+    global assignment_store
+    if assignment_store is None:
+        assignment_store = AssignmentStore()
+    return assignment_store
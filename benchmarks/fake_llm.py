@@ -0,0 +1,123 @@
+import re
+import json
+import time
+import zlib
+import asyncio
+from typing import Dict, Any, List, Optional, AsyncIterator
+
+# Stand-in for the ChatAnthropic model returned by llm.init_llm: same invoke/ainvoke/bind_tools/astream
+# surface, no network, fixed latency, and answers derived only from the prompt so runs are repeatable
+
+_ITEM_RE = re.compile(r"^\s*(\d+)\. (.*)$", re.MULTILINE)
+_DOMAIN_RE = re.compile(r"@([\w.-]+)")
+
+_CLUSTER_NAMES = ["Newsletters to Skim", "Notifications to Triage", "Receipts to File", "Messages to Answer", "Promotions to Archive"]
+_PRIORITIES = ["low", "medium", "low", "high", "low"]
+
+class FakeResponse:
+    def __init__(self, content: str, prompt: str):
+        self.content = content
+        self.response_metadata: Dict[str, Any] = {}
+        # Rough 4-characters-per-token estimate, enough to exercise token accounting
+        self.usage_metadata = {"input_tokens": len(prompt) // 4, "output_tokens": len(content) // 4}
+
+class FakeChunk:
+    """One streamed piece of a tool call, shaped like langchain's AIMessageChunk"""
+
+    def __init__(self, args: str, usage: Optional[Dict[str, int]] = None, stop_reason: Optional[str] = None, content: str = ""):
+        self.content = content
+        self.tool_call_chunks = [{"name": None, "args": args, "id": None, "index": 0}] if args else []
+        self.usage_metadata = usage
+        self.response_metadata = {"stop_reason": stop_reason} if stop_reason else {}
+
+class FakeChatModel:
+    """Deterministic LLM double: buckets numbered prompt items by sender domain into up to five clusters.
+    Every `truncate_every`th streamed reply, starting with the first, stops halfway as if it hit the output token limit."""
+
+    def __init__(self, latency: float = 0.0, fail_every: int = 0, truncate_every: int = 0):
+        self.latency = latency
+        self.fail_every = fail_every
+        self.truncate_every = truncate_every
+        self.calls = 0
+
+    def _respond(self, prompt: str, key: Optional[str] = None) -> FakeResponse:
+        self.calls += 1
+        if self.fail_every and self.calls % self.fail_every == 0:
+            raise RuntimeError("simulated LLM failure")
+
+        if key is None:
+            if "pre-grouped" in prompt:
+                key = "groups"
+            elif "partial email clusters" in prompt:
+                key = "partial_clusters"
+            else:
+                key = "email_indices"
+
+        buckets: Dict[int, List[int]] = {}
+        for number, text in _ITEM_RE.findall(prompt):
+            # Numbered instruction lines are not items; emails and groups carry From:, partials an action
+            if "From:" not in text and "(action:" not in text:
+                continue
+            domain = _DOMAIN_RE.search(text)
+            basis = domain.group(1) if domain else text.split(" - ")[0]
+            buckets.setdefault(zlib.crc32(basis.encode()) % len(_CLUSTER_NAMES), []).append(int(number))
+
+        clusters = [
+            {
+                "name": _CLUSTER_NAMES[bucket],
+                "description": f"{len(items)} similar items",
+                "action": "Review",
+                key: items,
+                "priority": _PRIORITIES[bucket],
+            }
+            for bucket, items in sorted(buckets.items())
+        ]
+        return FakeResponse("```json\n" + json.dumps({"clusters": clusters}) + "\n```", prompt)
+
+    def invoke(self, prompt: str, **kwargs) -> FakeResponse:
+        if self.latency:
+            time.sleep(self.latency)
+        return self._respond(prompt)
+
+    async def ainvoke(self, prompt: str, **kwargs) -> FakeResponse:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self._respond(prompt)
+
+    async def astream(self, prompt: str, **kwargs) -> AsyncIterator[FakeChunk]:
+        response = await self.ainvoke(prompt)
+        yield FakeChunk("", dict(response.usage_metadata), "end_turn", response.content)
+
+    def bind(self, **kwargs) -> "FakeChatModel":
+        return self
+
+    def bind_tools(self, tools: List[Dict[str, Any]], tool_choice: Any = None, **kwargs) -> "FakeToolModel":
+        return FakeToolModel(self, tools[0])
+
+class FakeToolModel:
+    """FakeChatModel with the cluster tool bound: replies arrive as streamed tool-call arguments"""
+
+    def __init__(self, model: FakeChatModel, tool: Dict[str, Any]):
+        self.model = model
+        items = tool["input_schema"]["properties"]["clusters"]["items"]["properties"]
+        self.key = next(name for name in items if name not in ("name", "description", "action", "priority"))
+
+    async def astream(self, prompt: str, **kwargs) -> AsyncIterator[FakeChunk]:
+        if self.model.latency:
+            await asyncio.sleep(self.model.latency)
+        response = self.model._respond(prompt, self.key)
+        args = json.dumps(json.loads(response.content.split("```json")[1].split("```")[0]))
+        stop_reason = "tool_use"
+        if self.model.truncate_every and (self.model.calls - 1) % self.model.truncate_every == 0:
+            args, stop_reason = args[:len(args) // 2], "max_tokens"
+        usage = response.usage_metadata
+        yield FakeChunk("", {"input_tokens": usage["input_tokens"], "output_tokens": 0})
+        for start in range(0, len(args), 64):
+            yield FakeChunk(args[start:start + 64])
+        yield FakeChunk("", {"input_tokens": 0, "output_tokens": len(args) // 4}, stop_reason)
+
+def fake_init_llm(latency: float = 0.0, fail_every: int = 0, truncate_every: int = 0):
+    """A drop-in replacement for llm.init_llm that hands out FakeChatModel instances"""
+    def init_llm(temperature: float = 0.7, **kwargs):
+        return FakeChatModel(latency, fail_every, truncate_every)
+    return init_llm
@@ -0,0 +1,484 @@
+import re
+import base64
+import bisect
+import quopri
+import random
+import select
+import socket
+import threading
+import socketserver
+from email.header import Header
+from email.utils import formataddr, parseaddr
+from typing import List, Dict, Any, Optional, Tuple
+
+# Enough of IMAP4rev1 + UIDPLUS/MOVE/CONDSTORE/IDLE for GmailClient, served from memory over plain TCP
+
+ARCHIVE_MAILBOX = "[Gmail]/All Mail"
+CAPABILITIES = "IMAP4rev1 UIDPLUS MOVE CONDSTORE ENABLE IDLE"
+
+_SECTION_RE = re.compile(r"BODY(?:\.PEEK)?\[([^\]]*)\](?:<(\d+)\.(\d+)>)?", re.IGNORECASE)
+_CHANGEDSINCE_RE = re.compile(r"\(CHANGEDSINCE (\d+)\)\s*$", re.IGNORECASE)
+
+class Mailbox:
+    """Messages in UID order with CONDSTORE mod-sequences"""
+
+    def __init__(self, uidvalidity: int = 1):
+        self.uidvalidity = uidvalidity
+        self.uidnext = 1
+        self.highestmodseq = 1
+        self.uids: List[int] = []
+        self.messages: List[Dict[str, Any]] = []
+        self.lock = threading.RLock()
+        self.waiters: List[threading.Event] = []
+
+    def append(self, raw: bytes, flags=()):
+        with self.lock:
+            self.highestmodseq += 1
+            self.uids.append(self.uidnext)
+            self.messages.append({"uid": self.uidnext, "raw": raw, "flags": set(flags), "modseq": self.highestmodseq})
+            self.uidnext += 1
+            for event in self.waiters:
+                event.set()
+
+    def remove(self, positions: List[int]) -> List[Dict[str, Any]]:
+        """Remove messages at 0-based positions, returning them; callers report EXPUNGE highest first"""
+        removed = []
+        with self.lock:
+            for position in sorted(positions, reverse=True):
+                self.uids.pop(position)
+                removed.append(self.messages.pop(position))
+            if removed:
+                self.highestmodseq += 1
+        return removed
+
+    def clear(self):
+        with self.lock:
+            self.uids.clear()
+            self.messages.clear()
+            self.highestmodseq += 1
+
+def _parse_set(spec: str, largest: int) -> List[Tuple[int, int]]:
+    ranges = []
+    for part in spec.split(","):
+        lo, _, hi = part.partition(":")
+        lo = largest if lo == "*" else int(lo)
+        hi = lo if not hi else (largest if hi == "*" else int(hi))
+        ranges.append((min(lo, hi), max(lo, hi)))
+    return ranges
+
+def _split_items(text: str) -> List[str]:
+    text = text.strip()
+    if text.startswith("(") and text.endswith(")"):
+        text = text[1:-1]
+    items, current, depth = [], "", 0
+    for ch in text:
+        if ch in "[(":
+            depth += 1
+        elif ch in "])":
+            depth -= 1
+        if ch == " " and depth == 0:
+            if current:
+                items.append(current)
+            current = ""
+        else:
+            current += ch
+    if current:
+        items.append(current)
+    return items
+
+def _split_message(raw: bytes) -> Tuple[bytes, bytes]:
+    end = raw.find(b"\r\n\r\n")
+    if end < 0:
+        return raw, b""
+    return raw[:end + 2], raw[end + 4:]
+
+def _header_fields(raw: bytes, names: List[str], negate: bool = False) -> bytes:
+    head, _ = _split_message(raw)
+    wanted = {name.upper() for name in names}
+    kept, keep = [], False
+    for line in head.split(b"\r\n"):
+        if not line:
+            continue
+        if line[:1] in (b" ", b"\t"):
+            if keep:
+                kept.append(line)
+            continue
+        keep = (line.split(b":", 1)[0].decode("ascii", "ignore").upper() in wanted) != negate
+        if keep:
+            kept.append(line)
+    return b"\r\n".join(kept) + b"\r\n\r\n" if kept else b"\r\n"
+
+class _Handler(socketserver.StreamRequestHandler):
+    def send(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        self.server.stats["bytes_sent"] += len(data)
+        self.wfile.write(data)
+
+    def handle(self):
+        # Replies go out in several writes; without NODELAY delayed ACKs would dominate every timing
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.selected: Optional[Mailbox] = None
+        self.condstore = False
+        self.logged_in = False
+        self.send("* OK [CAPABILITY IMAP4rev1] benchmark IMAP ready\r\n")
+        try:
+            self.serve()
+        finally:
+            if self.logged_in:
+                with self.server.lock:
+                    self.server.sessions -= 1
+
+    def serve(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            parts = line.decode().rstrip("\r\n").split(" ", 2)
+            if len(parts) < 2:
+                continue
+            tag, command, args = parts[0], parts[1].upper(), parts[2] if len(parts) > 2 else ""
+            self.server.stats["commands"] += 1
+            try:
+                if not self.dispatch(tag, command, args):
+                    return
+            except Exception as e:
+                self.send(f"{tag} BAD {e}\r\n")
+
+    def dispatch(self, tag: str, command: str, args: str) -> bool:
+        if command == "CAPABILITY":
+            # Like Gmail, extensions are only advertised once authenticated
+            self.send(f"* CAPABILITY {CAPABILITIES if self.logged_in else 'IMAP4rev1'}\r\n")
+        elif command == "LOGIN":
+            if self.server.latency:
+                threading.Event().wait(self.server.latency)
+            with self.server.lock:
+                # Like Gmail's per-account cap; every login here is the same account
+                refused = self.server.max_connections and self.server.sessions >= self.server.max_connections
+                if not refused:
+                    self.server.sessions += 1
+                    self.logged_in = True
+            if refused:
+                self.send(f"{tag} NO [ALERT] Too many simultaneous connections. (Failure)\r\n")
+                return True
+            self.send(f"{tag} OK [CAPABILITY {CAPABILITIES}] LOGIN completed\r\n")
+            return True
+        elif command == "LOGOUT":
+            self.send("* BYE logging out\r\n")
+            self.send(f"{tag} OK LOGOUT completed\r\n")
+            return False
+        elif command == "ENABLE":
+            self.condstore = True
+            self.send("* ENABLED CONDSTORE\r\n")
+        elif command in ("SELECT", "EXAMINE"):
+            # SELECT ... (CONDSTORE) turns CONDSTORE on as ENABLE does
+            self.condstore = self.condstore or args.upper().endswith("(CONDSTORE)")
+            self.select(args.split(" (")[0].strip('"'))
+        elif command == "CLOSE":
+            self.selected = None
+        elif command == "EXPUNGE":
+            self.expunge(None)
+        elif command == "FETCH":
+            if self.throttled(tag, args):
+                return True
+            self.fetch(args, uid=False)
+        elif command == "STORE":
+            self.store(args, uid=False)
+        elif command == "IDLE":
+            self.idle()
+        elif command == "UID":
+            sub, _, rest = args.partition(" ")
+            sub = sub.upper()
+            if sub == "FETCH":
+                if self.throttled(tag, rest):
+                    return True
+                self.fetch(rest, uid=True)
+            elif sub == "STORE":
+                self.store(rest, uid=True)
+            elif sub == "MOVE":
+                spec, destination = rest.split(" ", 1)
+                self.move(spec, destination.strip('"'))
+            elif sub == "EXPUNGE":
+                self.expunge(rest)
+            else:
+                self.send(f"{tag} BAD unsupported UID {sub}\r\n")
+                return True
+        elif command != "NOOP":
+            self.send(f"{tag} BAD unsupported {command}\r\n")
+            return True
+        self.send(f"{tag} OK {command} completed\r\n")
+        return True
+
+    def throttled(self, tag: str, args: str) -> bool:
+        """Apply the per-FETCH round trip for message content, and refuse every throttle_every-th such FETCH"""
+        if "BODY" not in args.upper():
+            return False
+        if self.server.fetch_latency:
+            threading.Event().wait(self.server.fetch_latency)
+        with self.server.lock:
+            self.server.stats["content_fetches"] += 1
+            refused = self.server.throttle_every and self.server.stats["content_fetches"] % self.server.throttle_every == 0
+        if refused:
+            self.send(f"{tag} NO [THROTTLED] Account exceeded command or bandwidth limits\r\n")
+        return bool(refused)
+
+    def select(self, name: str):
+        mailbox = self.server.mailboxes[name]
+        self.selected = mailbox
+        with mailbox.lock:
+            self.send(f"* FLAGS (\\Seen \\Deleted \\Flagged)\r\n* {len(mailbox.messages)} EXISTS\r\n* 0 RECENT\r\n")
+            self.send(f"* OK [UIDVALIDITY {mailbox.uidvalidity}] UIDs valid\r\n* OK [UIDNEXT {mailbox.uidnext}] next UID\r\n")
+            if self.condstore:
+                self.send(f"* OK [HIGHESTMODSEQ {mailbox.highestmodseq}] modseq\r\n")
+
+    def targets(self, spec: str, uid: bool) -> List[Tuple[int, Dict[str, Any]]]:
+        """(sequence number, message) pairs for a sequence or UID set, found by bisection"""
+        mailbox = self.selected
+        found = []
+        if uid:
+            largest = mailbox.uids[-1] if mailbox.uids else 0
+            for lo, hi in _parse_set(spec, largest):
+                start = bisect.bisect_left(mailbox.uids, lo)
+                end = bisect.bisect_right(mailbox.uids, hi)
+                found.extend((i + 1, mailbox.messages[i]) for i in range(start, end))
+        else:
+            for lo, hi in _parse_set(spec, len(mailbox.messages)):
+                found.extend((i, mailbox.messages[i - 1]) for i in range(max(lo, 1), min(hi, len(mailbox.messages)) + 1))
+        found.sort(key=lambda pair: pair[0])
+        return found
+
+    def fetch(self, args: str, uid: bool):
+        spec, rest = args.split(" ", 1)
+        changedsince = None
+        match = _CHANGEDSINCE_RE.search(rest)
+        if match:
+            changedsince = int(match.group(1))
+            rest = rest[:match.start()].strip()
+        items = _split_items(rest)
+        if uid and "UID" not in (item.upper() for item in items):
+            items.insert(0, "UID")
+
+        with self.selected.lock:
+            for seq, message in self.targets(spec, uid):
+                if changedsince is not None and message["modseq"] <= changedsince:
+                    continue
+                out = [f"* {seq} FETCH (".encode()]
+                for n, item in enumerate(items):
+                    if n:
+                        out.append(b" ")
+                    out.append(self.fetch_item(item, message))
+                if changedsince is not None:
+                    out.append(f" MODSEQ ({message['modseq']})".encode())
+                out.append(b")\r\n")
+                self.send(b"".join(out))
+
+    def fetch_item(self, item: str, message: Dict[str, Any]) -> bytes:
+        upper = item.upper()
+        if upper == "UID":
+            return f"UID {message['uid']}".encode()
+        if upper == "FLAGS":
+            return f"FLAGS ({' '.join(sorted(message['flags']))})".encode()
+        if upper == "MODSEQ":
+            return f"MODSEQ ({message['modseq']})".encode()
+        if upper == "RFC822.SIZE":
+            return f"RFC822.SIZE {len(message['raw'])}".encode()
+
+        match = _SECTION_RE.match(item)
+        if not match:
+            raise ValueError(f"unsupported fetch item {item}")
+        section = match.group(1).upper()
+        data = message["raw"]
+        if section == "TEXT":
+            data = _split_message(data)[1]
+        elif section == "HEADER":
+            data = _split_message(data)[0] + b"\r\n"
+        elif section.startswith("HEADER.FIELDS"):
+            names = re.search(r"\(([^)]*)\)", section).group(1).split()
+            data = _header_fields(data, names, negate=".NOT" in section)
+        key = f"BODY[{match.group(1)}]"
+        if match.group(2):
+            start, length = int(match.group(2)), int(match.group(3))
+            data = data[start:start + length]
+            key += f"<{start}>"
+        return f"{key} {{{len(data)}}}\r\n".encode() + data
+
+    def store(self, args: str, uid: bool):
+        spec, operation, values = args.split(" ", 2)
+        flags = values.strip("()").split()
+        silent = operation.upper().endswith(".SILENT")
+        mailbox = self.selected
+        with mailbox.lock:
+            for seq, message in self.targets(spec, uid):
+                if operation.startswith("+"):
+                    message["flags"].update(flags)
+                elif operation.startswith("-"):
+                    message["flags"].difference_update(flags)
+                else:
+                    message["flags"] = set(flags)
+                mailbox.highestmodseq += 1
+                message["modseq"] = mailbox.highestmodseq
+                if not silent:
+                    self.send(f"* {seq} FETCH (UID {message['uid']} FLAGS ({' '.join(sorted(message['flags']))}))\r\n")
+
+    def expunge(self, uid_spec: Optional[str]):
+        mailbox = self.selected
+        with mailbox.lock:
+            if uid_spec is None:
+                candidates = list(enumerate(mailbox.messages, start=1))
+            else:
+                candidates = self.targets(uid_spec, uid=True)
+            positions = [seq - 1 for seq, message in candidates if "\\Deleted" in message["flags"]]
+            mailbox.remove(positions)
+            for position in sorted(positions, reverse=True):
+                self.send(f"* {position + 1} EXPUNGE\r\n")
+
+    def move(self, spec: str, destination: str):
+        mailbox = self.selected
+        target = self.server.mailboxes[destination]
+        with mailbox.lock:
+            moving = self.targets(spec, uid=True)
+            for _, message in moving:
+                target.append(message["raw"], message["flags"])
+            positions = [seq - 1 for seq, _ in moving]
+            mailbox.remove(positions)
+            for position in sorted(positions, reverse=True):
+                self.send(f"* {position + 1} EXPUNGE\r\n")
+
+    def idle(self):
+        mailbox = self.selected
+        event = threading.Event()
+        mailbox.waiters.append(event)
+        self.send("+ idling\r\n")
+        try:
+            while True:
+                if select.select([self.request], [], [], 0.2)[0]:
+                    line = self.rfile.readline()
+                    if not line or line.strip().upper() == b"DONE":
+                        return
+                if event.is_set():
+                    event.clear()
+                    self.send(f"* {len(mailbox.messages)} EXISTS\r\n")
+        finally:
+            mailbox.waiters.remove(event)
+
+class BenchmarkImapServer(socketserver.ThreadingTCPServer):
+    """In-process IMAP server on 127.0.0.1 serving synthetic INBOX and All Mail folders"""
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, port: int = 0, latency: float = 0.0, fetch_latency: float = 0.0, max_connections: int = 0, throttle_every: int = 0):
+        super().__init__(("127.0.0.1", port), _Handler)
+        self.latency = latency
+        # Round trip added to each content FETCH, logins refused past max_connections, and a NO [THROTTLED]
+        # for every throttle_every-th content FETCH; 0 turns each off
+        self.fetch_latency = fetch_latency
+        self.max_connections = max_connections
+        self.throttle_every = throttle_every
+        self.sessions = 0
+        self.lock = threading.Lock()
+        self.mailboxes = {"INBOX": Mailbox(), ARCHIVE_MAILBOX: Mailbox()}
+        self.stats = {"commands": 0, "bytes_sent": 0, "content_fetches": 0}
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    @property
+    def inbox(self) -> Mailbox:
+        return self.mailboxes["INBOX"]
+
+    def start(self) -> "BenchmarkImapServer":
+        self._thread = threading.Thread(target=self.serve_forever, name="benchmark-imap", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def fill(self, count: int, seed: int = 0, **kwargs):
+        """Replace both folders' contents with `count` synthetic messages in INBOX"""
+        for mailbox in self.mailboxes.values():
+            mailbox.clear()
+        generator = MailboxGenerator(seed, **kwargs)
+        for i in range(count):
+            self.inbox.append(generator.message(i))
+
+    def reset_stats(self):
+        self.stats = {"commands": 0, "bytes_sent": 0, "content_fetches": 0}
+
+# Sender populations give the clusterer real structure to find
+_SENDERS = [
+    ("newsletter", ["Weekly Digest <digest@news.example.com>", "Product Updates <updates@saas.example.io>", "The Morning Brief <brief@media.example.org>"]),
+    ("notification", ["GitHub <notifications@github.example.com>", "Jira <jira@work.example.com>", "Calendar <calendar-noreply@example.com>"]),
+    ("receipt", ["Shop Orders <orders@shop.example.com>", "Billing <billing@cloud.example.net>", "Payments <no-reply@pay.example.com>"]),
+    ("personal", ["Alice Martin <alice@example.com>", "Bob Müller <bob@example.de>", "Chloé Durand <chloe@example.fr>"]),
+    ("promotion", ["Deals <deals@store.example.com>", "Travel Offers <offers@travel.example.com>"]),
+]
+_SUBJECTS = {
+    "newsletter": ["This week in {topic}", "{topic}: the 5 stories you missed", "Your {topic} digest"],
+    "notification": ["[repo] Pull request #{n} needs review", "Issue {n} was updated", "Reminder: {topic} sync tomorrow"],
+    "receipt": ["Your order #{n} has shipped", "Invoice {n} for {topic}", "Payment received - thank you"],
+    "personal": ["Re: plans for {topic}", "Quick question about {topic}", "Dinner on Friday?"],
+    "promotion": ["{n}% off everything {topic}", "Last chance: {topic} sale ends tonight"],
+}
+# List headers bulk mail carries, so sender aggregation sees what it would on a real inbox
+_BULK_HEADERS = {
+    "newsletter": "List-Id: <{list}>\r\nList-Unsubscribe: <mailto:unsubscribe@{domain}>\r\n",
+    "notification": "Precedence: bulk\r\n",
+    "promotion": "List-Unsubscribe: <https://{domain}/unsubscribe>\r\n",
+}
+_TOPICS = ["machine learning", "cloud costs", "the quarterly review", "Python", "kubernetes", "design", "the offsite", "café tables"]
+_WORDS = ("please review the attached details and let us know if anything needs to change before the deadline "
+          "we appreciate your feedback on the latest release notes summary schedule budget meeting").split()
+
+class MailboxGenerator:
+    """Deterministic synthetic mail: plain, quoted-printable latin-1, base64 UTF-8, HTML-only and attachments"""
+
+    def __init__(self, seed: int = 0, html_fraction: float = 0.25, attachment_fraction: float = 0.05, attachment_size: int = 32 * 1024):
+        self.rng = random.Random(seed)
+        self.html_fraction = html_fraction
+        self.attachment_fraction = attachment_fraction
+        self.attachment = base64.encodebytes(bytes(range(256)) * (attachment_size // 256)).replace(b"\n", b"\r\n")
+
+    def message(self, i: int) -> bytes:
+        rng = self.rng
+        kind, senders = rng.choice(_SENDERS)
+        sender = rng.choice(senders)
+        topic = rng.choice(_TOPICS)
+        subject = rng.choice(_SUBJECTS[kind]).format(topic=topic, n=rng.randint(10, 9999))
+        text = f"Hi, about {topic}: " + " ".join(rng.choice(_WORDS) for _ in range(rng.randint(40, 160)))
+
+        headers = (
+            f"From: {formataddr(parseaddr(sender), 'utf-8')}\r\n"
+            f"To: me@example.com\r\n"
+            f"Subject: {Header(subject, 'utf-8').encode() if not subject.isascii() else subject}\r\n"
+            f"Date: Mon, {1 + i % 28:02d} Jan 2024 {i % 24:02d}:{i % 60:02d}:00 +0000\r\n"
+            f"Message-ID: <bench-{i}@example.com>\r\n"
+            # Replies continue one thread per topic, so thread tracking has something to follow
+            + (f"In-Reply-To: <thread-{_TOPICS.index(topic)}@example.com>\r\nReferences: <thread-{_TOPICS.index(topic)}@example.com>\r\n" if subject.startswith("Re:") else "")
+            + _BULK_HEADERS.get(kind, "").format(list=parseaddr(sender)[1].replace("@", "."), domain=parseaddr(sender)[1].partition("@")[2])
+            + "MIME-Version: 1.0\r\n"
+        ).encode()
+
+        roll = rng.random()
+        if roll < self.attachment_fraction:
+            return headers + (
+                'Content-Type: multipart/mixed; boundary="mixed-b"\r\n\r\n'
+                "--mixed-b\r\nContent-Type: text/plain; charset=utf-8\r\n\r\n"
+            ).encode() + text.encode() + (
+                "\r\n--mixed-b\r\nContent-Type: application/pdf\r\nContent-Transfer-Encoding: base64\r\n"
+                'Content-Disposition: attachment; filename="report.pdf"\r\n\r\n'
+            ).encode() + self.attachment + b"--mixed-b--\r\n"
+        if roll < self.attachment_fraction + self.html_fraction:
+            html = f"<html><head><style>p{{color:#333}}</style></head><body><h1>{subject}</h1><p>{text}</p></body></html>"
+            return headers + b"Content-Type: text/html; charset=utf-8\r\n\r\n" + html.encode()
+        if kind == "personal" and rng.random() < 0.5:
+            body = base64.encodebytes(text.encode("utf-8")).replace(b"\n", b"\r\n")
+            return headers + b"Content-Type: text/plain; charset=utf-8\r\nContent-Transfer-Encoding: base64\r\n\r\n" + body
+        if rng.random() < 0.3:
+            body = quopri.encodestring(text.encode("latin-1", "replace")).replace(b"\n", b"\r\n")
+            return headers + b"Content-Type: text/plain; charset=iso-8859-1\r\nContent-Transfer-Encoding: quoted-printable\r\n\r\n" + body
+        return headers + b"Content-Type: text/plain; charset=utf-8\r\n\r\n" + text.encode()
@@ -0,0 +1,390 @@
+"""Offline benchmarks for fetch, MIME parsing, clustering, streamed analysis, parallel fetch, archive and the /clusters route.
+
+Runs against the in-process IMAP server and the fake LLM, so no Gmail account or API key is needed:
+
+    uv run python -m benchmarks.run --sizes 100,1000,10000 --output bench.json
+    uv run python -m benchmarks.run --output new.json --compare bench.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import dataclasses
+import platform
+import statistics
+import subprocess
+import tempfile
+from typing import List, Dict, Any, Callable, Optional
+
+from benchmarks.imap_server import BenchmarkImapServer, MailboxGenerator
+from benchmarks.fake_llm import FakeChatModel, fake_init_llm
+
+SCHEMA_VERSION = 1
+ACCOUNT = "bench@example.com"
+
+def summarize(samples: List[float]) -> Dict[str, float]:
+    ordered = sorted(samples)
+    return {
+        "runs": len(ordered),
+        "min_ms": round(ordered[0] * 1000, 3),
+        "median_ms": round(statistics.median(ordered) * 1000, 3),
+        "mean_ms": round(statistics.fmean(ordered) * 1000, 3),
+        "p95_ms": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000, 3),
+        "max_ms": round(ordered[-1] * 1000, 3),
+        "stdev_ms": round(statistics.stdev(ordered) * 1000, 3) if len(ordered) > 1 else 0.0,
+    }
+
+class Runner:
+    def __init__(self, args: argparse.Namespace, workdir: str):
+        self.args = args
+        self.workdir = workdir
+        self.results: List[Dict[str, Any]] = []
+        self._files = 0
+
+    def path(self, name: str) -> str:
+        """A fresh file in the scratch directory, so cold cases never see an earlier run's data"""
+        self._files += 1
+        return os.path.join(self.workdir, f"{self._files}-{name}")
+
+    def measure(self, benchmark: str, case: str, operation: Callable[[Any], Any], setup: Optional[Callable[[], Any]] = None,
+                params: Optional[Dict[str, Any]] = None, extra: Optional[Callable[[List[Any]], Dict[str, Any]]] = None):
+        """Time operation(setup()) `repeat` times after one untimed warm-up; only the operation is timed"""
+        samples, outputs = [], []
+        for i in range(self.args.repeat + 1):
+            state = setup() if setup else None
+            start = time.perf_counter()
+            output = operation(state)
+            elapsed = time.perf_counter() - start
+            if i:
+                samples.append(elapsed)
+                outputs.append(output)
+
+        entry = {"benchmark": benchmark, "case": case, "params": params or {}, "stats": summarize(samples)}
+        if extra:
+            entry["extra"] = extra(outputs)
+        self.results.append(entry)
+        label = " ".join(f"{k}={v}" for k, v in entry["params"].items())
+        print(f"{benchmark:<22} {case:<18} {label:<24} median {entry['stats']['median_ms']:>10.3f} ms")
+
+def server_cost(server: BenchmarkImapServer, operation: Callable[[Any], Any]) -> Callable[[Any], Dict[str, Any]]:
+    """Wrap an operation so it also reports the IMAP commands and bytes it caused"""
+    def run(state):
+        commands, sent = server.stats["commands"], server.stats["bytes_sent"]
+        result = operation(state)
+        return {"result": result, "commands": server.stats["commands"] - commands, "bytes": server.stats["bytes_sent"] - sent}
+    return run
+
+def cost_extra(outputs: List[Dict[str, Any]]) -> Dict[str, Any]:
+    return {
+        "imap_commands": statistics.median(o["commands"] for o in outputs),
+        "imap_bytes": statistics.median(o["bytes"] for o in outputs),
+    }
+
+def bench_fetch(runner: Runner, server: BenchmarkImapServer, size: int):
+    from gmail_client import GmailClient
+    from message_cache import MessageCache
+
+    params = {"mailbox_size": size, "limit": runner.args.limit}
+    limit = runner.args.limit
+
+    client = GmailClient(ACCOUNT, "password")
+    client.connect()
+    runner.measure("fetch_recent_emails", "no_cache", server_cost(server, lambda _: client.fetch_recent_emails(limit)),
+                   params=params, extra=cost_extra)
+
+    def cold():
+        client.cache = MessageCache(runner.path("email_cache.db"))
+    runner.measure("fetch_recent_emails", "cold_cache", server_cost(server, lambda _: client.fetch_recent_emails(limit)),
+                   setup=cold, params=params, extra=cost_extra)
+
+    runner.measure("fetch_recent_emails", "warm_cache", server_cost(server, lambda _: client.fetch_recent_emails(limit)),
+                   params=params, extra=cost_extra)
+
+    generator = MailboxGenerator(seed=size)
+    def new_mail():
+        for i in range(runner.args.new_messages):
+            server.inbox.append(generator.message(size + i))
+    runner.measure("fetch_recent_emails", "new_mail", server_cost(server, lambda _: client.fetch_recent_emails(limit)),
+                   setup=new_mail, params=dict(params, new_messages=runner.args.new_messages), extra=cost_extra)
+    client.disconnect()
+
+def bench_mime(runner: Runner):
+    from gmail_client import GmailClient
+
+    generator = MailboxGenerator(seed=1, attachment_fraction=0.1, attachment_size=256 * 1024)
+    corpus = [generator.message(i) for i in range(runner.args.mime_messages)]
+    total_bytes = sum(len(raw) for raw in corpus)
+    client = GmailClient(ACCOUNT, "password")
+
+    def parse(_):
+        for raw in corpus:
+            client._get_email_body(raw)
+
+    runner.measure("get_email_body", "full_messages", parse,
+                   params={"messages": len(corpus), "corpus_bytes": total_bytes},
+                   extra=lambda _: {"messages": len(corpus), "corpus_bytes": total_bytes})
+
+def sample_emails(server: BenchmarkImapServer, count: int) -> List[Any]:
+    from gmail_client import GmailClient
+
+    server.fill(count, seed=7)
+    client = GmailClient(ACCOUNT, "password")
+    client.connect()
+    emails = client.fetch_recent_emails(count)
+    client.disconnect()
+    return emails
+
+def bench_cluster(runner: Runner, emails: List[Any]):
+    from email_clusterer import EmailClusterer
+    from llm import LLMClient
+    from llm_cache import LLMResponseCache
+    from assignment_store import AssignmentStore
+
+    params = {"emails": len(emails), "llm_latency_s": runner.args.llm_latency}
+
+    def fresh(strategy: str):
+        return lambda: EmailClusterer(
+            cache=LLMResponseCache(runner.path("llm_cache.db")),
+            assignments=AssignmentStore(runner.path("assignments.db")),
+            strategy=strategy,
+        )
+
+    for strategy in ("hybrid", "map_reduce"):
+        runner.measure("cluster_emails", f"cold_{strategy}", lambda clusterer: clusterer.cluster_emails(emails),
+                       setup=fresh(strategy), params=params,
+                       extra=lambda outputs: {"clusters": statistics.median(len(o) for o in outputs)})
+
+    # Every first reply is cut off halfway: complete clusters are kept and only the rest is asked for again
+    def truncating():
+        clusterer = fresh("map_reduce")()
+        clusterer.llm = LLMClient(model=FakeChatModel(runner.args.llm_latency, truncate_every=2))
+        return clusterer
+    runner.measure("cluster_emails", "truncated_replies", lambda clusterer: clusterer.cluster_emails(emails),
+                   setup=truncating, params=params,
+                   extra=lambda outputs: {"clusters": statistics.median(len(o) for o in outputs)})
+
+    warm = fresh("hybrid")()
+    warm.cluster_emails(emails)
+    runner.measure("cluster_emails", "llm_cache_hit", lambda _: warm.cluster_emails(emails), params=params)
+
+    incremental = fresh("hybrid")()
+    incremental.cluster_emails(emails, ACCOUNT)
+    rng = random.Random(3)
+    def shifted():
+        # A few new arrivals on top of the same inbox: the stored cluster set should absorb them
+        newest = [dataclasses.replace(rng.choice(emails), message_id=f"<new-{rng.random()}@example.com>") for _ in range(5)]
+        return newest + emails[:-5]
+    runner.measure("cluster_emails", "incremental", lambda batch: incremental.cluster_emails(batch, ACCOUNT),
+                   setup=shifted, params=params)
+
+def bench_stream(runner: Runner, server: BenchmarkImapServer, window: int):
+    import tracemalloc
+    from gmail_client import GmailClient
+    from message_cache import MessageCache
+    from email_clusterer import EmailClusterer
+
+    server.fill(window, seed=window)
+    client = GmailClient(ACCOUNT, "password")
+    client.connect()
+    clusterer = EmailClusterer()
+    params = {"window": window}
+
+    def analyse(_):
+        grouper = clusterer.stream_grouper(window)
+        rows = []
+        for page in client.iter_recent_emails(window):
+            grouper.add(page)
+            rows.extend(email.slim() for email in page)
+        return len(rows), len(grouper.finish())
+
+    def cold():
+        client.cache = MessageCache(runner.path("email_cache.db"))
+    for case, setup in (("cold_cache", cold), ("warm_cache", None)):
+        runner.measure("stream_groups", case, server_cost(server, analyse), setup=setup, params=params,
+                       extra=lambda outputs: dict(cost_extra(outputs), emails=outputs[0]["result"][0], groups=outputs[0]["result"][1]))
+
+    # One more untimed pass under tracemalloc: peak Python allocations for the warm window
+    tracemalloc.start()
+    analyse(None)
+    runner.results[-1]["extra"]["peak_mb"] = round(tracemalloc.get_traced_memory()[1] / 1e6, 1)
+    tracemalloc.stop()
+    client.disconnect()
+
+def bench_parallel(runner: Runner, server: BenchmarkImapServer, window: int):
+    import gmail_client
+    from imap_pool import ImapConnectionPool
+
+    server.fill(window, seed=9)
+    connections = [int(n) for n in runner.args.parallel_connections.split(",")]
+    params = {"emails": window, "fetch_latency_s": runner.args.imap_fetch_latency}
+    # Only this group pays a round trip per FETCH, so the other groups stay comparable with older runs
+    server.fetch_latency = runner.args.imap_fetch_latency
+    default_connections = gmail_client.FETCH_CONNECTIONS
+    try:
+        for count in connections:
+            gmail_client.FETCH_CONNECTIONS = count
+            pool = ImapConnectionPool(max_per_account=max(connections))
+            pool.register(ACCOUNT, "password")
+            fetch = lambda _: len(pool.run(ACCOUNT, lambda client: client.fetch_recent_emails(window)))
+            runner.measure("parallel_fetch", f"connections_{count}", server_cost(server, fetch),
+                           params=dict(params, connections=count), extra=cost_extra)
+            pool.close_all()
+    finally:
+        gmail_client.FETCH_CONNECTIONS = default_connections
+        server.fetch_latency = 0.0
+
+def bench_archive(runner: Runner, server: BenchmarkImapServer):
+    from gmail_client import GmailClient
+
+    count = runner.args.archive_count
+    server.fill(count, seed=11)
+    client = GmailClient(ACCOUNT, "password")
+    client.connect()
+    generator = MailboxGenerator(seed=12)
+
+    def refill():
+        for i in range(count - len(server.inbox.uids)):
+            server.inbox.append(generator.message(i))
+        return list(server.inbox.uids[-count:])
+
+    runner.measure("archive_emails", "uid_move", server_cost(server, lambda uids: client.archive_emails(uids)),
+                   setup=refill, params={"messages": count}, extra=cost_extra)
+    client.disconnect()
+
+def bench_route(runner: Runner, server: BenchmarkImapServer, size: int):
+    server.fill(size, seed=21)
+    import main
+    from fragment_cache import FragmentCache
+    from starlette.testclient import TestClient
+
+    client = TestClient(main.app).__enter__()
+    client.post("/connect", data={"email": ACCOUNT, "password": "password"}, follow_redirects=False)
+    client.get("/analyze", follow_redirects=False)
+    deadline = time.monotonic() + 120
+    while not client.get("/analyze/status").headers.get("HX-Redirect"):
+        if time.monotonic() > deadline:
+            raise TimeoutError("analysis did not finish")
+        time.sleep(0.05)
+
+    def get(path: str):
+        def run(_):
+            response = client.get(path)
+            response.raise_for_status()
+            return len(response.content)
+        return run
+
+    size_extra = lambda outputs: {"response_bytes": statistics.median(outputs)}
+    params = {"mailbox_size": size}
+
+    def cold_fragments():
+        main.fragments = FragmentCache()
+    runner.measure("clusters_route", "cold_fragments", get("/clusters"), setup=cold_fragments, params=params, extra=size_extra)
+    runner.measure("clusters_route", "warm_fragments", get("/clusters"), params=params, extra=size_extra)
+    runner.measure("clusters_route", "more_emails", get("/clusters/0/emails?offset=5"), params=params, extra=size_extra)
+    client.__exit__(None, None, None)
+
+def compare(results: List[Dict[str, Any]], baseline_path: str):
+    """Print the median change of every benchmark also present in a baseline file"""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    key = lambda r: (r["benchmark"], r["case"], json.dumps(r["params"], sort_keys=True))
+    previous = {key(r): r for r in baseline.get("results", [])}
+    print(f"\nCompared with {baseline_path}:")
+    for result in results:
+        old = previous.get(key(result))
+        if not old:
+            continue
+        before, after = old["stats"]["median_ms"], result["stats"]["median_ms"]
+        change = (after - before) / before * 100 if before else 0.0
+        print(f"{result['benchmark']:<22} {result['case']:<18} {before:>10.3f} -> {after:>10.3f} ms ({change:+.1f}%)")
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Offline Email Cluster Manager benchmarks")
+    parser.add_argument("--sizes", default="100,1000,10000", help="Comma-separated INBOX sizes for the fetch benchmarks (up to 50000)")
+    parser.add_argument("--repeat", type=int, default=5, help="Timed runs per case, after one warm-up run")
+    parser.add_argument("--limit", type=int, default=200, help="Emails fetched per analysis")
+    parser.add_argument("--new-messages", type=int, default=10, help="Arrivals between runs in the new_mail case")
+    parser.add_argument("--mime-messages", type=int, default=1000, help="Messages in the MIME parsing corpus")
+    parser.add_argument("--cluster-emails", type=int, default=200, help="Emails per clustering run")
+    parser.add_argument("--stream-window", type=int, default=2000, help="Analysis window for the streamed fetch and grouping benchmark")
+    parser.add_argument("--parallel-window", type=int, default=2000, help="Emails fetched per run in the parallel fetch benchmark")
+    parser.add_argument("--parallel-connections", default="1,2,4", help="Comma-separated connection counts for the parallel fetch benchmark")
+    parser.add_argument("--imap-fetch-latency", type=float, default=0.05, help="Seconds the IMAP server sleeps per content FETCH in the parallel fetch benchmark")
+    parser.add_argument("--archive-count", type=int, default=150, help="Messages archived per run")
+    parser.add_argument("--route-size", type=int, default=1000, help="INBOX size behind the /clusters route benchmark")
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="Seconds the fake LLM sleeps per call")
+    parser.add_argument("--imap-latency", type=float, default=0.0, help="Seconds the IMAP server sleeps on LOGIN")
+    parser.add_argument("--only", default="fetch,mime,cluster,stream,parallel,archive,route", help="Comma-separated benchmark groups to run")
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    parser.add_argument("--compare", help="Baseline JSON file to compare medians against")
+    return parser.parse_args(argv)
+
+def main(argv: Optional[List[str]] = None):
+    args = parse_args(argv)
+    only = set(args.only.split(","))
+    server = BenchmarkImapServer(latency=args.imap_latency).start()
+
+    with tempfile.TemporaryDirectory(prefix="email-bench-") as workdir:
+        # Point the app at the local server, scratch stores and the fake LLM before any app module is imported
+        os.environ.update({
+            "IMAP_HOST": "127.0.0.1",
+            "IMAP_PORT": str(server.port),
+            "IMAP_SSL": "false",
+            "IMAP_IDLE": "false",
+            "ANTHROPIC_API_KEY": "benchmark",
+            "EMAIL_CACHE_PATH": os.path.join(workdir, "email_cache.db"),
+            "LLM_CACHE_PATH": os.path.join(workdir, "llm_cache.db"),
+            "ASSIGNMENT_STORE_PATH": os.path.join(workdir, "assignments.db"),
+            "RESULT_STORE_BACKEND": "memory",
+        })
+        import llm
+        llm.init_llm = fake_init_llm(args.llm_latency)
+
+        runner = Runner(args, workdir)
+        if "fetch" in only:
+            for size in (int(s) for s in args.sizes.split(",")):
+                server.fill(size, seed=size)
+                bench_fetch(runner, server, size)
+        if "mime" in only:
+            bench_mime(runner)
+        if "cluster" in only:
+            bench_cluster(runner, sample_emails(server, args.cluster_emails))
+        if "stream" in only:
+            bench_stream(runner, server, args.stream_window)
+        if "parallel" in only:
+            bench_parallel(runner, server, args.parallel_window)
+        if "archive" in only:
+            bench_archive(runner, server)
+        if "route" in only:
+            bench_route(runner, server, args.route_size)
+    server.stop()
+
+    report = {
+        "schema_version": SCHEMA_VERSION,
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "git_commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "args": vars(args),
+        },
+        "results": runner.results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nWrote {len(runner.results)} results to {args.output}")
+    if args.compare:
+        compare(runner.results, args.compare)
+    return report
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,95 @@
+import json
+from typing import List, Dict, Any
+
+# The LLM reports clusters by calling this tool, so replies are schema-shaped JSON rather than free text
+CLUSTER_TOOL = "report_clusters"
+
+# Rough characters per token for budgeting prompts before they are sent
+CHARS_PER_TOKEN = 4
+
+def cluster_tool(key: str) -> Dict[str, Any]:
+    """Anthropic tool definition for a list of clusters whose members are listed under `key`"""
+    return {
+        "name": CLUSTER_TOOL,
+        "description": "Report the clusters. Every numbered item must be listed in exactly one cluster.",
+        "input_schema": {
+            "type": "object",
+            "properties": {
+                "clusters": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "name": {"type": "string", "description": "Clear, actionable cluster name"},
+                            "description": {"type": "string", "description": "What to do with these emails"},
+                            "action": {"type": "string", "description": "Archive, Review, Reply, Schedule, Pay, ..."},
+                            "priority": {"type": "string", "enum": ["high", "medium", "low"]},
+                            key: {"type": "array", "items": {"type": "integer"}, "description": "Numbers of the items in this cluster"},
+                        },
+                        "required": ["name", "description", "action", "priority", key],
+                    },
+                },
+            },
+            "required": ["clusters"],
+        },
+    }
+
+class ClusterStreamParser:
+    """Incremental parser for {"clusters": [{...}, ...]} replies, fed text as it streams in.
+    Each cluster object is decoded as soon as it closes, so a reply cut off part-way still yields
+    every cluster completed before the cut. Text around the JSON (fences, prose) is ignored."""
+
+    def __init__(self):
+        self.clusters: List[Dict[str, Any]] = []
+        self.complete = False
+        self.fed = False
+        self._text: List[str] = []
+        self._stack: List[str] = []
+        self._in_string = False
+        self._escape = False
+        # Stack depth of the clusters array once it opens, and where the current cluster object began
+        self._array_depth = None
+        self._start = None
+        self._offset = 0
+
+    def feed(self, text: str):
+        if not text or self.complete:
+            return
+        self.fed = True
+        self._text.append(text)
+        for i, char in enumerate(text, self._offset):
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                if self._stack:
+                    self._in_string = True
+            elif char in "{[":
+                if char == "{" and self._array_depth is not None and len(self._stack) == self._array_depth:
+                    self._start = i
+                self._stack.append(char)
+                if char == "[" and self._array_depth is None:
+                    self._array_depth = len(self._stack)
+            elif char in "}]" and self._stack:
+                self._stack.pop()
+                if char == "}" and self._start is not None and len(self._stack) == self._array_depth:
+                    self._close(self._start, i + 1)
+                    self._start = None
+                if not self._stack:
+                    self.complete = True
+                    break
+        self._offset += len(text)
+
+    def _close(self, start: int, end: int):
+        text = "".join(self._text)
+        self._text = [text]
+        try:
+            cluster = json.loads(text[start:end])
+        except ValueError:
+            return
+        if isinstance(cluster, dict):
+            self.clusters.append(cluster)
@@ -0,0 +1,58 @@
+import os
+import asyncio
+import contextvars
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Callable, Optional, TypeVar
+
+from gmail_client import GmailClient
+from imap_pool import ImapConnectionPool
+
+T = TypeVar("T")
+
+class AccountLimiter:
+    """Async concurrency limits applied globally and per account"""
+
+    def __init__(self, global_limit: int, per_account_limit: int):
+        self.per_account_limit = per_account_limit
+        self._global = asyncio.Semaphore(global_limit)
+        self._accounts: Dict[str, list] = {}
+
+    @asynccontextmanager
+    async def limit(self, account: str):
+        entry = self._accounts.setdefault(account, [asyncio.Semaphore(self.per_account_limit), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                async with self._global:
+                    yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._accounts[account]
+
+class ImapExecutor:
+    """Runs blocking imaplib work for pooled connections on a bounded thread pool"""
+
+    def __init__(self, pool: ImapConnectionPool, max_workers: Optional[int] = None):
+        self.pool = pool
+        self.max_workers = max_workers or int(os.getenv("IMAP_WORKERS", "16"))
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="imap")
+        self.limiter = AccountLimiter(self.max_workers, pool.max_per_account)
+
+    async def run(self, account: str, operation: Callable[[GmailClient], T]) -> T:
+        async with self.limiter.limit(account):
+            loop = asyncio.get_running_loop()
+            # Carry the request context into the worker so its stage timings reach the request
+            context = contextvars.copy_context()
+            return await loop.run_in_executor(self._executor, context.run, self.pool.run, account, operation)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+def request_limiter() -> AccountLimiter:
+    """Limits for requests' IMAP work: REQUEST_CONCURRENCY globally, ACCOUNT_REQUEST_CONCURRENCY per account"""
+    return AccountLimiter(
+        int(os.getenv("REQUEST_CONCURRENCY", "32")),
+        int(os.getenv("ACCOUNT_REQUEST_CONCURRENCY", "1"))
+    )
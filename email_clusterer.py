@@ -1,131 +1,650 @@
-from typing import List, Dict, Any
-import json
-from llm import init_llm
+from typing import List, Dict, Any, Optional, Tuple, Callable, Awaitable
+import os
+import math
+import time
+import asyncio
+import metrics
+from llm import LLMClient, init_llm_client, LLM_MODEL
+from llm_cache import LLMResponseCache, init_llm_cache
+from local_clustering import LocalClusterer, StreamingClusterer, HashedTfidfVectorizer, vectorize_with_idf, centroid, email_signature, dot
+from assignment_store import AssignmentStore, init_assignment_store, message_key
+from email_record import EmailRecord
+from sender_index import SenderIndex
+from rules import RuleEngine, init_rule_engine, OTHER_CLUSTER
+from email_graph import EmailGraph, init_email_graph
+from cluster_output import CLUSTER_TOOL, CHARS_PER_TOKEN, ClusterStreamParser, cluster_tool
+
+# Bump whenever the prompts or the shape of parsed clusters change, to invalidate cached results
+PROMPT_VERSION = "clusters-v5"
+# Prompt tokens reserved for instructions; the rest of the budget is shared by the item lines
+PROMPT_OVERHEAD_TOKENS = 400
+# Smallest useful item line (sender and a few words of subject), which bounds items per prompt
+MIN_ITEM_TOKENS = 24
 
 class EmailClusterer:
-    def __init__(self):
-        self.llm = init_llm()
+    def __init__(self, chunk_size: Optional[int] = None, max_chunks: Optional[int] = None, concurrency: Optional[int] = None, cache: Optional[LLMResponseCache] = None, strategy: Optional[str] = None, assignments: Optional[AssignmentStore] = None, rules: Optional[RuleEngine] = None, graph: Optional[EmailGraph] = None):
+        try:
+            self.llm: Optional[LLMClient] = init_llm_client()
+        except ValueError as e:
+            print(f"LLM unavailable, clustering locally: {e}")
+            self.llm = None
+        self.cache = cache if cache is not None else init_llm_cache()
+        self.strategy = strategy or os.getenv("CLUSTER_STRATEGY", "hybrid")
+        self.local = LocalClusterer(max_clusters=int(os.getenv("LOCAL_MAX_CLUSTERS", "12")))
+        self.assignments = assignments if assignments is not None else init_assignment_store()
+        self.rules = rules if rules is not None else init_rule_engine()
+        self.graph = graph if graph is not None else init_email_graph()
+        # Cached results and stored cluster sets depend on the rules as well as the prompts
+        self.version = f"{PROMPT_VERSION}:{self.rules.fingerprint}"
+        self.drift_threshold = float(os.getenv("CLUSTER_DRIFT_THRESHOLD", "0.2"))
+        self.min_similarity = float(os.getenv("ASSIGN_MIN_SIMILARITY", "0.15"))
+        self.cluster_set_max_age = float(os.getenv("CLUSTER_SET_MAX_AGE", "86400"))
+        self.chunk_size = chunk_size or int(os.getenv("CLUSTER_CHUNK_SIZE", "50"))
+        self.max_chunks = max_chunks or int(os.getenv("CLUSTER_MAX_CHUNKS", "8"))
+        self.concurrency = concurrency or int(os.getenv("CLUSTER_CONCURRENCY", "4"))
+        # Windows larger than this are grouped page by page while fetching instead of held in memory
+        self.stream_threshold = int(os.getenv("CLUSTER_STREAM_THRESHOLD", "1000"))
+        self.prompt_token_budget = int(os.getenv("LLM_PROMPT_TOKEN_BUDGET", "8000"))
+        self.max_output_tokens = int(os.getenv("LLM_MAX_OUTPUT_TOKENS", "4096"))
+        # With an on_preview callback, a local grouping is published if the LLM has not answered after
+        # preview_after seconds, and kept as the result if it has not answered within llm_deadline
+        self.preview_after = float(os.getenv("CLUSTER_PREVIEW_AFTER", "0.25"))
+        self.llm_deadline = float(os.getenv("CLUSTER_LLM_DEADLINE", "30"))
     
-    def cluster_emails(self, emails: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    def cluster_emails(self, emails: List[EmailRecord], account: Optional[str] = None) -> List[Dict[str, Any]]:
+        return asyncio.run(self.acluster_emails(emails, account))
+    
+    async def acluster_emails(self, emails: List[EmailRecord], account: Optional[str] = None, on_preview: Optional[Callable[[List[Dict[str, Any]]], None]] = None) -> List[Dict[str, Any]]:
+        """Cluster emails; with on_preview, the fallback rules' grouping is handed to it while the LLM works"""
         if not emails:
             return []
         
-        email_summaries = []
-        for email in emails[:200]:
-            summary = f"From: {email['from'][:50]}, Subject: {email['subject'][:100]}, Preview: {email['body'][:150]}"
-            email_summaries.append(summary)
+        async def cluster():
+            with metrics.span("cluster"):
+                return await self._cluster(emails, account)
         
-        prompt = f"""Analyze these {len(email_summaries)} emails and group them into 3-5 actionable clusters. 
-        For each cluster, provide:
-        1. A clear, actionable name (e.g., "Newsletters to Unsubscribe", "Meeting Requests to Schedule", "Bills to Pay")
-        2. A brief description of what action to take
-        3. The email indices that belong to this cluster (0-indexed)
+        if on_preview is None:
+            return await cluster()
+        return await self._hedge(cluster(), lambda: self._fallback_clustering(emails), on_preview)
+    
+    def stream_grouper(self, expected: Optional[int] = None) -> StreamingClusterer:
+        """A grouper to feed pages of a large window into; pass its groups to cluster_groups"""
+        return StreamingClusterer(max_clusters=self.local.max_clusters, expected=expected, classify=self.rules.match)
+    
+    def cluster_groups(self, groups: List[Dict[str, Any]], total: int) -> List[Dict[str, Any]]:
+        return asyncio.run(self.acluster_groups(groups, total))
+    
+    async def acluster_groups(self, groups: List[Dict[str, Any]], total: int, on_preview: Optional[Callable[[List[Dict[str, Any]]], None]] = None) -> List[Dict[str, Any]]:
+        """Name and merge streamed groups from their representatives; clusters reference emails by email_indices.
+        Groups of rule matches become their rule's cluster as they are. With on_preview, the groups under
+        their local names are handed to it while the LLM works."""
+        if not groups:
+            return []
+        rule_clusters = [self.rules.cluster(group["rule"], group["indices"]) for group in groups if "rule" in group]
+        groups = [group for group in groups if "rule" not in group]
+        metrics.inc("messages_preclassified_total", sum(cluster["count"] for cluster in rule_clusters), source="rules")
+        if not groups:
+            return self._merge_fixed_clusters(rule_clusters, [])
         
-        Return as JSON with this exact structure:
-        {{
-            "clusters": [
-                {{
-                    "name": "cluster name",
-                    "description": "what to do with these emails",
-                    "action": "Archive", 
-                    "email_indices": [0, 1, 2],
-                    "count": 3,
-                    "priority": "high|medium|low"
-                }}
-            ]
-        }}
+        async def label():
+            with metrics.span("cluster"):
+                representatives = {group["representative"]: group["representative_email"] for group in groups}
+                clusters, _ = await self._label_groups(groups, representatives, total)
+            return self._merge_fixed_clusters(rule_clusters, clusters)
         
-        Email summaries:
-        {chr(10).join([f'{i}. {s}' for i, s in enumerate(email_summaries[:100])])}
+        if on_preview is None:
+            return await label()
+        return await self._hedge(label(), lambda: self._merge_fixed_clusters(rule_clusters, self._local_partials(groups)), on_preview)
+    
+    async def _hedge(self, clustering: Awaitable[List[Dict[str, Any]]], preview: Callable[[], List[Dict[str, Any]]], on_preview: Callable[[List[Dict[str, Any]]], None]) -> List[Dict[str, Any]]:
+        """Race the LLM clustering against the clock. Answers within preview_after are returned as they are;
+        otherwise the local preview is published, and if the deadline passes too the LLM work is cancelled
+        and the preview becomes the result."""
+        task = asyncio.ensure_future(clustering)
+        try:
+            done, _ = await asyncio.wait({task}, timeout=min(self.preview_after, self.llm_deadline))
+            if done:
+                return task.result()
+            
+            with metrics.span("cluster_preview"):
+                clusters = preview()
+            metrics.inc("cluster_previews_total")
+            on_preview(clusters)
+            
+            done, _ = await asyncio.wait({task}, timeout=max(0.0, self.llm_deadline - self.preview_after))
+            if done:
+                try:
+                    return task.result()
+                except Exception as e:
+                    # The preview is already on screen; keep it rather than fail the analysis
+                    print(f"Error clustering, keeping the local clusters: {e}")
+                    metrics.inc("cluster_fallbacks_total", reason="llm_error")
+                    return clusters
+            print(f"LLM clustering missed its {self.llm_deadline:g}s deadline, keeping the local clusters")
+            metrics.inc("cluster_fallbacks_total", reason="deadline")
+            return clusters
+        finally:
+            if not task.done():
+                task.cancel()
+    
+    async def _cluster(self, emails: List[EmailRecord], account: Optional[str]) -> List[Dict[str, Any]]:
+        chunk_size = max(self.chunk_size, math.ceil(len(emails) / self.max_chunks))
+        cache_key = LLMResponseCache.make_key(f"{self.version}:{LLM_MODEL}:{self.strategy}:{chunk_size}", emails)
+        cached = self.cache.get(cache_key)
+        metrics.inc("cache_lookups_total", cache="llm", result="miss" if cached is None else "hit")
+        if cached is not None:
+            return self._from_cache_entry(cached, len(emails))
         
-        {f'... and {len(email_summaries) - 100} more emails' if len(email_summaries) > 100 else ''}
+        # Rule matches are final, and so are messages whose thread or sender the graph has placed before;
+        # only the ambiguous remainder is clustered
+        with metrics.span("cluster_rules"):
+            matched, rest = self.rules.partition(emails)
+        metrics.inc("messages_preclassified_total", len(emails) - len(rest), source="rules")
+        fixed = self.rules.clusters(matched)
+        if rest and account and self.graph is not None:
+            with metrics.span("cluster_graph"):
+                known, rest = await asyncio.to_thread(self._classify_from_graph, account, emails, rest)
+            metrics.inc("messages_preclassified_total", sum(cluster["count"] for cluster in known), source="graph")
+            fixed += known
         
-        Focus on actionability and usefulness. Group by what action the user should take."""
+        clusters, complete = [], True
+        if rest:
+            remainder = [emails[i] for i in rest] if fixed else emails
+            clusters, complete = await self._cluster_remainder(remainder, account)
+            if fixed:
+                for cluster in clusters:
+                    cluster["email_indices"] = [rest[i] for i in cluster["email_indices"]]
+        clusters = self._merge_fixed_clusters(fixed, clusters)
         
+        if complete:
+            self.cache.put(cache_key, self._to_cache_entry(clusters))
+            if account and self.graph is not None:
+                await asyncio.to_thread(self._record_graph, account, emails, clusters)
+        return clusters
+    
+    def _classify_from_graph(self, account: str, emails: List[EmailRecord], positions: List[int]) -> Tuple[List[Dict[str, Any]], List[int]]:
+        """Graph clusters for the emails at `positions`, and the positions it could not place"""
         try:
-            response = self.llm.invoke(prompt)
-            
-            content = response.content
-            if "```json" in content:
-                content = content.split("```json")[1].split("```")[0]
-            elif "```" in content:
-                content = content.split("```")[1].split("```")[0]
-            
-            clusters_data = json.loads(content)
-            clusters = clusters_data.get("clusters", [])
-            
+            known, rest = self.graph.classify(account, [emails[i] for i in positions])
+        except Exception as e:
+            print(f"Error reading email graph: {e}")
+            metrics.inc("cache_lookups_total", cache="graph", result="error")
+            return [], positions
+        metrics.inc("cache_lookups_total", len(positions) - len(rest), cache="graph", result="hit")
+        metrics.inc("cache_lookups_total", len(rest), cache="graph", result="miss")
+        for cluster in known:
+            cluster["email_indices"] = [positions[i] for i in cluster["email_indices"]]
+        return known, [positions[i] for i in rest]
+    
+    def _record_graph(self, account: str, emails: List[EmailRecord], clusters: List[Dict[str, Any]]):
+        try:
+            with metrics.span("graph_write"):
+                self.graph.record(account, emails, clusters)
+        except Exception as e:
+            print(f"Error writing email graph: {e}")
+    
+    async def _cluster_remainder(self, emails: List[EmailRecord], account: Optional[str]) -> Tuple[List[Dict[str, Any]], bool]:
+        if account:
+            with metrics.span("cluster_incremental"):
+                clusters = await asyncio.to_thread(self._classify_incrementally, emails, account)
+            metrics.inc("cache_lookups_total", cache="assignments", result="miss" if clusters is None else "hit")
+            if clusters is not None:
+                return clusters, False
+        
+        # Each bulk source becomes one weighted entry; strategies work on entries and are expanded back to messages
+        index = SenderIndex(emails)
+        entries, weights = index.representatives, index.weights
+        metrics.inc("messages_collapsed_total", index.collapsed)
+        entry_chunk_size = max(self.chunk_size, math.ceil(len(entries) / self.max_chunks))
+        entry_chunk_size = min(entry_chunk_size, max(1, (self.prompt_token_budget - PROMPT_OVERHEAD_TOKENS) // MIN_ITEM_TOKENS))
+        
+        if self.strategy == "hybrid":
+            clusters, complete = await self._hybrid(entries, weights)
+        elif self.llm is None:
+            metrics.inc("cluster_fallbacks_total", reason="no_llm")
+            clusters, complete = self._fallback_clustering(entries), False
+        elif len(entries) > entry_chunk_size:
+            clusters, complete = await self._map_reduce(entries, entry_chunk_size, weights)
+        else:
+            try:
+                clusters, complete = await self._label_emails(entries, weights, "single")
+            except Exception as e:
+                print(f"Error clustering: {e}")
+                metrics.inc("cluster_fallbacks_total", reason="llm_error")
+                clusters, complete = self._fallback_clustering(entries), False
+        
+        for cluster in clusters:
+            cluster["email_indices"] = index.expand(cluster["email_indices"])
+            cluster["count"] = len(cluster["email_indices"])
+        
+        if complete and account:
+            await asyncio.to_thread(self._save_cluster_set, account, clusters, emails)
+        return clusters, complete
+    
+    async def _invoke(self, prompt: str, stage: str, key: str = "email_indices") -> Tuple[List[Dict[str, Any]], bool]:
+        """Stream a forced cluster-tool call, recording latency, outcome and reported token usage.
+        Returns the clusters and whether the reply was complete; a reply cut short (output limit,
+        dropped stream) still returns the clusters that finished before the cut."""
+        tool_args, text = ClusterStreamParser(), ClusterStreamParser()
+        usage = {}
+        error = None
+        try:
+            with metrics.span(f"llm_{stage}"):
+                async for chunk in self.llm.astream(prompt, [cluster_tool(key)], tool_choice=CLUSTER_TOOL, max_tokens=self.max_output_tokens):
+                    for call in getattr(chunk, "tool_call_chunks", None) or []:
+                        tool_args.feed(call.get("args") or "")
+                    # Without a tool call, fall back to JSON in the text (possibly fenced)
+                    content = chunk.content
+                    if isinstance(content, str):
+                        text.feed(content)
+                    else:
+                        for block in content:
+                            if isinstance(block, dict) and block.get("type") == "text":
+                                text.feed(block.get("text") or "")
+                    for direction in ("input", "output"):
+                        usage[direction] = usage.get(direction, 0) + ((getattr(chunk, "usage_metadata", None) or {}).get(f"{direction}_tokens") or 0)
+        except Exception as e:
+            error = e
+        for direction, tokens in usage.items():
+            if tokens:
+                metrics.inc("llm_tokens_total", tokens, direction=direction)
+        
+        parser = tool_args if tool_args.fed else text
+        if not parser.clusters:
+            metrics.inc("llm_calls_total", stage=stage, outcome="error")
+            raise error or ValueError("reply contained no clusters")
+        if error:
+            print(f"Error streaming {stage} reply, keeping {len(parser.clusters)} complete clusters: {error}")
+        metrics.inc("llm_calls_total", stage=stage, outcome="ok" if parser.complete else "truncated")
+        return parser.clusters, parser.complete
+    
+    async def _label_emails(self, emails: List[EmailRecord], weights: Optional[List[int]], stage: str) -> Tuple[List[Dict[str, Any]], bool]:
+        """One labelling call for a batch of emails. Emails the reply leaves out are sent back in a single
+        recovery request, then to the fallback rules; only a reply covering every email is complete."""
+        lines = self._email_lines(emails, weights)
+        clusters, _ = await self._invoke(self._build_prompt(lines, sum(weights) if weights else len(emails)), stage)
+        clusters, complete = await self._recover(clusters, lines, "email_indices")
+        clusters = self._parse_clusters(clusters, emails)
+        
+        claimed = {idx for cluster in clusters for idx in cluster["email_indices"]}
+        leftovers = [i for i in range(len(emails)) if i not in claimed]
+        if leftovers:
+            metrics.inc("cluster_fallbacks_total", reason="unassigned")
+            fallback = self._fallback_clustering([emails[i] for i in leftovers])
+            for cluster in fallback:
+                cluster["email_indices"] = [leftovers[i] for i in cluster["email_indices"]]
+            clusters = self._merge_by_name(clusters + fallback)
             for cluster in clusters:
-                cluster_emails = []
-                for idx in cluster.get("email_indices", []):
-                    if 0 <= idx < len(emails):
-                        cluster_emails.append(emails[idx])
-                cluster["emails"] = cluster_emails
-                cluster["count"] = len(cluster_emails)
-            
-            return clusters
+                cluster["count"] = len(cluster["email_indices"])
+        return clusters, complete
+    
+    async def _recover(self, clusters: List[Dict[str, Any]], lines: List[str], key: str) -> Tuple[List[Dict[str, Any]], bool]:
+        """Ask once more for just the items no cluster claimed, offering the clusters so far.
+        Returns the clusters with whatever was recovered and whether every item is now claimed."""
+        claimed = {idx for cluster in clusters for idx in cluster.get(key) or [] if isinstance(idx, int)}
+        missing = [i for i in range(len(lines)) if i not in claimed]
+        if not missing:
+            return clusters, True
+        
+        metrics.inc("llm_recovered_items_total", len(missing))
+        try:
+            recovered, _ = await self._invoke(self._build_recovery_prompt(clusters, lines, missing), "recover", key)
         except Exception as e:
-            print(f"Error clustering: {e}")
-            return self._fallback_clustering(emails)
+            print(f"Error recovering unassigned items: {e}")
+            return clusters, False
+        
+        wanted = set(missing)
+        by_name = {str(cluster.get("name", "")).strip().lower(): cluster for cluster in clusters}
+        for cluster in recovered:
+            items = [idx for idx in cluster.get(key) or [] if idx in wanted]
+            wanted.difference_update(items)
+            if not items:
+                continue
+            target = by_name.get(str(cluster.get("name", "")).strip().lower())
+            if target is not None:
+                target[key] = list(target.get(key) or []) + items
+            else:
+                cluster[key] = items
+                clusters.append(cluster)
+                by_name[str(cluster.get("name", "")).strip().lower()] = cluster
+        return clusters, not wanted
     
-    def _fallback_clustering(self, emails: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-        clusters = []
+    def _classify_incrementally(self, emails: List[EmailRecord], account: str) -> Optional[List[Dict[str, Any]]]:
+        """Reuse the account's stored cluster set, classifying only new or changed messages by nearest centroid.
+        Returns None when there is no usable cluster set or drift calls for a full re-cluster."""
+        cluster_set = self.assignments.get_cluster_set(account, self.version)
+        if not cluster_set or time.time() - cluster_set["created_at"] > self.cluster_set_max_age:
+            return None
         
-        newsletters = []
-        notifications = []
-        personal = []
-        other = []
+        stored_clusters = cluster_set["clusters"]
+        keys = [message_key(email) for email in emails]
+        known = self.assignments.get_assignments(account, cluster_set["version"], keys)
         
-        for email in emails:
-            sender = email.get("from", "").lower()
-            subject = email.get("subject", "").lower()
-            
-            if any(word in sender or word in subject for word in ["newsletter", "digest", "update", "weekly", "daily", "unsubscribe"]):
-                newsletters.append(email)
-            elif any(word in sender for word in ["notification", "alert", "noreply", "no-reply", "automated"]):
-                notifications.append(email)
-            elif "@gmail.com" in sender or "@yahoo.com" in sender or "@outlook.com" in sender:
-                personal.append(email)
+        members = [[] for _ in stored_clusters]
+        pending = []
+        for i, (email, key) in enumerate(zip(emails, keys)):
+            stored = known.get(key)
+            if stored and stored[1] == email_signature(email) and 0 <= stored[0] < len(members):
+                members[stored[0]].append(i)
             else:
-                other.append(email)
-        
-        if newsletters:
-            clusters.append({
-                "name": "Newsletters & Updates",
-                "description": "Marketing emails and newsletters - consider unsubscribing from unwanted ones",
-                "action": "Archive",
-                "emails": newsletters,
-                "count": len(newsletters),
-                "priority": "low"
-            })
+                pending.append(i)
         
-        if notifications:
-            clusters.append({
-                "name": "Automated Notifications",
-                "description": "System notifications and automated messages",
-                "action": "Archive",
-                "emails": notifications,
-                "count": len(notifications),
-                "priority": "low"
-            })
+        if len(pending) == len(emails):
+            return None
         
-        if personal:
-            clusters.append({
-                "name": "Personal Emails",
-                "description": "Emails from individuals - review for important messages",
-                "action": "Review",
-                "emails": personal,
-                "count": len(personal),
-                "priority": "high"
-            })
+        poor_fits = 0
+        new_assignments = []
+        for i in pending:
+            vector = vectorize_with_idf(emails[i], cluster_set["idf"], cluster_set["default_idf"])
+            similarities = [dot(vector, cluster["centroid"]) for cluster in stored_clusters]
+            best = max(range(len(stored_clusters)), key=lambda c: similarities[c])
+            if similarities[best] < self.min_similarity:
+                poor_fits += 1
+            members[best].append(i)
+            new_assignments.append((keys[i], best, email_signature(emails[i])))
         
-        if other:
-            clusters.append({
-                "name": "Other Emails",
-                "description": "Miscellaneous emails to review",
+        if poor_fits > self.drift_threshold * len(emails):
+            return None
+        if new_assignments:
+            self.assignments.add_assignments(account, cluster_set["version"], new_assignments)
+        
+        clusters = []
+        for stored, indices in zip(stored_clusters, members):
+            if not indices:
+                continue
+            indices.sort()
+            cluster = {k: v for k, v in stored.items() if k != "centroid"}
+            cluster["email_indices"] = indices
+            cluster["count"] = len(indices)
+            clusters.append(cluster)
+        return clusters
+    
+    def _save_cluster_set(self, account: str, clusters: List[Dict[str, Any]], emails: List[EmailRecord]):
+        vectorizer = HashedTfidfVectorizer()
+        vectors = vectorizer.fit_transform(emails)
+        
+        stored_clusters = []
+        assignments = []
+        for cluster_index, cluster in enumerate(clusters):
+            indices = cluster["email_indices"]
+            stored = {k: cluster.get(k) for k in ("name", "description", "action", "priority")}
+            stored["centroid"] = centroid(vectors, indices)
+            stored_clusters.append(stored)
+            for i in indices:
+                assignments.append((message_key(emails[i]), cluster_index, email_signature(emails[i])))
+        
+        features = {feature for stored in stored_clusters for feature in stored["centroid"]}
+        data = {
+            "clusters": stored_clusters,
+            "idf": {feature: vectorizer.idf(feature) for feature in features},
+            "default_idf": vectorizer.idf(-1),
+        }
+        self.assignments.save_cluster_set(account, self.version, data, assignments)
+    
+    def _merge_fixed_clusters(self, fixed: List[Dict[str, Any]], clusters: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Rule and graph clusters first; clusters with the same name are combined"""
+        merged = self._merge_by_name(fixed + clusters)
+        for cluster in merged:
+            cluster["email_indices"].sort()
+            cluster["count"] = len(cluster["email_indices"])
+        return merged
+    
+    def _to_cache_entry(self, clusters: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        return [{k: v for k, v in cluster.items() if k != "count"} for cluster in clusters]
+    
+    def _from_cache_entry(self, entry: List[Dict[str, Any]], email_count: int) -> List[Dict[str, Any]]:
+        clusters = []
+        for stored in entry:
+            cluster = dict(stored)
+            cluster["email_indices"] = [idx for idx in stored["email_indices"] if 0 <= idx < email_count]
+            cluster["count"] = len(cluster["email_indices"])
+            clusters.append(cluster)
+        return clusters
+    
+    async def _hybrid(self, emails: List[EmailRecord], weights: Optional[List[int]] = None) -> Tuple[List[Dict[str, Any]], bool]:
+        """Group locally, then have the LLM name and prioritize groups from one representative each"""
+        with metrics.span("cluster_local"):
+            groups = await asyncio.to_thread(self.local.cluster, emails, weights)
+        merged, complete = await self._label_groups(groups, emails, sum(weights) if weights else len(emails))
+        
+        for cluster in merged:
+            cluster["count"] = len(cluster["email_indices"])
+        return merged, complete
+    
+    async def _label_groups(self, groups: List[Dict[str, Any]], emails, total: int) -> Tuple[List[Dict[str, Any]], bool]:
+        """Merge local groups into named clusters; `emails` only needs each group's representative by index"""
+        partials = self._local_partials(groups)
+        
+        complete = False
+        if self.llm is None:
+            metrics.inc("cluster_fallbacks_total", reason="no_llm")
+            merged = partials
+        else:
+            try:
+                lines = self._group_lines(groups, emails)
+                clusters, _ = await self._invoke(self._build_groups_prompt(lines, total), "label_groups", "groups")
+                clusters, complete = await self._recover(clusters, lines, "groups")
+                # Groups still unclaimed keep their local names
+                merged = self._parse_reduce(clusters, partials, key="groups")
+            except Exception as e:
+                print(f"Error labelling clusters: {e}")
+                metrics.inc("cluster_fallbacks_total", reason="llm_error")
+                merged = partials
+        return merged, complete
+    
+    def _local_partials(self, groups: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        partials = []
+        for group in groups:
+            terms = group["terms"]
+            partials.append({
+                "name": ", ".join(terms[:3]).title() or "Similar Emails",
+                "description": f"Similar emails about {', '.join(terms)}" if terms else "Similar emails",
                 "action": "Review",
-                "emails": other,
-                "count": len(other),
-                "priority": "medium"
+                "priority": "medium",
+                "email_indices": list(group["indices"])
             })
+        return partials
+    
+    async def _map_reduce(self, emails: List[EmailRecord], chunk_size: int, weights: Optional[List[int]] = None) -> Tuple[List[Dict[str, Any]], bool]:
+        semaphore = asyncio.Semaphore(self.concurrency)
+        failures = []
+        
+        async def label_chunk(start: int, chunk: List[EmailRecord]) -> List[Dict[str, Any]]:
+            async with semaphore:
+                try:
+                    clusters, complete = await self._label_emails(chunk, weights[start:start + len(chunk)] if weights else None, "map")
+                    if not complete:
+                        failures.append(start)
+                except Exception as e:
+                    print(f"Error clustering chunk at {start}: {e}")
+                    metrics.inc("cluster_fallbacks_total", reason="chunk_error")
+                    failures.append(start)
+                    clusters = self._fallback_clustering(chunk)
+            
+            for cluster in clusters:
+                cluster["email_indices"] = [start + idx for idx in cluster["email_indices"]]
+            return clusters
+        
+        chunk_results = await asyncio.gather(*(
+            label_chunk(start, emails[start:start + chunk_size])
+            for start in range(0, len(emails), chunk_size)
+        ))
+        partials = [cluster for clusters in chunk_results for cluster in clusters]
+        
+        try:
+            clusters, complete = await self._invoke(self._build_reduce_prompt(partials, weights), "reduce", "partial_clusters")
+            merged = self._parse_reduce(clusters, partials)
+            if not complete:
+                failures.append("reduce")
+        except Exception as e:
+            print(f"Error merging clusters: {e}")
+            metrics.inc("cluster_fallbacks_total", reason="reduce_error")
+            failures.append("reduce")
+            merged = self._merge_by_name(partials)
+        
+        for cluster in merged:
+            indices = list(dict.fromkeys(cluster["email_indices"]))
+            cluster["email_indices"] = indices
+            cluster["count"] = len(indices)
+        return merged, not failures
+    
+    def _line_budget(self, count: int) -> int:
+        """Characters each of `count` item lines may take for the prompt to stay within the token budget"""
+        return (self.prompt_token_budget - PROMPT_OVERHEAD_TOKENS) * CHARS_PER_TOKEN // max(1, count)
+    
+    def _summary(self, head: str, email: EmailRecord, budget: int) -> str:
+        """Sender, subject and preview after `head`, trimming the preview and then the subject to fit `budget`"""
+        line = f"{head}From: {email.sender[:50]}, Subject: "
+        room = budget - len(line) - len(", Preview: ")
+        subject = email.subject[:max(20, min(100, room))]
+        preview = email.body[:max(0, min(150, room - len(subject)))]
+        return f"{line}{subject}, Preview: {preview}"
+    
+    def _email_lines(self, emails: List[EmailRecord], weights: Optional[List[int]] = None) -> List[str]:
+        budget = self._line_budget(len(emails))
+        lines = []
+        for i, email in enumerate(emails):
+            head = f"{i}. "
+            if weights and weights[i] > 1:
+                head += f"({weights[i]} emails from this sender, newest shown) "
+            lines.append(self._summary(head, email, budget))
+        return lines
+    
+    def _group_lines(self, groups: List[Dict[str, Any]], emails) -> List[str]:
+        budget = self._line_budget(len(groups))
+        return [
+            self._summary(f"{i}. ({group['size']} emails; terms: {', '.join(group['terms'])}) ", emails[group["representative"]], budget)
+            for i, group in enumerate(groups)
+        ]
+    
+    def _build_prompt(self, lines: List[str], total: int) -> str:
+        described = f"{len(lines)} emails"
+        if total > len(lines):
+            described = f"{total} emails (listed as {len(lines)} entries; repeated bulk senders share one entry)"
+        
+        prompt = f"""Analyze these {described} and group them into 3-5 actionable clusters. 
+        For each cluster, provide:
+        1. A clear, actionable name (e.g., "Newsletters to Unsubscribe", "Meeting Requests to Schedule", "Bills to Pay")
+        2. A brief description of what action to take
+        3. The email indices that belong to this cluster (0-indexed)
         
-        return clusters
\ No newline at end of file
+        Report the clusters with the {CLUSTER_TOOL} tool, listing them under email_indices.
+        
+        Email summaries:
+        {chr(10).join(lines)}
+        
+        Focus on actionability and usefulness. Group by what action the user should take."""
+        return prompt
+    
+    def _build_groups_prompt(self, lines: List[str], total: int) -> str:
+        prompt = f"""I pre-grouped {total} emails into {len(lines)} groups of similar messages.
+        Below is one representative email from each group, with the group size and its most distinctive terms.
+        Combine the groups into 3-5 actionable clusters. Every group must belong to exactly one cluster.
+        For each cluster, provide:
+        1. A clear, actionable name (e.g., "Newsletters to Unsubscribe", "Meeting Requests to Schedule", "Bills to Pay")
+        2. A brief description of what action to take
+        3. The group numbers that belong to this cluster
+        
+        Report the clusters with the {CLUSTER_TOOL} tool, listing group numbers under groups.
+        
+        Groups:
+        {chr(10).join(lines)}
+        
+        Focus on actionability and usefulness. Group by what action the user should take."""
+        return prompt
+    
+    def _build_recovery_prompt(self, clusters: List[Dict[str, Any]], lines: List[str], missing: List[int]) -> str:
+        existing = [f"- {cluster.get('name', 'Unnamed')}: {str(cluster.get('description', ''))[:120]}" for cluster in clusters]
+        prompt = f"""These {len(missing)} items were left out when the items of one inbox were grouped into the clusters below.
+        Assign every item to one of these clusters, reusing its exact name, or to a new actionable cluster if none fits.
+        Keep each item's number as shown.
+        
+        Report the clusters with the {CLUSTER_TOOL} tool.
+        
+        Clusters:
+        {chr(10).join(existing) or "(none yet)"}
+        
+        Items:
+        {chr(10).join(lines[i] for i in missing)}"""
+        return prompt
+    
+    def _build_reduce_prompt(self, partials: List[Dict[str, Any]], weights: Optional[List[int]] = None) -> str:
+        size = lambda indices: sum(weights[idx] for idx in indices) if weights else len(indices)
+        partial_summaries = [
+            f"{i}. {c.get('name', 'Unnamed')} - {c.get('description', '')[:120]} "
+            f"(action: {c.get('action', 'Review')}, priority: {c.get('priority', 'medium')}, {size(c['email_indices'])} emails)"
+            for i, c in enumerate(partials)
+        ]
+        
+        prompt = f"""These {len(partials)} partial email clusters were produced from separate batches of the same inbox.
+        Merge them into 3-5 final actionable clusters. Every partial cluster must belong to exactly one final cluster.
+        
+        Report the final clusters with the {CLUSTER_TOOL} tool, listing partial cluster numbers under partial_clusters.
+        
+        Partial clusters:
+        {chr(10).join(partial_summaries)}"""
+        return prompt
+    
+    def _parse_reduce(self, clusters: List[Dict[str, Any]], partials: List[Dict[str, Any]], key: str = "partial_clusters") -> List[Dict[str, Any]]:
+        merged = []
+        assigned = set()
+        for cluster in clusters:
+            indices = []
+            for idx in cluster.pop(key, None) or []:
+                if isinstance(idx, int) and 0 <= idx < len(partials) and idx not in assigned:
+                    assigned.add(idx)
+                    indices.extend(partials[idx]["email_indices"])
+            cluster["email_indices"] = indices
+            if indices:
+                merged.append(cluster)
+        
+        leftovers = [p for i, p in enumerate(partials) if i not in assigned]
+        if not leftovers:
+            return merged
+        
+        by_name = {c.get("name", "").strip().lower(): c for c in merged}
+        for cluster in self._merge_by_name(leftovers):
+            target = by_name.get(cluster["name"].strip().lower())
+            if target:
+                target["email_indices"].extend(cluster["email_indices"])
+            else:
+                merged.append(cluster)
+        return merged
+    
+    def _merge_by_name(self, partials: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        merged = {}
+        for partial in partials:
+            key = partial.get("name", "Unnamed Cluster").strip().lower()
+            if key not in merged:
+                merged[key] = {
+                    "name": partial.get("name", "Unnamed Cluster"),
+                    "description": partial.get("description", ""),
+                    "action": partial.get("action", "Review"),
+                    "priority": partial.get("priority", "medium"),
+                    "email_indices": []
+                }
+            merged[key]["email_indices"].extend(partial["email_indices"])
+        return list(merged.values())
+    
+    def _parse_clusters(self, clusters: List[Dict[str, Any]], emails: List[EmailRecord]) -> List[Dict[str, Any]]:
+        """Keep each in-range email in the first cluster that claims it"""
+        parsed = []
+        assigned = set()
+        for cluster in clusters:
+            indices = []
+            for idx in cluster.get("email_indices") or []:
+                if isinstance(idx, int) and 0 <= idx < len(emails) and idx not in assigned:
+                    assigned.add(idx)
+                    indices.append(idx)
+            cluster["email_indices"] = indices
+            cluster["count"] = len(indices)
+            if indices:
+                parsed.append(cluster)
+        return parsed
+    
+    def _fallback_clustering(self, emails: List[EmailRecord]) -> List[Dict[str, Any]]:
+        matched, other = self.rules.partition(emails, fallback=True)
+        clusters = self.rules.clusters(matched)
+        if other:
+            clusters.append({**OTHER_CLUSTER, "email_indices": other, "count": len(other)})
+        return clusters
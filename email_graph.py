@@ -0,0 +1,254 @@
+import os
+import time
+import threading
+from abc import ABC, abstractmethod
+from email.utils import parseaddr
+from typing import List, Dict, Any, Optional, Tuple
+
+from email_record import EmailRecord
+
+# Rows per UNWIND write; keeps each transaction's parameter payload bounded
+GRAPH_BATCH_SIZE = 1000
+
+ClusterInfo = Dict[str, Any]
+
+def sender_address(sender: str) -> str:
+    return parseaddr(sender)[1].lower()
+
+class EmailGraph(ABC):
+    """Accounts, senders, domains, reply threads and the clusters their mail was assigned to.
+    Lets later analyses place a message by its thread or its sender's past cluster instead of asking the LLM.
+    Subclasses store the graph; lookup() and record() are their whole interface."""
+
+    def __init__(self, min_share: Optional[float] = None, min_count: Optional[int] = None):
+        # A sender's past cluster is reused only when most of its mail landed there, and more than once
+        self.min_share = min_share or float(os.getenv("GRAPH_MIN_SHARE", "0.8"))
+        self.min_count = min_count or int(os.getenv("GRAPH_MIN_COUNT", "2"))
+
+    @abstractmethod
+    def lookup(self, account: str, senders: List[str], threads: List[str]) -> Tuple[Dict[str, ClusterInfo], Dict[str, ClusterInfo]]:
+        """Each known sender's most frequent cluster (with "count" and the sender's "total"), and each known thread's cluster"""
+
+    @abstractmethod
+    def record(self, account: str, emails: List[EmailRecord], clusters: List[Dict[str, Any]]):
+        """Replace the account's sender and thread edges for these emails with the given clusters"""
+
+    def classify(self, account: str, emails: List[EmailRecord]) -> Tuple[List[Dict[str, Any]], List[int]]:
+        """Clusters for emails whose thread or sender already has one, and positions of the rest.
+        A reply follows its thread before its sender."""
+        senders = [sender_address(email.sender) for email in emails]
+        known_senders, known_threads = self.lookup(
+            account, sorted(set(senders) - {""}), sorted({email.thread for email in emails if email.thread})
+        )
+
+        clusters: Dict[str, Dict[str, Any]] = {}
+        rest = []
+        for i, (email, address) in enumerate(zip(emails, senders)):
+            info = known_threads.get(email.thread)
+            if info is None:
+                prior = known_senders.get(address)
+                if prior and prior["count"] >= self.min_count and prior["count"] >= self.min_share * prior["total"]:
+                    info = prior
+            if info is None:
+                rest.append(i)
+                continue
+            cluster = clusters.get(info["name"])
+            if cluster is None:
+                cluster = clusters[info["name"]] = {
+                    "name": info["name"],
+                    "description": info.get("description") or "",
+                    "action": info.get("action") or "Review",
+                    "priority": info.get("priority") or "medium",
+                    "email_indices": [],
+                }
+            cluster["email_indices"].append(i)
+        for cluster in clusters.values():
+            cluster["count"] = len(cluster["email_indices"])
+        return list(clusters.values()), rest
+
+    def _edges(self, emails: List[EmailRecord], clusters: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+        """Per-sender cluster counts and each reply thread's majority cluster, as UNWIND rows"""
+        sender_counts: Dict[Tuple[str, str], int] = {}
+        thread_counts: Dict[str, Dict[str, int]] = {}
+        for cluster in clusters:
+            name = cluster["name"]
+            for i in cluster["email_indices"]:
+                email = emails[i]
+                address = sender_address(email.sender)
+                if "@" in address:
+                    sender_counts[(address, name)] = sender_counts.get((address, name), 0) + 1
+                # Only replies are recorded; a thread's first message finds it by its own Message-ID
+                if email.thread and email.thread != email.message_id:
+                    counts = thread_counts.setdefault(email.thread, {})
+                    counts[name] = counts.get(name, 0) + 1
+
+        senders = [
+            {"address": address, "domain": address.partition("@")[2], "cluster": name, "count": count}
+            for (address, name), count in sender_counts.items()
+        ]
+        threads = [{"root": root, "cluster": max(counts, key=counts.get)} for root, counts in thread_counts.items()]
+        return senders, threads
+
+class MemoryEmailGraph(EmailGraph):
+    """In-process stand-in for Neo4jEmailGraph with the same behaviour, for tests and single-process runs"""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._clusters: Dict[Tuple[str, str], ClusterInfo] = {}
+        self._senders: Dict[Tuple[str, str], Dict[str, int]] = {}
+        self._threads: Dict[Tuple[str, str], str] = {}
+        self._lock = threading.Lock()
+
+    def lookup(self, account: str, senders: List[str], threads: List[str]) -> Tuple[Dict[str, ClusterInfo], Dict[str, ClusterInfo]]:
+        known_senders, known_threads = {}, {}
+        with self._lock:
+            for address in senders:
+                counts = self._senders.get((account, address))
+                if counts:
+                    name = max(counts, key=counts.get)
+                    info = self._clusters.get((account, name))
+                    # Like the Cypher MATCH, an edge to a cluster that was never written places nothing
+                    if info is not None:
+                        known_senders[address] = dict(info, count=counts[name], total=sum(counts.values()))
+            for root in threads:
+                info = self._clusters.get((account, self._threads.get((account, root))))
+                if info is not None:
+                    known_threads[root] = dict(info)
+        return known_senders, known_threads
+
+    def record(self, account: str, emails: List[EmailRecord], clusters: List[Dict[str, Any]]):
+        senders, threads = self._edges(emails, clusters)
+        with self._lock:
+            for cluster in clusters:
+                self._clusters[(account, cluster["name"])] = {k: cluster.get(k) for k in ("name", "description", "action", "priority")}
+            for row in senders:
+                self._senders.pop((account, row["address"]), None)
+            for row in senders:
+                self._senders.setdefault((account, row["address"]), {})[row["cluster"]] = row["count"]
+            for row in threads:
+                self._threads[(account, row["root"])] = row["cluster"]
+
+_SCHEMA = [
+    "CREATE CONSTRAINT account_address IF NOT EXISTS FOR (a:Account) REQUIRE a.address IS UNIQUE",
+    "CREATE CONSTRAINT sender_address IF NOT EXISTS FOR (s:Sender) REQUIRE s.address IS UNIQUE",
+    "CREATE CONSTRAINT domain_name IF NOT EXISTS FOR (d:Domain) REQUIRE d.name IS UNIQUE",
+    "CREATE INDEX cluster_key IF NOT EXISTS FOR (c:Cluster) ON (c.account, c.name)",
+    "CREATE INDEX thread_key IF NOT EXISTS FOR (t:Thread) ON (t.account, t.root)",
+]
+
+# One round trip for both kinds of prior: senders' cluster edges and threads' clusters
+_LOOKUP = """
+UNWIND $senders AS address
+MATCH (:Sender {address: address})-[r:CLUSTERED_AS {account: $account}]->(c:Cluster)
+WITH address, c, r ORDER BY r.count DESC
+WITH address, collect(c)[0] AS c, collect(r.count) AS counts
+RETURN 'sender' AS kind, address AS key, c.name AS name, c.description AS description, c.action AS action,
+       c.priority AS priority, counts[0] AS count, reduce(total = 0, n IN counts | total + n) AS total
+UNION ALL
+UNWIND $threads AS root
+MATCH (:Thread {account: $account, root: root})-[:IN_CLUSTER]->(c:Cluster)
+RETURN 'thread' AS kind, root AS key, c.name AS name, c.description AS description, c.action AS action,
+       c.priority AS priority, 0 AS count, 0 AS total
+"""
+
+_WRITE_CLUSTERS = """
+MERGE (a:Account {address: $account})
+WITH a
+UNWIND $clusters AS row
+MERGE (c:Cluster {account: $account, name: row.name})
+SET c.description = row.description, c.action = row.action, c.priority = row.priority, c.updated_at = $now
+MERGE (a)-[:HAS_CLUSTER]->(c)
+"""
+
+_CLEAR_SENDERS = """
+UNWIND $addresses AS address
+MATCH (:Sender {address: address})-[r:CLUSTERED_AS {account: $account}]->()
+DELETE r
+"""
+
+_WRITE_SENDERS = """
+MATCH (a:Account {address: $account})
+UNWIND $rows AS row
+MERGE (s:Sender {address: row.address})
+MERGE (d:Domain {name: row.domain})
+MERGE (s)-[:AT]->(d)
+MERGE (a)-[:RECEIVED_FROM]->(s)
+WITH s, row
+MATCH (c:Cluster {account: $account, name: row.cluster})
+CREATE (s)-[:CLUSTERED_AS {account: $account, count: row.count, updated_at: $now}]->(c)
+"""
+
+_WRITE_THREADS = """
+UNWIND $rows AS row
+MERGE (t:Thread {account: $account, root: row.root})
+WITH t, row
+OPTIONAL MATCH (t)-[old:IN_CLUSTER]->()
+DELETE old
+WITH DISTINCT t, row
+MATCH (c:Cluster {account: $account, name: row.cluster})
+MERGE (t)-[:IN_CLUSTER]->(c)
+"""
+
+class Neo4jEmailGraph(EmailGraph):
+    """The graph in Neo4j, through the shared driver from neo4j_config; writes are batched UNWIND statements"""
+
+    def __init__(self, driver=None, database: Optional[str] = None, **kwargs):
+        super().__init__(**kwargs)
+        if driver is None:
+            from neo4j_config import init_neo4j
+            driver = init_neo4j()
+        self.driver = driver
+        self.database = database or os.getenv("NEO4J_DATABASE") or None
+        with self.driver.session(database=self.database) as session:
+            for statement in _SCHEMA:
+                session.run(statement).consume()
+
+    def lookup(self, account: str, senders: List[str], threads: List[str]) -> Tuple[Dict[str, ClusterInfo], Dict[str, ClusterInfo]]:
+        known = {"sender": {}, "thread": {}}
+        if not senders and not threads:
+            return known["sender"], known["thread"]
+        records, _, _ = self.driver.execute_query(
+            _LOOKUP, account=account, senders=senders, threads=threads, database_=self.database, routing_="r"
+        )
+        for record in records:
+            info = {k: record[k] for k in ("name", "description", "action", "priority", "count", "total")}
+            known[record["kind"]][record["key"]] = info
+        return known["sender"], known["thread"]
+
+    def record(self, account: str, emails: List[EmailRecord], clusters: List[Dict[str, Any]]):
+        senders, threads = self._edges(emails, clusters)
+        meta = [{k: cluster.get(k) for k in ("name", "description", "action", "priority")} for cluster in clusters]
+        now = time.time()
+
+        def write(tx):
+            tx.run(_WRITE_CLUSTERS, account=account, clusters=meta, now=now).consume()
+            addresses = sorted({row["address"] for row in senders})
+            for start in range(0, len(addresses), GRAPH_BATCH_SIZE):
+                tx.run(_CLEAR_SENDERS, account=account, addresses=addresses[start:start + GRAPH_BATCH_SIZE]).consume()
+            for start in range(0, len(senders), GRAPH_BATCH_SIZE):
+                tx.run(_WRITE_SENDERS, account=account, rows=senders[start:start + GRAPH_BATCH_SIZE], now=now).consume()
+            for start in range(0, len(threads), GRAPH_BATCH_SIZE):
+                tx.run(_WRITE_THREADS, account=account, rows=threads[start:start + GRAPH_BATCH_SIZE]).consume()
+
+        with self.driver.session(database=self.database) as session:
+            session.execute_write(write)
+
+# Global graph instance; None when disabled or unreachable, which is only decided once
+email_graph: Optional[EmailGraph] = None
+_email_graph_initialized = False
+
+def init_email_graph():
+    """Initialize global email graph (EMAIL_GRAPH_BACKEND=neo4j|memory|none; neo4j by default when NEO4J_URI is set).
+    Returns None when disabled or when Neo4j cannot be reached."""
+    global email_graph, _email_graph_initialized
+    if not _email_graph_initialized:
+        _email_graph_initialized = True
+        backend = os.getenv("EMAIL_GRAPH_BACKEND", "neo4j" if os.getenv("NEO4J_URI") else "none")
+        if backend == "memory":
+            email_graph = MemoryEmailGraph()
+        elif backend == "neo4j":
+            try:
+                email_graph = Neo4jEmailGraph()
+            except Exception as e:
+                print(f"Error connecting email graph, continuing without it: {e}")
+    return email_graph
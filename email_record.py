@@ -0,0 +1,106 @@
+import sys
+import struct
+from array import array
+from collections.abc import Sequence
+from dataclasses import dataclass
+from typing import Union, Tuple, Iterable
+
+# Byte lengths of the text block (NUL-separated fields) and the body, ahead of their UTF-8 bytes
+_LENGTHS = struct.Struct("<II")
+_FIELD_SEP = "\x00"
+_COUNT = struct.Struct("<I")
+
+# Characters of body kept in stored results, enough for a preview line
+PREVIEW_CHARS = 150
+
+@dataclass(slots=True, eq=False)
+class EmailRecord:
+    """One message's headers and text preview; the body stays UTF-8 bytes until it is first read"""
+    id: str = ""
+    uid: str = ""
+    flags: str = ""
+    message_id: str = ""
+    subject: str = ""
+    sender: str = ""
+    date: str = ""
+    # Bulk-sender aggregation key from sender_index.bulk_source; "" for person-to-person mail
+    source: str = ""
+    # Raw Precedence and List-Unsubscribe headers, for rules; not kept in stored results
+    precedence: str = ""
+    list_unsubscribe: str = ""
+    # Message-ID of the thread's first message (from References/In-Reply-To), or the message's own
+    thread: str = ""
+    _body: Union[bytes, str] = b""
+
+    def __post_init__(self):
+        # A window holds thousands of messages from a few dozen senders and flag combinations
+        self.sender = sys.intern(self.sender)
+        self.flags = sys.intern(self.flags)
+        self.source = sys.intern(self.source)
+        self.precedence = sys.intern(self.precedence)
+
+    @property
+    def body(self) -> str:
+        if isinstance(self._body, bytes):
+            self._body = self._body.decode("utf-8", "replace")
+        return self._body
+
+    def slim(self) -> "EmailRecord":
+        """A copy with just what rendering and archiving need: no flags or Message-ID, a short preview"""
+        return EmailRecord(self.id, self.uid, "", "", self.subject, self.sender, self.date, "", "", "", "", self.body[:PREVIEW_CHARS])
+
+    def size(self) -> int:
+        """Approximate packed size in bytes, without packing"""
+        fields = (self.id, self.uid, self.flags, self.message_id, self.subject, self.sender, self.date, self.source, self.precedence, self.list_unsubscribe, self.thread, self._body)
+        return _LENGTHS.size + sum(len(f) for f in fields)
+
+    def pack(self) -> bytes:
+        fields = (self.id, self.uid, self.flags, self.message_id, self.subject, self.sender, self.date, self.source, self.precedence, self.list_unsubscribe, self.thread)
+        text = _FIELD_SEP.join(fields)
+        if text.count(_FIELD_SEP) != len(fields) - 1:
+            text = _FIELD_SEP.join(f.replace(_FIELD_SEP, "") for f in fields)
+        text = text.encode("utf-8")
+        body = self._body if isinstance(self._body, bytes) else self._body.encode("utf-8")
+        return b"".join((_LENGTHS.pack(len(text), len(body)), text, body))
+
+    @classmethod
+    def unpack_from(cls, data: bytes, offset: int = 0) -> Tuple["EmailRecord", int]:
+        """Decode one record at `offset`; returns it with the offset just past it"""
+        text_length, body_length = _LENGTHS.unpack_from(data, offset)
+        pos = offset + _LENGTHS.size + text_length
+        fields = data[offset + _LENGTHS.size:pos].decode("utf-8").split(_FIELD_SEP)
+        return cls(*fields, data[pos:pos + body_length]), pos + body_length
+
+    @classmethod
+    def unpack(cls, data: bytes) -> "EmailRecord":
+        return cls.unpack_from(data)[0]
+
+class PackedRecords(Sequence):
+    """Read-only list view over pack_records output that unpacks each record only when it is indexed"""
+
+    def __init__(self, data: bytes):
+        (count,) = _COUNT.unpack_from(data)
+        self._offsets = array("I")
+        self._offsets.frombytes(data[_COUNT.size:_COUNT.size + count * self._offsets.itemsize])
+        self._data = data
+
+    def __len__(self) -> int:
+        return len(self._offsets)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        return EmailRecord.unpack_from(self._data, self._offsets[index])[0]
+
+def pack_records(records: Iterable[EmailRecord]) -> bytes:
+    """Count, an offset table, then each packed record, so a single record can be read without the rest"""
+    packed = [record.pack() for record in records]
+    offsets = array("I")
+    position = _COUNT.size + len(packed) * offsets.itemsize
+    for record in packed:
+        offsets.append(position)
+        position += len(record)
+    return _COUNT.pack(len(packed)) + offsets.tobytes() + b"".join(packed)
+
+def unpack_records(data: bytes) -> PackedRecords:
+    return PackedRecords(data)
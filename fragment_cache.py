@@ -0,0 +1,41 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from fasthtml.common import NotStr, to_xml
+
+import metrics
+
+class FragmentCache:
+    """LRU of rendered HTML fragments; keys start with the result id, so a new result never sees stale markup"""
+
+    def __init__(self, max_entries: Optional[int] = None):
+        self.max_entries = max_entries or int(os.getenv("FRAGMENT_CACHE_MAX_ENTRIES", "5000"))
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[Tuple, NotStr]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def render(self, key: Tuple, build: Callable[[], Any]) -> NotStr:
+        """Return the cached markup for key, building and rendering the component only on a miss"""
+        with self._lock:
+            fragment = self._entries.get(key)
+            if fragment is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                metrics.inc("cache_lookups_total", cache="fragments", result="hit")
+                return fragment
+            self.misses += 1
+        metrics.inc("cache_lookups_total", cache="fragments", result="miss")
+
+        fragment = NotStr(to_xml(build()))
+        with self._lock:
+            self._entries[key] = fragment
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return fragment
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
@@ -1,74 +1,536 @@
 import imaplib
 import email
 from email.header import decode_header
-from typing import List, Dict, Any
+from email.parser import BytesHeaderParser
+from typing import List, Dict, Any, Tuple, Optional, Iterable, Iterator, Callable
 import os
 from datetime import datetime
 import re
+import time
+import queue
+import random
+import select
+import ssl
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from message_cache import MessageCache
+from email_record import EmailRecord
+from sender_index import bulk_source
+from mime_text import extract_text
+
+IMAP_HOST = os.getenv("IMAP_HOST", "imap.gmail.com")
+IMAP_PORT = int(os.getenv("IMAP_PORT", "993"))
+# Plain-text IMAP is only meant for local stand-ins such as the benchmark server
+IMAP_SSL = os.getenv("IMAP_SSL", "true").lower() not in ("0", "false", "no")
+# Socket timeout for every IMAP read and write, so a stalled server cannot hang a worker forever; 0 disables it
+IMAP_TIMEOUT = float(os.getenv("IMAP_TIMEOUT", "30")) or None
+
+# Headers fetched for every message; CONTENT-* lets the preview partial be decoded, LIST-*/PRECEDENCE identify bulk mail
+HEADER_FIELDS = "FROM SUBJECT DATE MESSAGE-ID CONTENT-TYPE CONTENT-TRANSFER-ENCODING LIST-ID LIST-UNSUBSCRIBE PRECEDENCE IN-REPLY-TO REFERENCES"
+PREVIEW_BYTES = 2048
+# Messages per pipelined FETCH; smaller batches give finer progress reports
+FETCH_BATCH_SIZE = 50
+# Messages per page handed to streaming consumers; bounds what a large analysis window holds at once
+ANALYSIS_PAGE_SIZE = int(os.getenv("ANALYSIS_PAGE_SIZE", "500"))
+# Connections one large fetch spreads its batches over, its own included; the others are lent by the connection pool
+FETCH_CONNECTIONS = max(1, int(os.getenv("IMAP_FETCH_CONNECTIONS", "4")))
+# Windows smaller than this use one connection; opening more would cost more than it saves
+PARALLEL_FETCH_MIN = int(os.getenv("IMAP_PARALLEL_FETCH_MIN", "1000"))
+# Pause after a throttled batch, doubling while the server keeps throttling, and retries of a refused batch
+THROTTLE_BACKOFF = float(os.getenv("IMAP_THROTTLE_BACKOFF", "1.0"))
+THROTTLE_RETRIES = 3
+# Moving a message out of INBOX into All Mail is how Gmail archives over IMAP
+ARCHIVE_MAILBOX = '"[Gmail]/All Mail"'
+ARCHIVE_CHUNK_SIZE = 500
+
+_header_parser = BytesHeaderParser()
+
+_FETCH_START_RE = re.compile(rb"^\s*(\d+) \(")
+_FETCH_ATTR_RE = re.compile(rb"\b(UID|FLAGS|MODSEQ|RFC822\.SIZE) (\([^)]*\)|\d+)", re.IGNORECASE)
+_IDLE_CHANGE_RE = re.compile(rb"^\* \d+ (EXISTS|EXPUNGE|FETCH)\b", re.IGNORECASE)
+_FETCH_LITERAL_RE = re.compile(rb"(BODY\[[^\]]*\](?:<\d+>)?|RFC822(?:\.HEADER|\.TEXT)?) \{\d+\}$", re.IGNORECASE)
+# How Gmail refuses work when an account is doing too much at once
+_THROTTLED_RE = re.compile(rb"THROTTLED|UNAVAILABLE|Too many simultaneous", re.IGNORECASE)
+
+def compress_uids(uids: Iterable[int]) -> str:
+    """Compress UIDs into an IMAP message-set such as 1:5,9,12:40"""
+    ranges = []
+    for uid in sorted(set(int(u) for u in uids)):
+        if ranges and uid == ranges[-1][1] + 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    return ",".join(str(lo) if lo == hi else f"{lo}:{hi}" for lo, hi in ranges)
 
 class GmailClient:
-    def __init__(self, email_address: str, app_password: str):
+    def __init__(self, email_address: str, app_password: str, cache: Optional[MessageCache] = None):
         self.email_address = email_address
         self.app_password = app_password
+        self.cache = cache
         self.imap = None
+        self.condstore = False
+        # Set when CONDSTORE is advertised without ENABLE; each SELECT then turns it on for its mailbox
+        self._select_condstore = False
+        self.mailbox = None
+        self._idle_tag = None
+        # Set by ImapConnectionPool, which lends the account's spare connections for parallel fetches
+        self.lender = None
+        self._helpers: List["GmailClient"] = []
+        self._helper_budget = 0
     
     def connect(self):
         try:
-            self.imap = imaplib.IMAP4_SSL("imap.gmail.com")
-            self.imap.login(self.email_address, self.app_password)
+            with metrics.span("imap_login"):
+                if IMAP_SSL:
+                    self.imap = imaplib.IMAP4_SSL(IMAP_HOST, IMAP_PORT, timeout=IMAP_TIMEOUT)
+                else:
+                    self.imap = imaplib.IMAP4(IMAP_HOST, IMAP_PORT, timeout=IMAP_TIMEOUT)
+                self.imap.login(self.email_address, self.app_password)
+            self._refresh_capabilities()
+            self.condstore = "CONDSTORE" in self.imap.capabilities
+            self._select_condstore = self.condstore and "ENABLE" not in self.imap.capabilities
+            if self.condstore and not self._select_condstore:
+                try:
+                    result, _ = self.imap.enable("CONDSTORE")
+                    self.condstore = result == "OK"
+                except imaplib.IMAP4.error as e:
+                    # Incremental sync is an optimization; a full resync still works without it
+                    print(f"Error enabling CONDSTORE: {e}")
+                    self.condstore = False
             return {"success": True}
         except Exception as e:
             return {"success": False, "error": str(e)}
     
-    def fetch_recent_emails(self, limit: int = 200) -> List[Dict[str, Any]]:
+    def _refresh_capabilities(self):
+        """Re-read CAPABILITY after login; servers may only advertise extensions once authenticated"""
+        result, data = self.imap.capability()
+        if result == "OK" and data and data[-1]:
+            self.imap.capabilities = tuple(data[-1].decode().upper().split())
+    
+    def noop(self) -> bool:
+        """Keep the connection alive; returns False if the socket is dead"""
         if not self.imap:
-            return []
+            return False
+        try:
+            result, _ = self.imap.noop()
+            return result == "OK"
+        except (imaplib.IMAP4.error, OSError):
+            return False
+    
+    def reconnect(self) -> Dict[str, Any]:
+        """Open a fresh connection and re-select the previously selected mailbox"""
+        mailbox = self.mailbox
+        self.disconnect()
+        result = self.connect()
+        if result["success"] and mailbox:
+            if not self.select_mailbox(mailbox):
+                return {"success": False, "error": f"Could not select {mailbox}"}
+        return result
+    
+    def select_mailbox(self, mailbox: str = "INBOX") -> Optional[Dict[str, Any]]:
+        """SELECT a mailbox and return its EXISTS/UIDVALIDITY/UIDNEXT/HIGHESTMODSEQ state"""
+        with metrics.span("imap_select"):
+            if self._select_condstore:
+                # imaplib quotes a str argument as a whole, so the name and parameter list go as pre-built bytes
+                quoted = '"' + mailbox.replace("\\", "\\\\").replace('"', '\\"') + '"'
+                result, data = self.imap.select(f"{quoted} (CONDSTORE)".encode())
+            else:
+                result, data = self.imap.select(mailbox)
+        if result != "OK":
+            return None
+        self.mailbox = mailbox
         
+        state = {"exists": int(data[0]), "uidvalidity": None, "uidnext": None, "highestmodseq": None}
+        for code in ("UIDVALIDITY", "UIDNEXT", "HIGHESTMODSEQ"):
+            _, values = self.imap.response(code)
+            if values and values[-1]:
+                state[code.lower()] = int(values[-1])
+        return state
+    
+    def fetch_recent_emails(self, limit: int = 200, progress: Optional[Callable[[int, int], None]] = None) -> List[EmailRecord]:
         emails = []
         try:
-            self.imap.select("INBOX")
+            for page in self.iter_recent_emails(limit, progress):
+                emails.extend(page)
+            return emails
+        except (imaplib.IMAP4.abort, OSError):
+            raise
+        except Exception as e:
+            print(f"Error fetching emails: {e}")
+            return []
+    
+    def iter_recent_emails(self, limit: int = 200, progress: Optional[Callable[[int, int], None]] = None, page_size: int = ANALYSIS_PAGE_SIZE) -> Iterator[List[EmailRecord]]:
+        """Yield the newest `limit` INBOX messages newest-first, one page at a time, so callers never hold the whole window"""
+        if not self.imap:
+            return
+        
+        state = self.select_mailbox("INBOX")
+        if not state or state["exists"] == 0:
+            return
+        
+        # Large windows may borrow more connections as they go; they are all returned once the window is read
+        if self.lender is not None and min(limit, state["exists"]) >= PARALLEL_FETCH_MIN:
+            self._helper_budget = FETCH_CONNECTIONS - 1
+            # Whole rounds of batches per page, so no connection sits idle while the page's last batch lands
+            round_size = FETCH_CONNECTIONS * FETCH_BATCH_SIZE
+            page_size = -(-page_size // round_size) * round_size
+        try:
+            if self.cache is not None and state["uidvalidity"] is not None:
+                yield from self._iter_synced_emails("INBOX", state, limit, page_size, progress)
+                return
+            
+            exists = state["exists"]
+            start = max(1, exists - limit + 1)
+            total = exists - start + 1
+            fetched = 0
             
-            result, data = self.imap.search(None, "ALL")
+            def landed(batch: List[EmailRecord]):
+                nonlocal fetched
+                fetched += len(batch)
+                if progress:
+                    progress(fetched, total)
+            
+            for page_end in range(exists, start - 1, -page_size):
+                page_start = max(start, page_end - page_size + 1)
+                message_sets = [
+                    f"{max(page_start, batch_end - FETCH_BATCH_SIZE + 1)}:{batch_end}"
+                    for batch_end in range(page_end, page_start - 1, -FETCH_BATCH_SIZE)
+                ]
+                yield self._fetch_sets(message_sets, on_batch=landed)
+        finally:
+            self._return_helpers()
+    
+    def _iter_synced_emails(self, mailbox: str, state: Dict[str, Any], limit: int, page_size: int, progress: Optional[Callable[[int, int], None]] = None) -> Iterator[List[EmailRecord]]:
+        """Page through the window against the message cache: map each page's UIDs, read hits, fetch misses.
+        Only UIDs and flags are kept across pages; the mailbox state is saved once the whole window was read."""
+        account = self.email_address
+        uidvalidity = state["uidvalidity"]
+        previous = self.cache.get_state(account, mailbox)
+        if previous and previous["uidvalidity"] != uidvalidity:
+            self.cache.invalidate(account, mailbox)
+            previous = None
+        
+        known_flags = self.cache.get_flags(account, mailbox, uidvalidity) if previous else {}
+        exists = state["exists"]
+        window_size = min(limit, exists)
+        
+        unchanged = (
+            previous is not None
+            and previous["uidnext"] == state["uidnext"]
+            and previous["exists"] == exists
+            and self.condstore
+            and previous["highestmodseq"] == state["highestmodseq"]
+            and len(known_flags) >= window_size
+        )
+        if unchanged:
+            metrics.inc("imap_sync_total", path="unchanged")
+            window = sorted(known_flags, reverse=True)[:window_size]
+            for offset in range(0, len(window), page_size):
+                uids = window[offset:offset + page_size]
+                cached = self.cache.get_messages(account, mailbox, uidvalidity, uids)
+                page = []
+                for rank, uid in enumerate(uids, offset):
+                    message = cached[uid]
+                    message.id = str(exists - rank)
+                    page.append(message)
+                if progress:
+                    progress(offset + len(page), window_size)
+                yield page
+            return
+        
+        metrics.inc("imap_sync_total", path="delta" if previous else "full")
+        start = exists - window_size + 1
+        
+        # With CONDSTORE one command reports every flag change in the window; otherwise flags ride along with the UID map
+        changed_flags = {}
+        if self.condstore and previous and previous["highestmodseq"] and previous["highestmodseq"] != state["highestmodseq"]:
+            result, data = self.imap.fetch(f"{start}:{exists}", f"(UID FLAGS) (CHANGEDSINCE {previous['highestmodseq']})")
+            if result == "OK":
+                for seq, attrs in self._parse_fetch_response(data):
+                    if "UID" in attrs and "FLAGS" in attrs and int(attrs["UID"]) in known_flags:
+                        changed_flags[int(attrs["UID"])] = attrs["FLAGS"]
+        query = "(UID)" if self.condstore else "(UID FLAGS)"
+        
+        seen = set()
+        done = 0
+        for page_end in range(exists, start - 1, -page_size):
+            page_start = max(start, page_end - page_size + 1)
+            with metrics.span("imap_uid_map"):
+                result, data = self.imap.fetch(f"{page_start}:{page_end}", query)
             if result != "OK":
-                return []
+                return
+            
+            window = {}
+            page_flags = {}
+            for seq, attrs in self._parse_fetch_response(data):
+                if "UID" not in attrs:
+                    continue
+                uid = int(attrs["UID"])
+                window[uid] = seq
+                if uid in changed_flags:
+                    page_flags[uid] = changed_flags[uid]
+                elif "FLAGS" in attrs and uid in known_flags and known_flags[uid] != attrs["FLAGS"]:
+                    page_flags[uid] = attrs["FLAGS"]
+            seen.update(window)
             
-            email_ids = data[0].split()
-            email_ids = email_ids[-limit:] if len(email_ids) > limit else email_ids
-            email_ids.reverse()
+            cached = self.cache.get_messages(account, mailbox, uidvalidity, [uid for uid in window if uid in known_flags])
+            missing = sorted((uid for uid in window if uid not in cached), reverse=True)
+            arrived = 0
             
-            for email_id in email_ids:
-                result, data = self.imap.fetch(email_id, "(RFC822)")
-                if result != "OK":
+            def landed(batch: List[EmailRecord]):
+                nonlocal arrived
+                self.cache.put_messages(account, mailbox, uidvalidity, batch)
+                for message in batch:
+                    cached[int(message.uid)] = message
+                arrived += len(batch)
+                if progress:
+                    progress(done + len(window) - len(missing) + arrived, window_size)
+            
+            self._fetch_sets(
+                [compress_uids(missing[i:i + FETCH_BATCH_SIZE]) for i in range(0, len(missing), FETCH_BATCH_SIZE)],
+                uid=True, on_batch=landed
+            )
+            
+            if page_flags:
+                self.cache.update_flags(account, mailbox, uidvalidity, page_flags)
+            page = []
+            for uid in sorted(window, reverse=True):
+                message = cached.get(uid)
+                if message is None:
                     continue
-                
-                raw_email = data[0][1]
-                msg = email.message_from_bytes(raw_email)
-                
-                subject = self._decode_header(msg["Subject"])
-                sender = self._decode_header(msg["From"])
-                date_str = msg["Date"]
-                
+                message.id = window[uid]
+                if uid in page_flags:
+                    message.flags = page_flags[uid]
+                page.append(message)
+            done += len(window)
+            if progress:
+                progress(done, window_size)
+            yield page
+        
+        stale = [uid for uid in known_flags if uid not in seen]
+        if stale:
+            self.cache.delete_messages(account, mailbox, uidvalidity, stale)
+        
+        self.cache.set_state(account, mailbox, state)
+    
+    def _fetch_sets(self, message_sets: List[str], uid: bool = False, on_batch: Optional[Callable[[List[EmailRecord]], None]] = None) -> List[EmailRecord]:
+        """Fetch message sets over this connection and any lent ones at once; returns them in the given order.
+        Connections take the next set from a shared queue, so a slow one holds up no other. A throttled set is
+        retried after a backoff; a lent connection that is throttled hands its set back and is returned to the
+        pool, so throttling first costs parallelism. on_batch runs on this thread as each set lands."""
+        if len(message_sets) > 1 and self._helper_budget:
+            self._borrow_helpers(len(message_sets) - 1 - len(self._helpers))
+        helpers = self._helpers[:len(message_sets) - 1]
+        
+        pending: "queue.Queue[Tuple[int, str, int]]" = queue.Queue()
+        for position, message_set in enumerate(message_sets):
+            pending.put((position, message_set, 0))
+        landed: "queue.Queue[Tuple[int, List[EmailRecord]]]" = queue.Queue()
+        results: List[Optional[List[EmailRecord]]] = [None] * len(message_sets)
+        
+        def step(client: "GmailClient", streak: List[int]) -> Optional[str]:
+            """Fetch one queued set; None when the queue is empty, else "ok", or why a lent connection should go"""
+            try:
+                position, message_set, attempts = pending.get_nowait()
+            except queue.Empty:
+                return None
+            try:
+                emails, throttled = client._fetch_batch(message_set, uid)
+            except Exception:
+                if client is self:
+                    raise
+                # A lent connection that fails gives its set back to the others
+                pending.put((position, message_set, attempts))
+                return "broken"
+            if not throttled:
+                streak[0] = 0
+                landed.put((position, emails or []))
+                return "ok"
+            
+            metrics.inc("imap_throttled_total")
+            if self.lender is not None:
+                self.lender.throttle(self.email_address)
+            if emails is None and attempts < THROTTLE_RETRIES:
+                pending.put((position, message_set, attempts + 1))
+            else:
+                if emails is None:
+                    print(f"Error fetching emails: still throttled after {THROTTLE_RETRIES} retries")
+                landed.put((position, emails or []))
+            if client is not self:
+                return "throttled"
+            time.sleep(THROTTLE_BACKOFF * 2 ** streak[0] * (0.5 + random.random()))
+            streak[0] += 1
+            return "ok"
+        
+        def work(client: "GmailClient") -> Optional[str]:
+            streak = [0]
+            while True:
+                outcome = step(client, streak)
+                if outcome != "ok":
+                    return outcome
+        
+        def deliver(block: bool):
+            try:
+                while True:
+                    position, emails = landed.get(timeout=0.05) if block else landed.get_nowait()
+                    block = False
+                    results[position] = emails
+                    if on_batch:
+                        on_batch(emails)
+            except queue.Empty:
+                pass
+        
+        if not helpers:
+            streak = [0]
+            while step(self, streak):
+                deliver(False)
+            deliver(False)
+            return [email for batch in results if batch for email in batch]
+        
+        futures = {}
+        try:
+            with ThreadPoolExecutor(max_workers=len(helpers), thread_name_prefix="imap-shard") as executor:
+                # Each lent connection carries the request context, so its fetch timings reach the request
+                futures = {executor.submit(contextvars.copy_context().run, work, client): client for client in helpers}
+                streak = [0]
                 try:
-                    date_parsed = email.utils.parsedate_to_datetime(date_str)
-                    date_formatted = date_parsed.strftime("%Y-%m-%d %H:%M")
-                except:
-                    date_formatted = date_str
-                
-                body = self._get_email_body(msg)
-                
-                emails.append({
-                    "id": email_id.decode(),
-                    "subject": subject,
-                    "from": sender,
-                    "date": date_formatted,
-                    "body": body[:500],
-                    "full_body": body
-                })
+                    while True:
+                        if step(self, streak):
+                            deliver(False)
+                        elif not all(future.done() for future in futures):
+                            deliver(True)
+                        elif pending.empty():
+                            break
+                        # Otherwise sets handed back by dropped connections are left, and this connection takes them
+                except BaseException:
+                    # Stop the lent connections after their current set
+                    while not pending.empty():
+                        pending.get_nowait()
+                    raise
+        finally:
+            for future, client in futures.items():
+                outcome = future.result() if future.exception() is None else "broken"
+                if outcome:
+                    self._drop_helper(client, broken=outcome == "broken")
+        deliver(False)
+        return [email for batch in results if batch for email in batch]
+    
+    def _borrow_helpers(self, wanted: int):
+        wanted = min(wanted, self._helper_budget)
+        if wanted <= 0:
+            return
+        # What the pool cannot spare now is not asked for again during this fetch
+        self._helper_budget -= wanted
+        self._helpers.extend(self.lender.lend(self.email_address, wanted, self.mailbox))
+    
+    def _drop_helper(self, client: "GmailClient", broken: bool = False):
+        self._helpers.remove(client)
+        self.lender.release(self.email_address, client, broken=broken)
+    
+    def _return_helpers(self):
+        for client in self._helpers:
+            self.lender.release(self.email_address, client)
+        self._helpers = []
+        self._helper_budget = 0
+    
+    def _fetch_batch(self, message_set: str, uid: bool = False) -> Tuple[Optional[List[EmailRecord]], bool]:
+        """One FETCH of headers and previews. Returns the emails (None if the server refused the command)
+        and whether the server asked this account to slow down."""
+        query = f"(UID FLAGS BODY.PEEK[HEADER.FIELDS ({HEADER_FIELDS})] BODY.PEEK[TEXT]<0.{PREVIEW_BYTES}>)"
+        with metrics.span("imap_fetch"):
+            if uid:
+                result, data = self.imap.uid("FETCH", message_set, query)
+            else:
+                result, data = self.imap.fetch(message_set, query)
+        throttled = self.imap.response("THROTTLED")[1] != [None]
+        if result != "OK":
+            throttled = throttled or any(isinstance(item, bytes) and _THROTTLED_RE.search(item) for item in data)
+            return None, throttled
+        metrics.inc("imap_bytes_fetched_total", sum(len(item[1]) for item in data if isinstance(item, tuple)))
+        
+        with metrics.span("mime_parse"):
+            emails = []
+            for seq, attrs in self._parse_fetch_response(data):
+                emails.append(self._build_email(seq, attrs))
+        metrics.inc("messages_parsed_total", len(emails))
+        
+        emails.sort(key=lambda e: int(e.id), reverse=True)
+        return emails, throttled
+    
+    def _parse_fetch_response(self, data) -> List[Tuple[str, Dict[str, Any]]]:
+        messages = []
+        attrs = None
+        for item in data:
+            if isinstance(item, tuple):
+                meta, literal = item
+            else:
+                meta, literal = item, None
+            if not meta:
+                continue
             
-            return emails
-        except Exception as e:
-            print(f"Error fetching emails: {e}")
-            return []
+            start = _FETCH_START_RE.match(meta)
+            if start:
+                attrs = {}
+                messages.append((start.group(1).decode(), attrs))
+                meta = meta[start.end():]
+            if attrs is None:
+                continue
+            
+            for match in _FETCH_ATTR_RE.finditer(meta):
+                name, value = match.group(1).decode().upper(), match.group(2).decode()
+                attrs[name] = value.strip("()")
+            
+            if literal is not None:
+                key = _FETCH_LITERAL_RE.search(meta)
+                if key:
+                    attrs[self._literal_key(key.group(1).decode())] = literal
+        return messages
+    
+    def _literal_key(self, section: str) -> str:
+        section = section.upper()
+        if section.startswith("BODY[HEADER"):
+            return "HEADER"
+        if section.startswith("BODY[TEXT]"):
+            return "TEXT"
+        if section in ("RFC822", "BODY[]"):
+            return "BODY[]"
+        return section
+    
+    def _build_email(self, seq: str, attrs: Dict[str, Any]) -> EmailRecord:
+        header_bytes = attrs.get("HEADER", b"").rstrip(b"\r\n") + b"\r\n\r\n"
+        msg = _header_parser.parsebytes(header_bytes)
+        
+        subject = self._decode_header(msg["Subject"])
+        sender = self._decode_header(msg["From"])
+        date_str = msg["Date"]
+        
+        try:
+            date_parsed = email.utils.parsedate_to_datetime(date_str)
+            date_formatted = date_parsed.strftime("%Y-%m-%d %H:%M")
+        except:
+            date_formatted = date_str
+        
+        body = self._get_email_body(header_bytes + attrs.get("TEXT", b""), PREVIEW_BYTES)
+        message_id = (msg["Message-ID"] or "").strip()
+        # References lists the thread oldest first; In-Reply-To alone only names the parent
+        references = (msg["References"] or "").split() or (msg["In-Reply-To"] or "").split()
+        
+        return EmailRecord(
+            id=seq,
+            uid=attrs.get("UID", ""),
+            flags=attrs.get("FLAGS", ""),
+            message_id=message_id,
+            subject=subject,
+            sender=sender,
+            date=date_formatted or "",
+            source=bulk_source(sender, msg["List-Id"], msg["List-Unsubscribe"], msg["Precedence"]),
+            precedence=" ".join((msg["Precedence"] or "").split()),
+            list_unsubscribe=" ".join((msg["List-Unsubscribe"] or "").split()),
+            thread=references[0] if references else message_id,
+            _body=body[:500]
+        )
     
     def _decode_header(self, header):
         if not header:
@@ -85,52 +547,108 @@ class GmailClient:
                 result.append(str(part))
         return " ".join(result)
     
-    def _get_email_body(self, msg):
-        body = ""
-        if msg.is_multipart():
-            for part in msg.walk():
-                content_type = part.get_content_type()
-                if content_type == "text/plain":
-                    try:
-                        payload = part.get_payload(decode=True)
-                        charset = part.get_content_charset() or 'utf-8'
-                        body = payload.decode(charset, errors='ignore')
-                        break
-                    except:
-                        continue
-        else:
-            try:
-                payload = msg.get_payload(decode=True)
-                charset = msg.get_content_charset() or 'utf-8'
-                body = payload.decode(charset, errors='ignore')
-            except:
-                body = str(msg.get_payload())
-        
-        body = re.sub(r'<[^>]+>', '', body)
+    def _get_email_body(self, raw_email: bytes, limit: Optional[int] = None) -> str:
+        body = extract_text(raw_email, limit)
         body = re.sub(r'\s+', ' ', body)
         return body.strip()
     
-    def archive_emails(self, email_ids: List[str]) -> Dict[str, Any]:
+    def archive_emails(self, uids: List[str]) -> Dict[str, Any]:
+        """Archive messages by UID, in compressed message-set chunks, via UID MOVE (or STORE + UID EXPUNGE).
+        Without MOVE or UIDPLUS the messages are only flagged \\Deleted: a plain EXPUNGE would also remove
+        anything else in the mailbox that happens to be flagged."""
         if not self.imap:
             return {"success": False, "error": "Not connected"}
         
         try:
-            self.imap.select("INBOX")
+            state = self.select_mailbox("INBOX")
+            if not state:
+                return {"success": False, "error": "Could not select INBOX"}
+            
+            uids = sorted({int(uid) for uid in uids if uid})
+            use_move = "MOVE" in self.imap.capabilities
+            use_uid_expunge = "UIDPLUS" in self.imap.capabilities
+            archived = []
+            flagged = 0
             
-            for email_id in email_ids:
-                self.imap.store(email_id, '+X-GM-LABELS', '\\All')
-                self.imap.store(email_id, '+FLAGS', '\\Deleted')
+            for i in range(0, len(uids), ARCHIVE_CHUNK_SIZE):
+                chunk = uids[i:i + ARCHIVE_CHUNK_SIZE]
+                message_set = compress_uids(chunk)
+                with metrics.span("imap_archive"):
+                    if use_move:
+                        result, data = self.imap.uid("MOVE", message_set, ARCHIVE_MAILBOX)
+                    else:
+                        result, data = self.imap.uid("STORE", message_set, "+FLAGS.SILENT", "(\\Deleted)")
+                        if result == "OK" and use_uid_expunge:
+                            result, data = self.imap.uid("EXPUNGE", message_set)
+                if result != "OK":
+                    return {"success": False, "error": f"Archive failed: {data}", "archived": len(archived), "flagged": flagged}
+                if use_move or use_uid_expunge:
+                    archived.extend(chunk)
+                    metrics.inc("messages_archived_total", len(chunk))
+                else:
+                    flagged += len(chunk)
             
-            self.imap.expunge()
+            if self.cache is not None and state["uidvalidity"] is not None and archived:
+                self.cache.delete_messages(self.email_address, "INBOX", state["uidvalidity"], archived)
             
-            return {"success": True, "archived": len(email_ids)}
+            return {"success": True, "archived": len(archived), "flagged": flagged}
+        except (imaplib.IMAP4.abort, OSError):
+            raise
         except Exception as e:
             return {"success": False, "error": str(e)}
     
+    def idle_start(self) -> bool:
+        """Put the selected mailbox into IDLE; returns False if the server does not support or refuses it"""
+        if "IDLE" not in self.imap.capabilities:
+            return False
+        # imaplib before 3.14 has no IDLE, so drive it with the raw tag/response helpers
+        tag = self.imap._new_tag()
+        self.imap.send(tag + b" IDLE\r\n")
+        while self.imap._get_response() is not None:
+            if self.imap.tagged_commands.get(tag) is not None:
+                del self.imap.tagged_commands[tag]
+                return False
+        self._idle_tag = tag
+        return True
+    
+    def idle_wait(self, timeout: float) -> bool:
+        """While in IDLE, wait up to timeout for the server to report new, expunged or changed messages"""
+        if not self._readable_now():
+            ready, _, _ = select.select([self.imap.sock], [], [], max(0.0, timeout))
+            if not ready:
+                return False
+        line = self.imap._get_line()
+        return bool(_IDLE_CHANGE_RE.match(line))
+    
+    def _readable_now(self) -> bool:
+        """Whether a response is already at hand: in imaplib's buffered reader, the TLS layer or the socket.
+        select() only sees the socket, so a second line that arrived with the first would otherwise wait."""
+        sock = self.imap.sock
+        timeout = sock.gettimeout()
+        sock.settimeout(0.0)
+        try:
+            # Non-blocking, peek returns what is buffered, or whatever one read can get without waiting
+            return bool(self.imap.file.peek(1))
+        except (BlockingIOError, ssl.SSLWantReadError):
+            return False
+        finally:
+            sock.settimeout(timeout)
+    
+    def idle_done(self):
+        """Leave IDLE and read the tagged completion"""
+        tag, self._idle_tag = self._idle_tag, None
+        self.imap.send(b"DONE\r\n")
+        self.imap._command_complete("IDLE", tag)
+    
     def disconnect(self):
         if self.imap:
             try:
-                self.imap.close()
+                if self.imap.state == "SELECTED":
+                    self.imap.close()
+            except:
+                pass
+            try:
                 self.imap.logout()
             except:
-                pass
\ No newline at end of file
+                pass
+            self.imap = None
\ No newline at end of file
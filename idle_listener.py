@@ -0,0 +1,182 @@
+import os
+import time
+import threading
+from typing import Dict, Any, Optional, Callable
+
+from gmail_client import GmailClient
+from message_cache import MessageCache
+
+# Gmail ends IDLE after ~29 minutes, so re-issue it before that
+IDLE_REFRESH_INTERVAL = 25 * 60
+# How often a waiting listener checks whether it was asked to stop
+IDLE_STOP_CHECK = 5.0
+MAX_RECONNECT_BACKOFF = 300.0
+
+class IdleListener:
+    """Background IDLE session for one account that re-syncs and re-clusters INBOX whenever it changes"""
+
+    def __init__(
+        self,
+        email_address: str,
+        app_password: str,
+        cache: Optional[MessageCache],
+        refresh: Callable[[GmailClient], Any],
+        wanted: Callable[[str], bool],
+        debounce: float = 2.0,
+    ):
+        self.email_address = email_address
+        self.app_password = app_password
+        self.cache = cache
+        self.refresh = refresh
+        self.wanted = wanted
+        self.debounce = debounce
+        self.result: Any = None
+        self.refreshed_at: Optional[float] = None
+        self.refreshes = 0
+        self.connected = False
+        self._generation = 0
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"imap-idle-{email_address}", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    @property
+    def alive(self) -> bool:
+        return self._thread.is_alive() and not self._stopped.is_set()
+
+    def invalidate(self):
+        """Drop the kept result; a refresh already in flight will not publish over this"""
+        self._generation += 1
+        self.result = None
+
+    def _run(self):
+        backoff = 1.0
+        while not self._stopped.is_set() and self.wanted(self.email_address):
+            client = GmailClient(self.email_address, self.app_password, self.cache)
+            try:
+                result = client.connect()
+                if not result["success"]:
+                    raise ConnectionError(result.get("error", "IMAP connect failed"))
+                if not client.select_mailbox("INBOX"):
+                    raise ConnectionError("Could not select INBOX")
+                self.connected = True
+                backoff = 1.0
+                if not self._watch(client):
+                    print(f"IMAP IDLE not supported for {self.email_address}, listener stopped")
+                    return
+            except Exception as e:
+                print(f"Error in IDLE listener for {self.email_address}: {e}")
+            finally:
+                # Nothing is watching the mailbox any more, so a kept result could go stale unnoticed
+                self.connected = False
+                self.result = None
+                client.disconnect()
+            self._stopped.wait(backoff)
+            backoff = min(backoff * 2, MAX_RECONNECT_BACKOFF)
+
+    def _watch(self, client: GmailClient) -> bool:
+        while not self._stopped.is_set() and self.wanted(self.email_address):
+            if not client.idle_start():
+                return False
+            changed = self._wait_for_change(client)
+            client.idle_done()
+            if changed:
+                self.result = None
+                # Let a burst of arrivals settle so it costs one refresh
+                if self._stopped.wait(self.debounce):
+                    break
+                generation = self._generation
+                result = self.refresh(client)
+                if generation == self._generation:
+                    self.result = result
+                self.refreshed_at = time.time()
+                self.refreshes += 1
+        return True
+
+    def _wait_for_change(self, client: GmailClient) -> bool:
+        deadline = time.monotonic() + IDLE_REFRESH_INTERVAL
+        while not self._stopped.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            if client.idle_wait(min(remaining, IDLE_STOP_CHECK)):
+                return True
+        return False
+
+class IdleListenerManager:
+    """Starts one IdleListener per connected account and serves the results they precompute"""
+
+    def __init__(
+        self,
+        refresh: Callable[[GmailClient], Any],
+        wanted: Callable[[str], bool],
+        cache: Optional[MessageCache] = None,
+        enabled: Optional[bool] = None,
+        debounce: Optional[float] = None,
+    ):
+        self.refresh = refresh
+        self.wanted = wanted
+        self.cache = cache
+        self.enabled = enabled if enabled is not None else os.getenv("IMAP_IDLE", "false").lower() in ("1", "true", "yes")
+        self.debounce = debounce if debounce is not None else float(os.getenv("IMAP_IDLE_DEBOUNCE", "2"))
+        self._listeners: Dict[str, IdleListener] = {}
+        self._lock = threading.Lock()
+
+    def watch(self, email_address: str, app_password: str):
+        """Start listening for the account, restarting the listener if its credentials changed"""
+        if not self.enabled:
+            return
+        with self._lock:
+            listener = self._listeners.get(email_address)
+            if listener is not None and listener.alive and listener.app_password == app_password:
+                return
+            if listener is not None:
+                listener.stop()
+            listener = IdleListener(email_address, app_password, self.cache, self.refresh, self.wanted, self.debounce)
+            self._listeners[email_address] = listener
+        listener.start()
+
+    def warm_result(self, email_address: Optional[str]) -> Optional[Any]:
+        """The latest precomputed result, if a live listener has one that reflects the current mailbox"""
+        with self._lock:
+            listener = self._listeners.get(email_address)
+        if listener is None or not listener.alive or not listener.connected:
+            return None
+        return listener.result
+
+    def invalidate(self, email_address: Optional[str]):
+        with self._lock:
+            listener = self._listeners.get(email_address)
+        if listener is not None:
+            listener.invalidate()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            listeners = list(self._listeners.values())
+        return {
+            "enabled": self.enabled,
+            "listeners": sum(1 for l in listeners if l.alive),
+            "connected": sum(1 for l in listeners if l.connected),
+            "warm": sum(1 for l in listeners if l.result is not None),
+            "refreshes": sum(l.refreshes for l in listeners),
+        }
+
+    def stop_all(self):
+        with self._lock:
+            for listener in self._listeners.values():
+                listener.stop()
+            self._listeners.clear()
+
+# Global listener manager instance
+idle_listeners: Optional[IdleListenerManager] = None
+
+def init_idle_listeners(refresh: Callable[[GmailClient], Any], wanted: Callable[[str], bool], cache: Optional[MessageCache] = None):
+    """Initialize global IDLE listener manager"""
+    global idle_listeners
+    if idle_listeners is None:
+        idle_listeners = IdleListenerManager(refresh, wanted, cache)
+    return idle_listeners
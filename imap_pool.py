@@ -0,0 +1,346 @@
+import os
+import time
+import imaplib
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Optional, Callable, List, Tuple, TypeVar
+
+from gmail_client import GmailClient
+from message_cache import MessageCache
+
+T = TypeVar("T")
+
+class _AccountPool:
+    def __init__(self, email_address: str, app_password: str):
+        self.email_address = email_address
+        self.app_password = app_password
+        self.idle: List[Tuple[GmailClient, float]] = []
+        self.in_use = 0
+        self.last_used = time.monotonic()
+        # No connections are lent for parallel fetches until then, after the server throttled the account
+        self.throttled_until = 0.0
+
+    @property
+    def open_count(self) -> int:
+        return self.in_use + len(self.idle)
+
+class ImapConnectionPool:
+    """Per-account bounded pools of GmailClient connections with keep-alive, reconnect and idle eviction"""
+
+    def __init__(
+        self,
+        cache: Optional[MessageCache] = None,
+        max_per_account: Optional[int] = None,
+        max_total: Optional[int] = None,
+        idle_timeout: Optional[float] = None,
+        keepalive_interval: Optional[float] = None,
+        account_ttl: Optional[float] = None,
+        throttle_cooldown: Optional[float] = None,
+    ):
+        self.cache = cache
+        # Gmail allows 15 simultaneous connections per account, IDLE listeners included
+        self.max_per_account = max_per_account or int(os.getenv("IMAP_POOL_MAX_PER_ACCOUNT", "4"))
+        self.max_total = max_total or int(os.getenv("IMAP_POOL_MAX_TOTAL", "50"))
+        self.idle_timeout = idle_timeout or float(os.getenv("IMAP_POOL_IDLE_TIMEOUT", "600"))
+        self.keepalive_interval = keepalive_interval or float(os.getenv("IMAP_KEEPALIVE_INTERVAL", "120"))
+        self.account_ttl = account_ttl or float(os.getenv("IMAP_ACCOUNT_TTL", "43200"))
+        self.throttle_cooldown = throttle_cooldown or float(os.getenv("IMAP_THROTTLE_COOLDOWN", "60"))
+        self._accounts: Dict[str, _AccountPool] = {}
+        self._total = 0
+        self._cond = threading.Condition()
+        self._maintenance: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+
+    def _new_client(self, pool: _AccountPool) -> GmailClient:
+        client = GmailClient(pool.email_address, pool.app_password, self.cache)
+        client.lender = self
+        return client
+
+    def register(self, email_address: str, app_password: str) -> Dict[str, Any]:
+        """Validate credentials with a fresh connection and make it the account's first pooled client"""
+        client = GmailClient(email_address, app_password, self.cache)
+        client.lender = self
+        closing: List[GmailClient] = []
+        with self._cond:
+            admitted = self._total < self.max_total or self._evict_lru_idle(closing)
+            if admitted:
+                self._total += 1
+        self._disconnect(closing)
+        if not admitted:
+            return {"success": False, "error": "Too many open IMAP connections, try again shortly"}
+
+        result = client.connect()
+        closing = []
+        with self._cond:
+            if not result["success"]:
+                self._total -= 1
+                self._cond.notify_all()
+                return result
+
+            pool = self._accounts.get(email_address)
+            if pool is None or pool.app_password != app_password:
+                if pool is not None:
+                    closing.extend(self._close_idle(pool))
+                pool = self._accounts.setdefault(email_address, _AccountPool(email_address, app_password))
+                pool.app_password = app_password
+
+            if pool.open_count >= self.max_per_account:
+                self._total -= 1
+                closing.append(client)
+            else:
+                pool.idle.append((client, time.monotonic()))
+            pool.last_used = time.monotonic()
+            self._cond.notify_all()
+        self._disconnect(closing)
+        return result
+
+    def has_account(self, email_address: Optional[str]) -> bool:
+        with self._cond:
+            return email_address in self._accounts
+
+    def acquire(self, email_address: str, timeout: float = 30.0) -> GmailClient:
+        deadline = time.monotonic() + timeout
+        closing: List[GmailClient] = []
+        with self._cond:
+            while True:
+                pool = self._accounts.get(email_address)
+                if pool is None:
+                    raise KeyError(f"Unknown IMAP account {email_address}")
+
+                if pool.idle:
+                    client, idle_since = pool.idle.pop()
+                    pool.in_use += 1
+                    break
+
+                if pool.open_count < self.max_per_account and (self._total < self.max_total or self._evict_lru_idle(closing)):
+                    client, idle_since = None, None
+                    pool.in_use += 1
+                    self._total += 1
+                    break
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(f"No IMAP connection available for {email_address}")
+                self._cond.wait(remaining)
+            pool.last_used = time.monotonic()
+        self._disconnect(closing)
+
+        try:
+            if client is None:
+                client = self._new_client(pool)
+                result = client.connect()
+                if not result["success"]:
+                    raise ConnectionError(result.get("error", "IMAP connect failed"))
+            elif time.monotonic() - idle_since >= self.keepalive_interval and not client.noop():
+                result = client.reconnect()
+                if not result["success"]:
+                    raise ConnectionError(result.get("error", "IMAP reconnect failed"))
+        except Exception:
+            self.release(email_address, client, broken=True)
+            raise
+        return client
+
+    def release(self, email_address: str, client: Optional[GmailClient], broken: bool = False):
+        closing = False
+        with self._cond:
+            pool = self._accounts.get(email_address)
+            if pool is not None:
+                pool.in_use -= 1
+            if broken or pool is None or client is None or client.imap is None:
+                self._total -= 1
+                closing = client is not None
+            else:
+                pool.idle.append((client, time.monotonic()))
+            self._cond.notify_all()
+        if closing:
+            client.disconnect()
+
+    def lend(self, email_address: str, count: int, mailbox: Optional[str] = None) -> List[GmailClient]:
+        """Up to `count` more connections for a parallel fetch, with `mailbox` selected; give each back with release().
+        Never waits: idle connections first, then new ones while the account and total caps allow, and none
+        while the account is cooling down after throttling."""
+        reserved = []
+        closing: List[GmailClient] = []
+        with self._cond:
+            pool = self._accounts.get(email_address)
+            if pool is None or time.monotonic() < pool.throttled_until:
+                return []
+            while len(reserved) < count:
+                if pool.idle:
+                    reserved.append(pool.idle.pop())
+                elif pool.open_count < self.max_per_account and (self._total < self.max_total or self._evict_lru_idle(closing)):
+                    reserved.append((None, None))
+                    self._total += 1
+                else:
+                    break
+                pool.in_use += 1
+            pool.last_used = time.monotonic()
+        self._disconnect(closing)
+        if not reserved:
+            return []
+
+        def prepare(entry: Tuple[Optional[GmailClient], Optional[float]]) -> Optional[GmailClient]:
+            client, idle_since = entry
+            try:
+                if client is None:
+                    client = self._new_client(pool)
+                    result = client.connect()
+                elif time.monotonic() - idle_since >= self.keepalive_interval and not client.noop():
+                    result = client.reconnect()
+                else:
+                    result = {"success": True}
+                if result["success"] and mailbox and not client.select_mailbox(mailbox):
+                    result = {"success": False, "error": f"Could not select {mailbox}"}
+            except (imaplib.IMAP4.error, OSError) as e:
+                result = {"success": False, "error": str(e)}
+            if not result["success"]:
+                # Gmail refuses logins past its per-account connection limit
+                if "Too many simultaneous connections" in result.get("error", ""):
+                    self.throttle(email_address)
+                self.release(email_address, client, broken=True)
+                return None
+            return client
+
+        # Logins are slow, so lent connections are opened side by side
+        with ThreadPoolExecutor(max_workers=len(reserved), thread_name_prefix="imap-lend") as executor:
+            return [client for client in executor.map(prepare, reserved) if client is not None]
+
+    def throttle(self, email_address: str):
+        """Lend the account no more connections for a while; the server has asked it to slow down"""
+        with self._cond:
+            pool = self._accounts.get(email_address)
+            if pool is not None:
+                pool.throttled_until = time.monotonic() + self.throttle_cooldown
+
+    @contextmanager
+    def connection(self, email_address: str):
+        client = self.acquire(email_address)
+        broken = False
+        try:
+            yield client
+        except (imaplib.IMAP4.abort, OSError):
+            broken = True
+            raise
+        finally:
+            self.release(email_address, client, broken=broken)
+
+    def run(self, email_address: str, operation: Callable[[GmailClient], T]) -> T:
+        """Run an operation on a pooled connection, reconnecting and re-selecting once if the socket died"""
+        with self.connection(email_address) as client:
+            try:
+                return operation(client)
+            except (imaplib.IMAP4.abort, OSError):
+                result = client.reconnect()
+                if not result["success"]:
+                    raise
+                return operation(client)
+
+    @staticmethod
+    def _disconnect(clients: List[GmailClient]):
+        """Log out connections already taken out of the pool; never called with the lock held, LOGOUT can block"""
+        for client in clients:
+            client.disconnect()
+
+    def _close_idle(self, pool: _AccountPool) -> List[GmailClient]:
+        """Take an account's idle connections out of the pool; the caller disconnects them after unlocking"""
+        clients = [client for client, _ in pool.idle]
+        self._total -= len(clients)
+        pool.idle = []
+        return clients
+
+    def _evict_lru_idle(self, closing: List[GmailClient]) -> bool:
+        """Free a slot by taking out the least recently used idle connection across all accounts, adding it to closing"""
+        oldest = None
+        for pool in self._accounts.values():
+            for i, (client, idle_since) in enumerate(pool.idle):
+                if oldest is None or idle_since < oldest[2]:
+                    oldest = (pool, i, idle_since)
+        if oldest is None:
+            return False
+        pool, i, _ = oldest
+        client, _ = pool.idle.pop(i)
+        closing.append(client)
+        self._total -= 1
+        return True
+
+    def maintain(self):
+        """Evict idle connections past the idle timeout, NOOP the rest, and forget long-unused accounts"""
+        now = time.monotonic()
+        to_ping = []
+        closing: List[GmailClient] = []
+        with self._cond:
+            for email_address, pool in list(self._accounts.items()):
+                keep = []
+                for client, idle_since in pool.idle:
+                    if now - idle_since >= self.idle_timeout:
+                        closing.append(client)
+                        self._total -= 1
+                    elif now - idle_since >= self.keepalive_interval:
+                        # Counted as in use while pinged, so the account's caps still see it
+                        pool.in_use += 1
+                        to_ping.append((email_address, pool, client))
+                    else:
+                        keep.append((client, idle_since))
+                pool.idle = keep
+                if pool.open_count == 0 and now - pool.last_used >= self.account_ttl:
+                    del self._accounts[email_address]
+            self._cond.notify_all()
+        self._disconnect(closing)
+
+        for email_address, pool, client in to_ping:
+            alive = client.noop()
+            with self._cond:
+                pool.in_use -= 1
+                keep = alive and self._accounts.get(email_address) is pool
+                if keep:
+                    pool.idle.append((client, time.monotonic()))
+                else:
+                    self._total -= 1
+                self._cond.notify_all()
+            if not keep:
+                client.disconnect()
+
+    def start_maintenance(self, interval: float = 30.0):
+        if self._maintenance is not None:
+            return
+
+        def loop():
+            while not self._stopped.wait(interval):
+                try:
+                    self.maintain()
+                except Exception as e:
+                    print(f"Error maintaining IMAP pool: {e}")
+
+        self._maintenance = threading.Thread(target=loop, name="imap-pool-maintenance", daemon=True)
+        self._maintenance.start()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            return {
+                "accounts": len(self._accounts),
+                "open": self._total,
+                "idle": sum(len(p.idle) for p in self._accounts.values()),
+                "in_use": sum(p.in_use for p in self._accounts.values()),
+            }
+
+    def close_all(self):
+        self._stopped.set()
+        closing: List[GmailClient] = []
+        with self._cond:
+            for pool in self._accounts.values():
+                closing.extend(self._close_idle(pool))
+            self._accounts.clear()
+            self._cond.notify_all()
+        self._disconnect(closing)
+
+# Global pool instance
+imap_pool: Optional[ImapConnectionPool] = None
+
+def init_imap_pool(cache: Optional[MessageCache] = None):
+    """Initialize global IMAP connection pool"""
+    global imap_pool
+    if imap_pool is None:
+        imap_pool = ImapConnectionPool(cache)
+        imap_pool.start_maintenance()
+    return imap_pool
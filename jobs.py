@@ -0,0 +1,109 @@
+import os
+import time
+import uuid
+import asyncio
+from typing import Dict, Any, Optional, Callable, Awaitable
+
+class Job:
+    """A background fetch+cluster run and the progress it has published so far"""
+
+    def __init__(self, account: str, key: str):
+        self.id = uuid.uuid4().hex
+        self.account = account
+        self.key = key
+        self.stage = "queued"
+        self.message = "Waiting for a free worker"
+        self.fetched = 0
+        self.total = 0
+        self.result: Any = None
+        # A quick local result shown while the final one is still being computed
+        self.preview: Any = None
+        self.error: Optional[str] = None
+        self.created_at = time.time()
+        self.updated_at = self.created_at
+        self.task: Optional[asyncio.Task] = None
+
+    def update(self, stage: Optional[str] = None, message: Optional[str] = None, fetched: Optional[int] = None, total: Optional[int] = None):
+        if stage is not None:
+            self.stage = stage
+        if message is not None:
+            self.message = message
+        if fetched is not None:
+            self.fetched = fetched
+        if total is not None:
+            self.total = total
+        self.updated_at = time.time()
+
+    @property
+    def finished(self) -> bool:
+        return self.stage in ("done", "failed")
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "stage": self.stage,
+            "message": self.message,
+            "fetched": self.fetched,
+            "total": self.total,
+            "error": self.error,
+            "preview": self.preview is not None,
+        }
+
+class JobManager:
+    """Runs analysis jobs on a bounded asyncio worker pool and keeps finished jobs for a TTL"""
+
+    def __init__(self, max_workers: Optional[int] = None, ttl: Optional[float] = None):
+        self.max_workers = max_workers or int(os.getenv("ANALYSIS_WORKERS", "8"))
+        self.ttl = ttl or float(os.getenv("ANALYSIS_JOB_TTL", "1800"))
+        self._jobs: Dict[str, Job] = {}
+        self._running: Dict[str, Job] = {}
+        self._workers = asyncio.Semaphore(self.max_workers)
+
+    def submit(self, account: str, pipeline: Callable[[Job], Awaitable[Any]], key: Optional[str] = None) -> Job:
+        """Start a job for the key (default: the account), or return the one already in flight"""
+        self._prune()
+        key = key or account
+        running = self._running.get(key)
+        if running and not running.finished:
+            return running
+
+        job = Job(account, key)
+        self._jobs[job.id] = job
+        self._running[key] = job
+        job.task = asyncio.create_task(self._run(job, pipeline))
+        return job
+
+    def complete(self, account: str, result: Any, key: Optional[str] = None) -> Job:
+        """Record an already-finished job for a result that was computed ahead of time"""
+        self._prune()
+        job = Job(account, key or account)
+        job.result = result
+        job.update(stage="done", message="Done")
+        self._jobs[job.id] = job
+        return job
+    
+    async def _run(self, job: Job, pipeline: Callable[[Job], Awaitable[Any]]):
+        try:
+            async with self._workers:
+                job.update(stage="connecting", message="Connecting to Gmail")
+                job.result = await pipeline(job)
+            job.update(stage="done", message="Done")
+        except Exception as e:
+            print(f"Error running analysis job: {e}")
+            job.error = str(e)
+            job.update(stage="failed", message="Analysis failed")
+        finally:
+            job.task = None
+            if self._running.get(job.key) is job:
+                del self._running[job.key]
+
+    def get(self, job_id: Optional[str]) -> Optional[Job]:
+        if not job_id:
+            return None
+        return self._jobs.get(job_id)
+
+    def _prune(self):
+        cutoff = time.time() - self.ttl
+        for job_id, job in list(self._jobs.items()):
+            if job.finished and job.updated_at < cutoff:
+                del self._jobs[job_id]
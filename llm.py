@@ -1,23 +1,206 @@
 import os
+import time
+import random
+import asyncio
+import threading
+from collections import deque
+from typing import List, Dict, Any, Optional, AsyncIterator
+
+import anthropic
 from langchain_anthropic import ChatAnthropic
 
-def init_llm():
+import metrics
+
+LLM_MODEL = "claude-3-5-sonnet-20241022"
+
+def init_llm(temperature: float = 0.7, **kwargs):
     """Initialize Anthropic LLM via LangChain"""
     api_key = os.getenv("ANTHROPIC_API_KEY")
     if not api_key:
         raise ValueError("ANTHROPIC_API_KEY not found in environment variables")
-    
+
     return ChatAnthropic(
-        model="claude-3-5-sonnet-20241022",
+        model=LLM_MODEL,
         api_key=api_key,
-        temperature=0.7
+        temperature=temperature,
+        **kwargs
     )
 
-def test_connection():
-    """Test LLM connection and return status"""
+def is_retryable(error: Exception) -> bool:
+    """Connection failures, timeouts, rate limits and overload/server errors are worth another attempt"""
+    if isinstance(error, (anthropic.APIConnectionError, asyncio.TimeoutError)):
+        return True
+    if isinstance(error, anthropic.APIStatusError):
+        return error.status_code in (408, 409, 429) or error.status_code >= 500
+    return False
+
+def percentiles(latencies: List[float]) -> Dict[str, Optional[float]]:
+    """p50/p95/p99 of latencies in seconds, in milliseconds"""
+    ordered = sorted(latencies)
+    pick = lambda p: round(ordered[min(len(ordered) - 1, int(p * len(ordered)))] * 1000, 1) if ordered else None
+    return {"p50": pick(0.5), "p95": pick(0.95), "p99": pick(0.99)}
+
+class LLMClient:
+    """Process-wide access to the model: one ChatAnthropic (and so one pooled HTTP client) for the process,
+    a deadline per call, bounded retries with jittered exponential backoff, and a cap on calls in flight.
+    The async HTTP client's connections belong to the loop that opened them, so every call runs on the
+    client's own long-lived event loop thread, whichever loop (or asyncio.run) the caller is on."""
+
+    def __init__(self, model=None, temperature: float = 0, timeout: Optional[float] = None, max_retries: Optional[int] = None, backoff: Optional[float] = None, concurrency: Optional[int] = None):
+        if model is None and not os.getenv("ANTHROPIC_API_KEY"):
+            # Fail fast on missing configuration rather than on the first call
+            raise ValueError("ANTHROPIC_API_KEY not found in environment variables")
+        self.temperature = temperature
+        # Seconds a call may take, retries included; 0 disables the deadline
+        self.timeout = timeout if timeout is not None else float(os.getenv("LLM_TIMEOUT", "60"))
+        self.max_retries = max_retries if max_retries is not None else int(os.getenv("LLM_MAX_RETRIES", "2"))
+        self.backoff = backoff if backoff is not None else float(os.getenv("LLM_RETRY_BACKOFF", "0.5"))
+        self.concurrency = concurrency or int(os.getenv("LLM_CONCURRENCY", "8"))
+        self._model = model
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._lock = threading.Lock()
+        # Recent call latencies (seconds) and outcome counts, for test_connection and /health
+        self._latencies: deque = deque(maxlen=500)
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+
+    def model(self):
+        """The shared model, created on first use"""
+        with self._lock:
+            if self._model is None:
+                # Retries and timeouts are handled here, so the SDK's own are off
+                self._model = init_llm(temperature=self.temperature, max_retries=0)
+            return self._model
+
+    def _background_loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._semaphore = asyncio.Semaphore(self.concurrency)
+                threading.Thread(target=self._loop.run_forever, name="llm-loop", daemon=True).start()
+            return self._loop
+
+    async def astream(self, prompt: str, tools: Optional[List[Dict[str, Any]]] = None, **kwargs) -> AsyncIterator[Any]:
+        """Stream a call's chunks within the deadline. Attempts that fail before their first chunk are retried;
+        once output has arrived an error is raised to the caller, which may keep what it already has."""
+        loop = asyncio.get_running_loop()
+        background = self._background_loop()
+        if loop is background:
+            async for chunk in self._astream(prompt, tools, **kwargs):
+                yield chunk
+            return
+
+        # Run the call on the client's loop and hand its chunks (then None, or the error) back to this one
+        queue: asyncio.Queue = asyncio.Queue()
+
+        def post(item):
+            try:
+                loop.call_soon_threadsafe(queue.put_nowait, item)
+            except RuntimeError:
+                pass  # The caller's loop has closed; nobody is listening
+
+        async def pump():
+            try:
+                async for chunk in self._astream(prompt, tools, **kwargs):
+                    post((chunk, None))
+                post((None, None))
+            except Exception as e:
+                post((None, e))
+
+        future = asyncio.run_coroutine_threadsafe(pump(), background)
+        try:
+            while True:
+                chunk, error = await queue.get()
+                if error is not None:
+                    raise error
+                if chunk is None:
+                    return
+                yield chunk
+        finally:
+            future.cancel()
+
+    async def _astream(self, prompt: str, tools: Optional[List[Dict[str, Any]]], **kwargs) -> AsyncIterator[Any]:
+        loop = asyncio.get_running_loop()
+        model = self.model()
+        runnable = model.bind_tools(tools, **kwargs) if tools else (model.bind(**kwargs) if kwargs else model)
+        deadline = loop.time() + self.timeout if self.timeout else None
+
+        async with self._semaphore:
+            started = time.perf_counter()
+            attempt = 0
+            try:
+                while True:
+                    received = False
+                    stream = runnable.astream(prompt)
+                    try:
+                        while True:
+                            try:
+                                chunk = await asyncio.wait_for(anext(stream), None if deadline is None else max(0, deadline - loop.time()))
+                            except StopAsyncIteration:
+                                return
+                            except asyncio.TimeoutError:
+                                raise asyncio.TimeoutError(f"LLM call exceeded its {self.timeout:g}s deadline") from None
+                            received = True
+                            yield chunk
+                    except Exception as e:
+                        delay = self.backoff * 2 ** attempt * (0.5 + random.random())
+                        if received or attempt >= self.max_retries or not is_retryable(e) or (deadline is not None and loop.time() + delay >= deadline):
+                            raise
+                        attempt += 1
+                        with self._lock:
+                            self.retries += 1
+                        metrics.inc("llm_retries_total")
+                        print(f"Retrying LLM call after {type(e).__name__} (attempt {attempt + 1})")
+                        await asyncio.sleep(delay)
+                    finally:
+                        await stream.aclose()
+            except Exception:
+                with self._lock:
+                    self.errors += 1
+                raise
+            finally:
+                with self._lock:
+                    self.calls += 1
+                    self._latencies.append(time.perf_counter() - started)
+
+    async def ainvoke(self, prompt: str, **kwargs) -> str:
+        """Text of a plain completion, through the same deadline, retries and concurrency cap"""
+        parts = []
+        async for chunk in self.astream(prompt, **kwargs):
+            if isinstance(chunk.content, str):
+                parts.append(chunk.content)
+            else:
+                parts.extend(block.get("text") or "" for block in chunk.content if isinstance(block, dict))
+        return "".join(parts)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"calls": self.calls, "errors": self.errors, "retries": self.retries, "latency_ms": percentiles(list(self._latencies))}
+
+# Global client instance
+llm_client: Optional[LLMClient] = None
+
+def init_llm_client():
+    """Initialize global LLM client; raises ValueError when the API key is missing"""
+    global llm_client
+    if llm_client is None:
+        llm_client = LLMClient()
+    return llm_client
+
+def test_connection(samples: int = 5):
+    """Test LLM connection with a few short calls and report their latency percentiles"""
     try:
-        llm = init_llm()
-        response = llm.invoke("Hello")
-        return {"success": True, "message": "Connected"}
+        client = init_llm_client()
+        latencies = []
+
+        async def probe():
+            for _ in range(samples):
+                started = time.perf_counter()
+                await client.ainvoke("Hello", max_tokens=1)
+                latencies.append(time.perf_counter() - started)
+        asyncio.run(probe())
+        return {"success": True, "message": "Connected", "samples": samples, "latency_ms": percentiles(latencies)}
     except Exception as e:
-        return {"success": False, "error": str(e)}
\ No newline at end of file
+        return {"success": False, "error": str(e)}
@@ -0,0 +1,86 @@
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+from typing import List, Dict, Any, Optional
+
+from email_record import EmailRecord
+
+class LLMResponseCache:
+    """Persistent content-addressed cache of clustering results with TTL, LRU eviction and hit-rate stats"""
+
+    def __init__(self, path: Optional[str] = None, ttl: Optional[float] = None, max_entries: Optional[int] = None):
+        self.path = path or os.getenv("LLM_CACHE_PATH", "llm_cache.db")
+        self.ttl = ttl or float(os.getenv("LLM_CACHE_TTL", "86400"))
+        self.max_entries = max_entries or int(os.getenv("LLM_CACHE_MAX_ENTRIES", "1000"))
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS llm_cache (
+                key TEXT PRIMARY KEY,
+                data TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS llm_cache_accessed ON llm_cache (accessed_at);
+        """)
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(version: str, emails: List[EmailRecord]) -> str:
+        """Hash the prompt/model version with the ordered, normalized fields the prompt is built from"""
+        digest = hashlib.sha256(version.encode())
+        for email in emails:
+            for field in (email.sender[:50], email.subject[:100], email.body[:150]):
+                digest.update(b"\x1f" + " ".join(field.split()).encode("utf-8", "ignore"))
+            digest.update(b"\x1e")
+        return digest.hexdigest()
+
+    def get(self, key: str) -> Optional[Any]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT data FROM llm_cache WHERE key = ? AND created_at >= ?", (key, now - self.ttl)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._conn.execute("UPDATE llm_cache SET accessed_at = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+        return json.loads(row[0])
+
+    def put(self, key: str, value: Any):
+        now = time.time()
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO llm_cache VALUES (?, ?, ?, ?)", (key, json.dumps(value), now, now))
+            self._conn.execute("DELETE FROM llm_cache WHERE created_at < ?", (now - self.ttl,))
+            self._conn.execute(
+                "DELETE FROM llm_cache WHERE key IN (SELECT key FROM llm_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+            self._conn.commit()
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+        }
+
+# Global cache instance
+llm_cache: Optional[LLMResponseCache] = None
+
+def init_llm_cache():
+    """Initialize global LLM response cache"""
+    global llm_cache
+    if llm_cache is None:
+        llm_cache = LLMResponseCache()
+    return llm_cache
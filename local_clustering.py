@@ -0,0 +1,387 @@
+import re
+import math
+import zlib
+import random
+from email.utils import parseaddr
+from typing import List, Dict, Any, Optional, Tuple, Iterable, Callable
+
+from email_record import EmailRecord
+
+# Size of the hashed feature space; collisions are rare at inbox vocabulary sizes
+FEATURE_DIM = 2 ** 20
+# Centroids keep only their heaviest terms so similarity stays cheap on sparse vectors
+CENTROID_TERMS = 200
+# Emails buffered to seed the streaming clusterer's centroids before it starts assigning page by page
+STREAM_SEED_SIZE = 1000
+# Document-frequency buckets for the streaming clusterer; bounds its IDF table however large the window
+STREAM_DF_BUCKETS = 2 ** 16
+
+# Letters only: numbered tokens (ticket IDs, order numbers) are unique per email and only add noise
+_TOKEN_RE = re.compile(r"[a-z][a-z'_-]*[a-z]")
+_STOPWORDS = frozenset("""
+    a an and are as at be by for from has have i in is it its me my no not of on or our re fw fwd
+    so that the this to was we will with you your yours he she they them their there here all any
+    can do if just more new now out up get got been was were what when which who why how than then
+""".split())
+
+SparseVector = Dict[int, float]
+
+def _feature(token: str) -> int:
+    return zlib.crc32(token.encode("utf-8")) % FEATURE_DIM
+
+def tokenize(email: EmailRecord) -> List[str]:
+    """Features for an email: sender address/domain, display name, subject words (weighted x2) and preview words"""
+    name, address = parseaddr(email.sender)
+    address = address.lower()
+    domain = address.partition("@")[2]
+
+    tokens = []
+    if address:
+        tokens.append(f"from:{address}")
+    if domain:
+        tokens.append(f"domain:{domain}")
+        tokens.extend(f"domain:{part}" for part in domain.split(".")[:-1] if len(part) > 2)
+    tokens.extend(f"name:{w}" for w in _TOKEN_RE.findall(name.lower()) if w not in _STOPWORDS)
+
+    subject_words = [w for w in _TOKEN_RE.findall(email.subject.lower()) if w not in _STOPWORDS]
+    tokens.extend(subject_words)
+    tokens.extend(subject_words)
+    tokens.extend(w for w in _TOKEN_RE.findall(email.body[:300].lower()) if w not in _STOPWORDS)
+    return tokens
+
+def dot(a: SparseVector, b: SparseVector) -> float:
+    if len(a) > len(b):
+        a, b = b, a
+    return sum(v * b.get(k, 0.0) for k, v in a.items())
+
+def normalize(vector: SparseVector, keep: Optional[int] = None) -> SparseVector:
+    if keep is not None and len(vector) > keep:
+        vector = dict(sorted(vector.items(), key=lambda kv: kv[1], reverse=True)[:keep])
+    norm = math.sqrt(sum(v * v for v in vector.values()))
+    if norm == 0:
+        return {}
+    return {k: v / norm for k, v in vector.items()}
+
+class HashedTfidfVectorizer:
+    """TF-IDF over hashed token features, L2-normalized, with no vocabulary beyond a term lookup for labels.
+    With df_buckets, document frequencies are counted per feature modulo df_buckets."""
+
+    def __init__(self, df_buckets: Optional[int] = None):
+        self.doc_freq: Dict[int, int] = {}
+        self.doc_count = 0
+        self.terms: Dict[int, str] = {}
+        self.df_buckets = df_buckets
+
+    def fit_transform(self, emails: List[EmailRecord]) -> List[SparseVector]:
+        counts = []
+        for email in emails:
+            tf: Dict[int, int] = {}
+            for token in tokenize(email):
+                feature = _feature(token)
+                tf[feature] = tf.get(feature, 0) + 1
+                self.terms.setdefault(feature, token)
+            for feature in tf:
+                bucket = self._bucket(feature)
+                self.doc_freq[bucket] = self.doc_freq.get(bucket, 0) + 1
+            counts.append(tf)
+        self.doc_count += len(emails)
+        return [self._weigh(tf) for tf in counts]
+
+    def transform(self, emails: List[EmailRecord]) -> List[SparseVector]:
+        vectors = []
+        for email in emails:
+            tf: Dict[int, int] = {}
+            for token in tokenize(email):
+                feature = _feature(token)
+                tf[feature] = tf.get(feature, 0) + 1
+            vectors.append(self._weigh(tf))
+        return vectors
+
+    def _bucket(self, feature: int) -> int:
+        return feature % self.df_buckets if self.df_buckets else feature
+
+    def idf(self, feature: int) -> float:
+        return math.log((1 + self.doc_count) / (1 + self.doc_freq.get(self._bucket(feature), 0))) + 1
+
+    def retain_terms(self, features: Iterable[int]):
+        """Forget the label terms of every feature but these"""
+        self.terms = {feature: self.terms[feature] for feature in features if feature in self.terms}
+
+    def _weigh(self, tf: Dict[int, int]) -> SparseVector:
+        return normalize({feature: (1 + math.log(count)) * self.idf(feature) for feature, count in tf.items()})
+
+    def top_terms(self, centroid: SparseVector, limit: int = 5) -> List[str]:
+        ranked = sorted(centroid.items(), key=lambda kv: kv[1], reverse=True)
+        terms = []
+        for feature, _ in ranked:
+            term = self.terms.get(feature)
+            if term and not term.startswith("from:"):
+                term = term.split(":", 1)[-1]
+                if term not in terms:
+                    terms.append(term)
+            if len(terms) >= limit:
+                break
+        return terms
+
+def vectorize_with_idf(email: EmailRecord, idf: Dict[int, float], default_idf: float) -> SparseVector:
+    """Vectorize one email against a stored IDF snapshot (features outside it get default_idf)"""
+    tf: Dict[int, int] = {}
+    for token in tokenize(email):
+        feature = _feature(token)
+        tf[feature] = tf.get(feature, 0) + 1
+    return normalize({feature: (1 + math.log(count)) * idf.get(feature, default_idf) for feature, count in tf.items()})
+
+def centroid(vectors: List[SparseVector], indices: Iterable[int]) -> SparseVector:
+    acc: SparseVector = {}
+    for i in indices:
+        for feature, weight in vectors[i].items():
+            acc[feature] = acc.get(feature, 0.0) + weight
+    return normalize(acc, CENTROID_TERMS)
+
+def email_signature(email: EmailRecord) -> str:
+    """Cheap content signature used to notice when a known message changed"""
+    text = "\x1f".join(" ".join(field.split()) for field in (email.sender, email.subject, email.body))
+    return format(zlib.crc32(text.encode("utf-8", "ignore")), "08x")
+
+def spherical_kmeans(vectors: List[SparseVector], k: int, iterations: int = 15, seed: int = 0, weights: Optional[List[float]] = None) -> Tuple[List[int], List[SparseVector]]:
+    """Cosine k-means with k-means++ seeding; returns per-vector labels and normalized sparse centroids.
+    Weighted vectors (one per collapsed bulk sender) pull seeding and centroids by their message count."""
+    rng = random.Random(seed)
+    n = len(vectors)
+    k = max(1, min(k, n))
+    if weights is None:
+        weights = [1.0] * n
+
+    centroids = [vectors[rng.randrange(n)]]
+    best = [dot(v, centroids[0]) for v in vectors]
+    while len(centroids) < k:
+        odds = [max(0.0, 1.0 - s) * w for s, w in zip(best, weights)]
+        total = sum(odds)
+        if total <= 1e-9:
+            break
+        pick = rng.random() * total
+        for i, w in enumerate(odds):
+            pick -= w
+            if pick <= 0:
+                break
+        centroids.append(vectors[i])
+        best = [max(b, dot(v, vectors[i])) for b, v in zip(best, vectors)]
+
+    labels = [-1] * n
+    for _ in range(iterations):
+        changed = False
+        for i, v in enumerate(vectors):
+            label = max(range(len(centroids)), key=lambda c: dot(v, centroids[c]))
+            if label != labels[i]:
+                labels[i] = label
+                changed = True
+        if not changed:
+            break
+
+        sums: List[SparseVector] = [{} for _ in centroids]
+        for v, label, w in zip(vectors, labels, weights):
+            acc = sums[label]
+            for feature, weight in v.items():
+                acc[feature] = acc.get(feature, 0.0) + weight * w
+        centroids = [normalize(acc, CENTROID_TERMS) if acc else c for acc, c in zip(sums, centroids)]
+
+    return labels, centroids
+
+class LocalClusterer:
+    """Offline first-pass grouping of emails by hashed TF-IDF similarity"""
+
+    def __init__(self, max_clusters: int = 12, seed: int = 0, min_group_fraction: float = 0.02):
+        self.max_clusters = max_clusters
+        self.seed = seed
+        self.min_group_fraction = min_group_fraction
+
+    def choose_k(self, n: int) -> int:
+        return max(1, min(self.max_clusters, round(math.sqrt(n / 2))))
+
+    def cluster(self, emails: List[EmailRecord], weights: Optional[List[int]] = None) -> List[Dict[str, Any]]:
+        """Group emails; each group has its member indices, a representative index, top terms and centroid.
+        With weights (messages per entry) group sizes are message counts, not entry counts."""
+        if not emails:
+            return []
+        if weights is None:
+            weights = [1] * len(emails)
+        total = sum(weights)
+
+        # IDF is fitted per call: calls are independent windows, and one clusterer serves concurrent analyses
+        vectorizer = HashedTfidfVectorizer()
+        vectors = vectorizer.fit_transform(emails)
+        labels, centroids = spherical_kmeans(vectors, self.choose_k(total), seed=self.seed, weights=weights)
+
+        members: Dict[int, List[int]] = {}
+        for i, label in enumerate(labels):
+            members.setdefault(label, []).append(i)
+        size = lambda indices: sum(weights[i] for i in indices)
+
+        # Fold outlier groups into their nearest substantial group instead of showing singletons
+        min_size = max(2, int(total * self.min_group_fraction))
+        large = [label for label, indices in members.items() if size(indices) >= min_size]
+        if large:
+            for label in [label for label in members if label not in large]:
+                for i in members.pop(label):
+                    nearest = max(large, key=lambda c: dot(vectors[i], centroids[c]))
+                    members[nearest].append(i)
+            for indices in members.values():
+                indices.sort()
+
+        groups = []
+        for label, indices in members.items():
+            centroid = centroids[label]
+            representative = max(indices, key=lambda i: dot(vectors[i], centroid))
+            groups.append({
+                "indices": indices,
+                "size": size(indices),
+                "representative": representative,
+                "terms": vectorizer.top_terms(centroid),
+                "centroid": centroid,
+            })
+        groups.sort(key=lambda g: g["size"], reverse=True)
+        return groups
+
+class StreamingClusterer:
+    """Mini-batch spherical k-means over pages of emails for large windows.
+    Centroids are seeded from the first STREAM_SEED_SIZE emails, then each page is assigned and folded
+    into them; per email only a label is kept, plus the closest email seen so far for each centroid.
+    Later mail from a bulk source already seen takes that source's label without being featurized.
+    Emails `classify` maps to a rule index (-1 for none) skip clustering and form one group per rule.
+    Memory stays bounded too: document frequencies go into STREAM_DF_BUCKETS buckets, and label terms
+    are kept only for features still in a centroid."""
+
+    def __init__(self, max_clusters: int = 12, expected: Optional[int] = None, seed_size: int = STREAM_SEED_SIZE, seed: int = 0, min_group_fraction: float = 0.02, classify: Optional[Callable[[EmailRecord], int]] = None):
+        self.local = LocalClusterer(max_clusters=max_clusters, seed=seed, min_group_fraction=min_group_fraction)
+        self.vectorizer = HashedTfidfVectorizer(df_buckets=STREAM_DF_BUCKETS)
+        self.expected = expected
+        self.seed_size = seed_size
+        self.labels: List[int] = []
+        self.centroids: List[SparseVector] = []
+        self.counts: List[int] = []
+        self._pending: List[EmailRecord] = []
+        self._best: Dict[int, Tuple[float, int, EmailRecord]] = {}
+        self._source_labels: Dict[str, int] = {}
+        self.classify = classify
+
+    def add(self, emails: List[EmailRecord]):
+        if self.centroids:
+            rules = self._rules(emails)
+            needed = [rule < 0 and e.source not in self._source_labels for e, rule in zip(emails, rules)]
+            fresh = iter(self.vectorizer.fit_transform([e for e, need in zip(emails, needed) if need]))
+            self._assign(emails, [next(fresh) if need else None for need in needed], rules)
+            return
+        self._pending.extend(emails)
+        if len(self._pending) >= self.seed_size:
+            self._seed_centroids()
+
+    def _rules(self, emails: List[EmailRecord]) -> List[int]:
+        if self.classify is None:
+            return [-1] * len(emails)
+        return [self.classify(email) for email in emails]
+
+    def _seed_centroids(self):
+        emails, self._pending = self._pending, []
+        rules = self._rules(emails)
+        unmatched = [email for email, rule in zip(emails, rules) if rule < 0]
+        if not unmatched:
+            # Nothing to seed from yet: record the rule labels and seed from later pages
+            self._assign(emails, [None] * len(emails), rules)
+            return
+        vectors = self.vectorizer.fit_transform(unmatched)
+        k = self.local.choose_k(max(self.expected or 0, len(unmatched)))
+        _, self.centroids = spherical_kmeans(vectors, k, seed=self.local.seed)
+        self.counts = [0] * len(self.centroids)
+        fresh = iter(vectors)
+        self._assign(emails, [next(fresh) if rule < 0 else None for rule in rules], rules)
+
+    def _assign(self, emails: List[EmailRecord], vectors: List[Optional[SparseVector]], rules: List[int]):
+        # Score against all centroids at once through an inverted index of their (truncated) terms
+        postings: Dict[int, List[Tuple[int, float]]] = {}
+        for label, c in enumerate(self.centroids):
+            for feature, weight in c.items():
+                postings.setdefault(feature, []).append((label, weight))
+
+        sums: Dict[int, SparseVector] = {}
+        batch_counts: Dict[int, int] = {}
+        for email, vector, rule in zip(emails, vectors, rules):
+            if rule >= 0:
+                # Rule labels are stored negated so they never collide with centroid labels
+                self.labels.append(-1 - rule)
+                continue
+            if vector is None:
+                label = self._source_labels[email.source]
+                self.labels.append(label)
+                batch_counts[label] = batch_counts.get(label, 0) + 1
+                continue
+            similarities = [0.0] * len(self.centroids)
+            for feature, weight in vector.items():
+                for label, centroid_weight in postings.get(feature, ()):
+                    similarities[label] += weight * centroid_weight
+            label = max(range(len(similarities)), key=similarities.__getitem__)
+            index = len(self.labels)
+            self.labels.append(label)
+            best = self._best.get(label)
+            if best is None or similarities[label] > best[0]:
+                self._best[label] = (similarities[label], index, email)
+            if email.source:
+                self._source_labels.setdefault(email.source, label)
+            acc = sums.setdefault(label, {})
+            for feature, weight in vector.items():
+                acc[feature] = acc.get(feature, 0.0) + weight
+            batch_counts[label] = batch_counts.get(label, 0) + 1
+
+        # Each centroid moves towards the page's members in proportion to how many it has absorbed so far
+        for label, count in batch_counts.items():
+            acc = sums.get(label)
+            if acc is None:
+                self.counts[label] += count
+                continue
+            previous = self.counts[label]
+            for feature, weight in self.centroids[label].items():
+                acc[feature] = acc.get(feature, 0.0) + weight * previous
+            self.centroids[label] = normalize(acc, CENTROID_TERMS)
+            self.counts[label] = previous + count
+
+        # Labels only ever come from centroid terms, so the term lookup stays as small as the centroids
+        self.vectorizer.retain_terms({feature for c in self.centroids for feature in c})
+
+    def finish(self) -> List[Dict[str, Any]]:
+        """Groups shaped like LocalClusterer.cluster, each also carrying its representative email"""
+        if self._pending:
+            self._seed_centroids()
+        if not self.labels:
+            return []
+
+        members: Dict[int, List[int]] = {}
+        ruled: Dict[int, List[int]] = {}
+        for i, label in enumerate(self.labels):
+            if label < 0:
+                ruled.setdefault(-1 - label, []).append(i)
+            else:
+                members.setdefault(label, []).append(i)
+
+        # Member vectors are gone, so outlier groups fold into the substantial group with the nearest centroid
+        min_size = max(2, int(sum(len(indices) for indices in members.values()) * self.local.min_group_fraction))
+        large = [label for label, indices in members.items() if len(indices) >= min_size]
+        if large:
+            for label in [label for label in members if label not in large]:
+                nearest = max(large, key=lambda c: dot(self.centroids[label], self.centroids[c]))
+                members[nearest].extend(members.pop(label))
+            for indices in members.values():
+                indices.sort()
+
+        groups = []
+        for label, indices in members.items():
+            _, representative, email = self._best[label]
+            groups.append({
+                "indices": indices,
+                "size": len(indices),
+                "representative": representative,
+                "representative_email": email,
+                "terms": self.vectorizer.top_terms(self.centroids[label]),
+                "centroid": self.centroids[label],
+            })
+        groups.sort(key=lambda g: len(g["indices"]), reverse=True)
+        groups.extend({"indices": indices, "size": len(indices), "rule": rule} for rule, indices in sorted(ruled.items()))
+        return groups
@@ -1,6 +1,6 @@
 from fasthtml.common import *
 import os
-import json
+import uuid
 
 # Load environment variables first
 try:
@@ -9,19 +9,65 @@ try:
 except ImportError:
     pass
 
-from gmail_client import GmailClient
 from email_clusterer import EmailClusterer
+from message_cache import init_message_cache
+from imap_pool import init_imap_pool
+from concurrency import ImapExecutor, request_limiter
+from jobs import JobManager
+from result_store import init_result_store, slim_result, indexed_result, cluster_members
+from llm_cache import init_llm_cache
+import llm
+from idle_listener import init_idle_listeners
+from fragment_cache import FragmentCache
+import metrics
 
 app, rt = fast_app()
+app.add_middleware(metrics.MetricsMiddleware)
 
-gmail_clients = {}
+imap_pool = init_imap_pool(init_message_cache())
+imap_executor = ImapExecutor(imap_pool)
+limiter = request_limiter()
+jobs = JobManager()
+result_store = init_result_store()
+fragments = FragmentCache()
+
+# Newest INBOX messages analysed per run; windows past CLUSTER_STREAM_THRESHOLD are streamed page by page
+MAX_ANALYSIS_WINDOW = 50000
+ANALYSIS_WINDOW = max(1, min(int(os.getenv("ANALYSIS_WINDOW", "200")), MAX_ANALYSIS_WINDOW))
+
+def stream_groups(client, clusterer, progress=None):
+    """Fetch the window a page at a time, grouping each page and keeping only its slim rows"""
+    grouper = clusterer.stream_grouper(ANALYSIS_WINDOW)
+    rows = []
+    for page in client.iter_recent_emails(ANALYSIS_WINDOW, progress):
+        grouper.add(page)
+        rows.extend(email.slim() for email in page)
+    return rows, grouper.finish()
+
+def precompute_clusters(client):
+    """Fetch and cluster on an IDLE listener's own connection when new mail arrives"""
+    clusterer = EmailClusterer()
+    if ANALYSIS_WINDOW > clusterer.stream_threshold:
+        rows, groups = stream_groups(client, clusterer)
+        return indexed_result(rows, clusterer.cluster_groups(groups, len(rows)))
+    emails = client.fetch_recent_emails(ANALYSIS_WINDOW)
+    clusters = clusterer.cluster_emails(emails, client.email_address) if emails else []
+    return slim_result(emails, clusters)
+
+idle_listeners = init_idle_listeners(precompute_clusters, imap_pool.has_account, imap_pool.cache)
+
+def session_key(session):
+    """Opaque per-browser key that server-side results are stored under"""
+    if 'sid' not in session:
+        session['sid'] = uuid.uuid4().hex
+    return session['sid']
 
 @rt("/")
 def get(session):
     return Titled("Email Cluster Manager",
         Div(
             H1("📧 Email Cluster Manager"),
-            P("Organize your last 200 emails into actionable groups"),
+            P(f"Organize your last {ANALYSIS_WINDOW} emails into actionable groups"),
             Div(
                 H2("Connect to Gmail"),
                 P("You'll need an App Password from Google:"),
@@ -46,8 +92,7 @@ def get(session):
 
 @rt("/connect", methods=["POST"])
 def connect_gmail(session, email: str, password: str):
-    client = GmailClient(email, password)
-    result = client.connect()
+    result = imap_pool.register(email, password)
     
     if not result["success"]:
         return Titled("Connection Error",
@@ -60,35 +105,88 @@ def connect_gmail(session, email: str, password: str):
             )
         )
     
-    session_id = f"{email}_{id(session)}"
-    gmail_clients[session_id] = client
-    session['gmail_session'] = session_id
+    session['gmail_account'] = email
+    idle_listeners.watch(email, password)
     
     return RedirectResponse("/analyze", status_code=302)
 
+async def run_analysis(job, owner):
+    account = job.account
+    clusterer = EmailClusterer()
+    streaming = ANALYSIS_WINDOW > clusterer.stream_threshold
+    
+    def progress(fetched, total):
+        job.update(fetched=fetched, total=total, message=f"Fetched {fetched} of {total} emails")
+    
+    def publish_preview(result):
+        job.preview = result_store.put(owner, result)
+        job.update(message="Showing a quick grouping while Claude refines it...")
+    
+    def fetch(client):
+        job.update(stage="fetching", message="Connected, fetching emails")
+        if streaming:
+            return stream_groups(client, clusterer, progress)
+        return client.fetch_recent_emails(ANALYSIS_WINDOW, progress=progress)
+    
+    # Only the IMAP work holds the account's slot; the LLM client bounds its own calls, and an
+    # archive for the same account should not wait behind a whole clustering
+    async with limiter.limit(account):
+        fetched = await imap_executor.run(account, fetch)
+    
+    if streaming:
+        rows, groups = fetched
+        if not rows:
+            return result_store.put(owner, indexed_result([], []))
+        job.update(stage="clustering", message=f"Labelling {len(groups)} groups of {len(rows)} emails with Claude...")
+        clusters = await clusterer.acluster_groups(groups, len(rows), on_preview=lambda clusters: publish_preview(indexed_result(rows, clusters)))
+        return result_store.put(owner, indexed_result(rows, clusters))
+    
+    emails = fetched
+    if not emails:
+        return result_store.put(owner, slim_result([], []))
+    
+    job.update(stage="clustering", message=f"Clustering {len(emails)} emails with Claude...")
+    clusters = await clusterer.acluster_emails(emails, account, on_preview=lambda clusters: publish_preview(slim_result(emails, clusters)))
+    return result_store.put(owner, slim_result(emails, clusters))
+
+def analysis_progress(job):
+    percent = int(100 * job.fetched / job.total) if job.total else 0
+    if job.stage == "clustering":
+        bar_style = "width: 100%; height: 100%; background: #4285f4; animation: loading 2s ease-in-out infinite;"
+    else:
+        bar_style = f"width: {percent}%; height: 100%; background: #4285f4; transition: width 0.5s;"
+    
+    return Div(
+        P(job.message, style="color: #666;"),
+        Div(
+            Div(style=bar_style),
+            style="width: 100%; height: 4px; background: #e0e0e0; border-radius: 2px; overflow: hidden;"
+        ),
+        id="analysis-progress",
+        hx_get="/analyze/status", hx_trigger="every 1s", hx_swap="outerHTML"
+    )
+
 @rt("/analyze")
-def analyze_emails(session):
-    session_id = session.get('gmail_session')
-    if not session_id or session_id not in gmail_clients:
+async def analyze_emails(session):
+    account = session.get('gmail_account')
+    if not imap_pool.has_account(account):
         return RedirectResponse("/", status_code=302)
     
-    client = gmail_clients[session_id]
+    owner = session_key(session)
+    warm = idle_listeners.warm_result(account)
+    if warm is not None:
+        job = jobs.complete(account, result_store.put(owner, warm), key=owner)
+        session['analysis_job'] = job.id
+        return RedirectResponse("/clusters", status_code=302)
+    
+    job = jobs.submit(account, lambda job: run_analysis(job, owner), key=owner)
+    session['analysis_job'] = job.id
     
     return Titled("Analyzing Emails",
         Div(
             H1("⏳ Analyzing Your Emails..."),
-            P("Fetching and clustering your last 200 emails. This may take a moment..."),
-            Div(
-                style="width: 100%; height: 4px; background: #e0e0e0; border-radius: 2px; overflow: hidden;",
-                children=[
-                    Div(style="width: 100%; height: 100%; background: #4285f4; animation: loading 2s ease-in-out infinite;")
-                ]
-            ),
-            Script("""
-                setTimeout(() => {
-                    window.location.href = '/clusters';
-                }, 2000);
-            """),
+            P(f"Fetching and clustering your last {ANALYSIS_WINDOW} emails. This may take a moment..."),
+            analysis_progress(job),
             Style("""
                 @keyframes loading {
                     0% { transform: translateX(-100%); }
@@ -100,17 +198,149 @@ def analyze_emails(session):
         )
     )
 
+@rt("/analyze/status")
+def analysis_status(session):
+    job = jobs.get(session.get('analysis_job'))
+    if job is None:
+        return Response(headers={"HX-Redirect": "/analyze"})
+    if job.finished or job.preview is not None:
+        return Response(headers={"HX-Redirect": "/clusters"})
+    return analysis_progress(job)
+
+# Emails shown per card up front, and per "more" click after that
+CARD_EMAILS = 5
+MORE_EMAILS_PAGE = 50
+
+PRIORITY_COLORS = {"high": "#dc3545", "medium": "#ffc107", "low": "#28a745"}
+
+CLUSTER_STYLES = Style("""
+    .cluster-card { background: white; padding: 20px; margin: 15px 0; border-radius: 10px; box-shadow: 0 2px 4px rgba(0,0,0,0.1); }
+    .cluster-card h3 { margin: 0 0 10px 0; }
+    .cluster-card .priority { color: white; padding: 3px 8px; border-radius: 3px; font-size: 11px; }
+    .cluster-card .count { margin-left: 10px; color: #666; }
+    .cluster-card .description { color: #333; margin: 10px 0; }
+    .email-list { background: #f8f9fa; border-radius: 5px; margin: 10px 0; max-height: 300px; overflow-y: auto; }
+    .email-row { padding: 8px; border-bottom: 1px solid #eee; }
+    .email-row p { margin: 0; font-size: 12px; }
+    .email-row .subject { font-size: 11px; color: #666; }
+    .more-emails { display: block; width: 100%; padding: 8px; font-style: italic; color: #666; font-size: 11px; background: none; border: none; cursor: pointer; text-align: left; }
+    .archive-button { padding: 10px 20px; background: #dc3545; color: white; border: none; border-radius: 5px; cursor: pointer; width: 100%; }
+    .archive-status { color: #dc3545; }
+    .cluster-archived { color: #28a745; text-align: center; }
+""")
+
+def archived_clusters(session, result_id):
+    """Indices of clusters already archived from this result during the session"""
+    archived = session.get('archived_clusters') or {}
+    return set(archived.get("clusters", [])) if archived.get("result") == result_id else set()
+
+def email_row(email):
+    return Div(
+        P(Strong((email.sender or "Unknown")[:40])),
+        P((email.subject or "No subject")[:60], cls="subject"),
+        cls="email-row"
+    )
+
+def more_emails_button(index, offset, remaining):
+    return Button(f"... and {remaining} more emails", cls="more-emails", type="button",
+                  hx_get=f"/clusters/{index}/emails?offset={offset}", hx_swap="outerHTML")
+
+def cluster_card(index, cluster, result, preview=False):
+    members = len(cluster["email_indices"])
+    count = cluster.get("count", 0)
+    priority = cluster.get("priority", "medium")
+    
+    email_list = [email_row(email) for email in cluster_members(result, cluster, 0, CARD_EMAILS)]
+    if members > CARD_EMAILS:
+        email_list.append(more_emails_button(index, CARD_EMAILS, members - CARD_EMAILS))
+    
+    return Div(
+        Div(
+            H3(cluster.get("name", "Unnamed Cluster")),
+            Span(f"Priority: {priority.upper()}", cls="priority", style=f"background: {PRIORITY_COLORS.get(priority, '#6c757d')};"),
+            Span(f" {count} emails", cls="count"),
+            style="margin-bottom: 10px;"
+        ),
+        P(cluster.get("description", "No description"), cls="description"),
+        Div(*email_list, cls="email-list"),
+        # Preview clusters are about to be replaced, so they cannot be archived yet
+        *(() if preview else (
+            Div(id=f"cluster-{index}-status", cls="archive-status"),
+            Form(
+                Input(type="hidden", name="cluster_index", value=str(index)),
+                Button(f"📁 Archive All {count} Emails", type="submit", cls="archive-button"),
+                method="post", action="/archive",
+                hx_post="/archive", hx_target=f"#cluster-{index}-status", hx_disabled_elt="find button"
+            ),
+        )),
+        id=f"cluster-{index}", cls="cluster-card"
+    )
+
+def clusters_view(session, result_id, result, preview=False):
+    """The cluster cards for a result; a preview polls for the final result and swaps itself out for it"""
+    clusters = result["clusters"]
+    archived = set() if preview else archived_clusters(session, result_id)
+    with metrics.span("render_clusters"):
+        cluster_divs = [
+            fragments.render((result_id, "card", i), lambda i=i, cluster=cluster: cluster_card(i, cluster, result, preview))
+            for i, cluster in enumerate(clusters) if i not in archived
+        ]
+    
+    status = P(f"Analyzed {result['email_count']} emails and grouped them into {len(clusters)} actionable clusters")
+    if preview:
+        status = Div(
+            P(f"Quick grouping of {result['email_count']} emails into {len(clusters)} clusters; Claude is refining it..."),
+            hx_get="/clusters/status", hx_trigger="every 1s", hx_target="#clusters-view", hx_swap="outerHTML"
+        )
+    
+    return Div(
+        H1("📊 Your Email Clusters"),
+        status,
+        Div(
+            *cluster_divs,
+            style="max-width: 800px; margin: 0 auto;"
+        ),
+        Div(
+            A("← Analyze Again", href="/analyze", style="color: #4285f4; margin: 20px;"),
+            style="text-align: center; margin: 40px 0;"
+        ),
+        id="clusters-view",
+        style="padding: 20px; background: #f5f5f5; min-height: 100vh;"
+    )
+
 @rt("/clusters")
 def show_clusters(session):
-    session_id = session.get('gmail_session')
-    if not session_id or session_id not in gmail_clients:
+    account = session.get('gmail_account')
+    if not imap_pool.has_account(account):
         return RedirectResponse("/", status_code=302)
     
-    client = gmail_clients[session_id]
+    job = jobs.get(session.get('analysis_job'))
+    if job is None:
+        return RedirectResponse("/analyze", status_code=302)
+    if not job.finished:
+        result = result_store.get(job.preview, session_key(session)) if job.preview else None
+        if result is None:
+            return RedirectResponse("/analyze", status_code=302)
+        session['result_id'] = job.preview
+        return Titled("Email Clusters", CLUSTER_STYLES, clusters_view(session, job.preview, result, preview=True))
     
-    emails = client.fetch_recent_emails(200)
+    if job.stage == "failed":
+        return Titled("Analysis Error",
+            Div(
+                H1("❌ Analysis Failed"),
+                P(f"Error: {job.error or 'Unknown error'}"),
+                A("Try Again", href="/analyze", style="color: #4285f4;"),
+                style="text-align: center; margin-top: 50px; padding: 20px;"
+            )
+        )
     
-    if not emails:
+    result = result_store.get(job.result, session_key(session))
+    if result is None:
+        return RedirectResponse("/analyze", status_code=302)
+    
+    session['result_id'] = job.result
+    
+    if not result["email_count"]:
         return Titled("No Emails",
             Div(
                 H1("📭 No Emails Found"),
@@ -120,110 +350,92 @@ def show_clusters(session):
             )
         )
     
-    clusterer = EmailClusterer()
-    clusters = clusterer.cluster_emails(emails)
-    
-    session['clusters'] = json.dumps(clusters, default=str)
-    
-    cluster_divs = []
-    for i, cluster in enumerate(clusters):
-        priority_color = {
-            "high": "#dc3545",
-            "medium": "#ffc107", 
-            "low": "#28a745"
-        }.get(cluster.get("priority", "medium"), "#6c757d")
-        
-        email_list = []
-        for email in cluster.get("emails", [])[:5]:
-            email_list.append(
-                Div(
-                    P(Strong(email.get("from", "Unknown")[:40]), style="margin: 0; font-size: 12px;"),
-                    P(email.get("subject", "No subject")[:60], style="margin: 0; font-size: 11px; color: #666;"),
-                    style="padding: 8px; border-bottom: 1px solid #eee;"
-                )
-            )
-        
-        if cluster.get("count", 0) > 5:
-            email_list.append(
-                P(f"... and {cluster.get('count', 0) - 5} more emails", 
-                  style="padding: 8px; font-style: italic; color: #666; font-size: 11px;")
-            )
-        
-        cluster_divs.append(
-            Div(
-                Div(
-                    H3(cluster.get("name", "Unnamed Cluster"), style="margin: 0 0 10px 0;"),
-                    Span(f"Priority: {cluster.get('priority', 'medium').upper()}", 
-                         style=f"background: {priority_color}; color: white; padding: 3px 8px; border-radius: 3px; font-size: 11px;"),
-                    Span(f" {cluster.get('count', 0)} emails", style="margin-left: 10px; color: #666;"),
-                    style="margin-bottom: 10px;"
-                ),
-                P(cluster.get("description", "No description"), style="color: #333; margin: 10px 0;"),
-                Div(*email_list, style="background: #f8f9fa; border-radius: 5px; margin: 10px 0; max-height: 300px; overflow-y: auto;"),
-                Form(
-                    Input(type="hidden", name="cluster_index", value=str(i)),
-                    Button(f"📁 Archive All {cluster.get('count', 0)} Emails", 
-                           type="submit",
-                           style="padding: 10px 20px; background: #dc3545; color: white; border: none; border-radius: 5px; cursor: pointer; width: 100%;"),
-                    method="post", action="/archive"
-                ),
-                style="background: white; padding: 20px; margin: 15px 0; border-radius: 10px; box-shadow: 0 2px 4px rgba(0,0,0,0.1);"
-            )
-        )
+    return Titled("Email Clusters", CLUSTER_STYLES, clusters_view(session, job.result, result))
+
+@rt("/clusters/status")
+def clusters_status(session):
+    """Polled by a preview: nothing until the job finishes, then the final clusters in its place"""
+    job = jobs.get(session.get('analysis_job'))
+    if job is not None and not job.finished:
+        return Response(status_code=204)
+    result = result_store.get(job.result, session_key(session)) if job is not None and job.stage == "done" else None
+    if result is None or not result["email_count"]:
+        return Response(headers={"HX-Redirect": "/clusters"})
+    session['result_id'] = job.result
+    return clusters_view(session, job.result, result)
+
+@rt("/clusters/{cluster_index}/emails")
+def more_emails(session, cluster_index: int, offset: int = CARD_EMAILS):
+    """The next page of a card's email rows, replacing its "... and N more" button"""
+    result_id = session.get('result_id')
+    result = result_store.get(result_id, session_key(session))
+    if result is None or not 0 <= cluster_index < len(result["clusters"]):
+        return ""
     
-    return Titled("Email Clusters",
-        Div(
-            H1("📊 Your Email Clusters"),
-            P(f"Analyzed {len(emails)} emails and grouped them into {len(clusters)} actionable clusters"),
-            Div(
-                *cluster_divs,
-                style="max-width: 800px; margin: 0 auto;"
-            ),
-            Div(
-                A("← Analyze Again", href="/", style="color: #4285f4; margin: 20px;"),
-                style="text-align: center; margin: 40px 0;"
-            ),
-            style="padding: 20px; background: #f5f5f5; min-height: 100vh;"
-        )
-    )
+    def build():
+        cluster = result["clusters"][cluster_index]
+        page = cluster_members(result, cluster, offset, offset + MORE_EMAILS_PAGE)
+        rows = [email_row(email) for email in page]
+        remaining = len(cluster["email_indices"]) - offset - len(page)
+        if remaining > 0:
+            rows.append(more_emails_button(cluster_index, offset + len(page), remaining))
+        return Div(*rows)
+    
+    return fragments.render((result_id, "emails", cluster_index, offset), build)
 
 @rt("/archive", methods=["POST"])
-def archive_cluster(session, cluster_index: str):
-    session_id = session.get('gmail_session')
-    if not session_id or session_id not in gmail_clients:
+async def archive_cluster(session, htmx: HtmxHeaders, cluster_index: str):
+    account = session.get('gmail_account')
+    if not imap_pool.has_account(account):
         return RedirectResponse("/", status_code=302)
-    
-    client = gmail_clients[session_id]
-    clusters_json = session.get('clusters', '[]')
-    clusters = json.loads(clusters_json)
+    result_id = session.get('result_id')
+    result = result_store.get(result_id, session_key(session))
+    clusters = result["clusters"] if result else []
     
     try:
         cluster_idx = int(cluster_index)
         if 0 <= cluster_idx < len(clusters):
             cluster = clusters[cluster_idx]
-            email_ids = [email.get("id") for email in cluster.get("emails", [])]
+            uids = [email.uid for email in cluster_members(result, cluster)]
             
-            result = client.archive_emails(email_ids)
+            async with limiter.limit(account):
+                archive_result = await imap_executor.run(account, lambda client: client.archive_emails(uids))
+            idle_listeners.invalidate(account)
             
-            if result["success"]:
+            if archive_result["success"]:
+                archived = archived_clusters(session, result_id) | {cluster_idx}
+                session['archived_clusters'] = {"result": result_id, "clusters": sorted(archived)}
+                message = f"Successfully archived {archive_result.get('archived', 0)} emails from '{cluster.get('name', 'cluster')}'"
+                if archive_result.get('flagged'):
+                    message += f" ({archive_result['flagged']} flagged for deletion; this server cannot expunge them individually)"
+                if htmx.request:
+                    # Replace the whole card rather than the status line it targeted
+                    return (
+                        Div(P(f"✅ {message}"), id=f"cluster-{cluster_idx}", cls="cluster-card cluster-archived"),
+                        HtmxResponseHeaders(retarget=f"#cluster-{cluster_idx}", reswap="outerHTML")
+                    )
                 return Titled("Success",
                     Div(
                         H1("✅ Emails Archived!"),
-                        P(f"Successfully archived {result.get('archived', 0)} emails from '{cluster.get('name', 'cluster')}'"),
+                        P(message),
                         A("← Back to Clusters", href="/clusters", style="color: #4285f4;"),
                         style="text-align: center; margin-top: 50px; padding: 20px;"
                     )
                 )
             else:
+                if htmx.request:
+                    return P(f"❌ Archive failed: {archive_result.get('error', 'Unknown error')}")
                 return Titled("Error",
                     Div(
                         H1("❌ Archive Failed"),
-                        P(f"Error: {result.get('error', 'Unknown error')}"),
+                        P(f"Error: {archive_result.get('error', 'Unknown error')}"),
                         A("← Back to Clusters", href="/clusters", style="color: #4285f4;"),
                         style="text-align: center; margin-top: 50px; padding: 20px;"
                     )
                 )
     except Exception as e:
+        if htmx.request:
+            return P(f"❌ Error processing request: {str(e)}")
         return Titled("Error",
             Div(
                 H1("❌ Error"),
@@ -237,7 +449,23 @@ def archive_cluster(session, cluster_index: str):
 
 @rt("/health")
 def health():
-    return {"status": "healthy"}
+    return {
+        "status": "healthy",
+        "llm": llm.llm_client.stats() if llm.llm_client else None,
+        "llm_cache": init_llm_cache().stats(),
+        "idle_listeners": idle_listeners.stats(),
+    }
+
+@rt("/metrics")
+def metrics_endpoint():
+    """Prometheus text exposition of pipeline counters, stage timings and pool gauges"""
+    for name, value in imap_pool.stats().items():
+        metrics.registry.set_gauge(f"imap_pool_{name}", value)
+    for name, value in idle_listeners.stats().items():
+        if name != "enabled":
+            metrics.registry.set_gauge(f"idle_listeners_{name}", value)
+    metrics.registry.set_gauge("fragment_cache_entries", fragments.stats()["entries"])
+    return Response(metrics.registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
 
 if __name__ == "__main__":
     serve()
\ No newline at end of file
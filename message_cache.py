@@ -0,0 +1,124 @@
+import os
+import sqlite3
+import threading
+from typing import List, Dict, Any, Optional, Iterable
+
+from email_record import EmailRecord
+
+class MessageCache:
+    """Persistent SQLite (WAL) cache of parsed messages keyed by (account, mailbox, UIDVALIDITY, UID).
+    Messages are stored as packed EmailRecord blobs; rows written as JSON by older versions still load."""
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path or os.getenv("EMAIL_CACHE_PATH", "email_cache.db")
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS mailbox_state (
+                account TEXT NOT NULL,
+                mailbox TEXT NOT NULL,
+                uidvalidity INTEGER NOT NULL,
+                uidnext INTEGER NOT NULL,
+                highestmodseq INTEGER,
+                message_count INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (account, mailbox)
+            );
+            CREATE TABLE IF NOT EXISTS messages (
+                account TEXT NOT NULL,
+                mailbox TEXT NOT NULL,
+                uidvalidity INTEGER NOT NULL,
+                uid INTEGER NOT NULL,
+                flags TEXT NOT NULL DEFAULT '',
+                data BLOB NOT NULL,
+                PRIMARY KEY (account, mailbox, uidvalidity, uid)
+            );
+        """)
+        self._conn.commit()
+
+    def get_state(self, account: str, mailbox: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT uidvalidity, uidnext, highestmodseq, message_count FROM mailbox_state WHERE account = ? AND mailbox = ?",
+                (account, mailbox)
+            ).fetchone()
+        if not row:
+            return None
+        return {"uidvalidity": row[0], "uidnext": row[1], "highestmodseq": row[2], "exists": row[3]}
+
+    def set_state(self, account: str, mailbox: str, state: Dict[str, Any]):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO mailbox_state VALUES (?, ?, ?, ?, ?, ?)",
+                (account, mailbox, state["uidvalidity"], state["uidnext"], state.get("highestmodseq"), state.get("exists", 0))
+            )
+            self._conn.commit()
+
+    def get_messages(self, account: str, mailbox: str, uidvalidity: int, uids: Optional[List[int]] = None) -> Dict[int, EmailRecord]:
+        """Cached messages by UID: the whole mailbox, or only `uids` when reading a window page by page"""
+        query = "SELECT uid, flags, data FROM messages WHERE account = ? AND mailbox = ? AND uidvalidity = ?"
+        params: List[Any] = [account, mailbox, uidvalidity]
+        if uids is not None:
+            query += f" AND uid IN ({','.join('?' * len(uids))})"
+            params.extend(uids)
+        with self._lock:
+            rows = self._conn.execute(query, params).fetchall()
+        messages = {}
+        for uid, flags, data in rows:
+            message = EmailRecord.unpack(data)
+            message.flags = flags
+            messages[uid] = message
+        return messages
+
+    def get_flags(self, account: str, mailbox: str, uidvalidity: int) -> Dict[int, str]:
+        """Flags of every cached message by UID, without loading the messages themselves"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT uid, flags FROM messages WHERE account = ? AND mailbox = ? AND uidvalidity = ?",
+                (account, mailbox, uidvalidity)
+            ).fetchall()
+        return dict(rows)
+
+    def put_messages(self, account: str, mailbox: str, uidvalidity: int, emails: List[EmailRecord]):
+        rows = [(account, mailbox, uidvalidity, int(e.uid), e.flags, e.pack()) for e in emails]
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?, ?)", rows)
+            self._conn.commit()
+
+    def update_flags(self, account: str, mailbox: str, uidvalidity: int, flags: Dict[int, str]):
+        with self._lock:
+            self._conn.executemany(
+                "UPDATE messages SET flags = ? WHERE account = ? AND mailbox = ? AND uidvalidity = ? AND uid = ?",
+                [(f, account, mailbox, uidvalidity, uid) for uid, f in flags.items()]
+            )
+            self._conn.commit()
+
+    def delete_messages(self, account: str, mailbox: str, uidvalidity: int, uids: Iterable[int]):
+        with self._lock:
+            self._conn.executemany(
+                "DELETE FROM messages WHERE account = ? AND mailbox = ? AND uidvalidity = ? AND uid = ?",
+                [(account, mailbox, uidvalidity, uid) for uid in uids]
+            )
+            self._conn.commit()
+
+    def invalidate(self, account: str, mailbox: str):
+        """Drop everything cached for a mailbox, e.g. after UIDVALIDITY changed"""
+        with self._lock:
+            self._conn.execute("DELETE FROM messages WHERE account = ? AND mailbox = ?", (account, mailbox))
+            self._conn.execute("DELETE FROM mailbox_state WHERE account = ? AND mailbox = ?", (account, mailbox))
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+# Global cache instance
+message_cache: Optional[MessageCache] = None
+
+def init_message_cache():
+    """Initialize global message cache"""
+    global message_cache
+    if message_cache is None:
+        message_cache = MessageCache()
+    return message_cache
@@ -0,0 +1,179 @@
+import os
+import time
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Any, List, Optional, Tuple
+
+# Histogram bucket upper bounds in seconds, from a cache hit up to a slow LLM call
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+# Spans finished during the current request, for the optional Server-Timing header
+_request_spans: ContextVar[Optional[List[Tuple[str, float]]]] = ContextVar("request_spans", default=None)
+
+def _label_key(labels: Dict[str, Any]) -> LabelKey:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+def _format_labels(key: LabelKey, extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(key) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    escaped = (v.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+class MetricsRegistry:
+    """Thread-safe counters, gauges and histograms rendered in the Prometheus text format"""
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self._counters: Dict[str, Dict[LabelKey, float]] = {}
+        self._gauges: Dict[str, Dict[LabelKey, float]] = {}
+        self._histograms: Dict[str, Dict[LabelKey, List[float]]] = {}
+        self._help: Dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def describe(self, name: str, help_text: str):
+        self._help[name] = help_text
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def set_gauge(self, name: str, value: float, **labels):
+        with self._lock:
+            self._gauges.setdefault(name, {})[_label_key(labels)] = value
+
+    def observe(self, name: str, value: float, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            # Per-bucket counts, then sum and count
+            state = series.get(key)
+            if state is None:
+                state = series[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[i] += 1
+                    break
+            state[-2] += value
+            state[-1] += 1
+
+    @contextmanager
+    def span(self, stage: str):
+        """Time a pipeline stage into stage_duration_seconds and the current request's timings"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.observe("stage_duration_seconds", elapsed, stage=stage)
+            spans = _request_spans.get()
+            if spans is not None:
+                spans.append((stage, elapsed))
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            for kind, metrics in (("counter", self._counters), ("gauge", self._gauges)):
+                for name in sorted(metrics):
+                    lines.extend(self._header(name, kind))
+                    for key, value in sorted(metrics[name].items()):
+                        lines.append(f"{name}{_format_labels(key)} {value:g}")
+            for name in sorted(self._histograms):
+                lines.extend(self._header(name, "histogram"))
+                for key, state in sorted(self._histograms[name].items()):
+                    cumulative = 0
+                    for bound, count in zip(self.buckets, state):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{_format_labels(key, ('le', f'{bound:g}'))} {cumulative}")
+                    lines.append(f"{name}_bucket{_format_labels(key, ('le', '+Inf'))} {state[-1]}")
+                    lines.append(f"{name}_sum{_format_labels(key)} {state[-2]:.6f}")
+                    lines.append(f"{name}_count{_format_labels(key)} {state[-1]}")
+        return "\n".join(lines) + "\n"
+
+    def _header(self, name: str, kind: str) -> List[str]:
+        help_text = self._help.get(name)
+        return ([f"# HELP {name} {help_text}"] if help_text else []) + [f"# TYPE {name} {kind}"]
+
+# Process-wide registry; modules record into it through the helpers below
+registry = MetricsRegistry()
+
+registry.describe("stage_duration_seconds", "Time spent in each pipeline stage")
+registry.describe("http_request_duration_seconds", "Time to the start of the response, per route")
+registry.describe("imap_bytes_fetched_total", "Message bytes received in FETCH literals")
+registry.describe("messages_parsed_total", "Messages parsed from FETCH responses")
+registry.describe("messages_archived_total", "Messages moved out of INBOX")
+registry.describe("imap_sync_total", "Cached mailbox syncs by path taken")
+registry.describe("imap_throttled_total", "FETCH commands the server throttled or refused for load")
+registry.describe("llm_calls_total", "LLM calls by clustering stage and outcome")
+registry.describe("llm_retries_total", "LLM calls retried after a connection error, timeout, rate limit or server error")
+registry.describe("llm_recovered_items_total", "Items an LLM reply left unassigned and sent back in a recovery request")
+registry.describe("llm_tokens_total", "LLM tokens reported by the API, by direction")
+registry.describe("cache_lookups_total", "Cache lookups by cache and result")
+registry.describe("cluster_fallbacks_total", "Times clustering fell back from the LLM, by reason")
+registry.describe("cluster_previews_total", "Local clusterings shown while the LLM result was still pending")
+registry.describe("messages_collapsed_total", "Messages folded into a bulk sender's entry before clustering")
+registry.describe("messages_preclassified_total", "Messages placed by a rule or the sender/thread graph before clustering, by source")
+
+def inc(name: str, value: float = 1, **labels):
+    registry.inc(name, value, **labels)
+
+def observe(name: str, value: float, **labels):
+    registry.observe(name, value, **labels)
+
+def span(stage: str):
+    return registry.span(stage)
+
+class MetricsMiddleware:
+    """ASGI middleware timing every request, optionally adding a Server-Timing header with its stage spans"""
+
+    def __init__(self, app, timing_header: Optional[bool] = None):
+        self.app = app
+        if timing_header is None:
+            timing_header = os.getenv("METRICS_TIMING_HEADER", "false").lower() in ("1", "true", "yes")
+        self.timing_header = timing_header
+        self._routes: Dict[Any, str] = {}
+
+    def _route(self, scope) -> str:
+        """The matched route's path template, so label values stay bounded"""
+        endpoint = scope.get("endpoint")
+        router = scope.get("router")
+        if endpoint is None or router is None:
+            return "unmatched"
+        path = self._routes.get(endpoint)
+        if path is None:
+            path = next((getattr(r, "path", None) for r in router.routes if getattr(r, "endpoint", None) is endpoint), None) or "unmatched"
+            self._routes[endpoint] = path
+        return path
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        start = time.perf_counter()
+        spans: List[Tuple[str, float]] = []
+        token = _request_spans.set(spans)
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                elapsed = time.perf_counter() - start
+                registry.observe("http_request_duration_seconds", elapsed, route=self._route(scope), method=scope["method"])
+                if self.timing_header:
+                    totals: Dict[str, float] = {}
+                    for stage, seconds in spans:
+                        totals[stage] = totals.get(stage, 0.0) + seconds
+                    timings = [f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in totals.items()]
+                    timings.append(f"total;dur={elapsed * 1000:.1f}")
+                    headers = list(message.get("headers", []))
+                    headers.append((b"server-timing", ", ".join(timings).encode("latin-1")))
+                    message = dict(message, headers=headers)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _request_spans.reset(token)
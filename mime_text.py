@@ -0,0 +1,145 @@
+import os
+import quopri
+import binascii
+from email.message import Message
+from email.parser import BytesHeaderParser
+from html.parser import HTMLParser
+from typing import Optional, Tuple, Iterator
+
+# Max decoded bytes of body text kept per message
+BODY_LIMIT = int(os.getenv("EMAIL_BODY_LIMIT", "4096"))
+# HTML source read per byte of text wanted, since markup inflates it
+HTML_SOURCE_FACTOR = 8
+MAX_MULTIPART_DEPTH = 5
+
+_SKIP_TAGS = frozenset(("script", "style", "head", "title", "noscript"))
+_BLOCK_TAGS = frozenset(("p", "div", "br", "tr", "li", "td", "th", "h1", "h2", "h3", "h4", "table", "section"))
+
+_header_parser = BytesHeaderParser()
+
+def extract_text(raw: bytes, limit: Optional[int] = None) -> str:
+    """Return up to `limit` bytes of body text from a raw (possibly truncated) RFC822 message.
+
+    Parts are located by scanning for boundaries, so attachments are skipped without being
+    decoded. The first text/plain part wins; otherwise the first text/html part is converted."""
+    limit = limit or BODY_LIMIT
+    headers, body_start = _split_headers(raw, 0, len(raw))
+    text, html = _scan(raw, body_start, len(raw), headers, limit, 0)
+    if text is not None:
+        return text
+    if html is not None:
+        return html_to_text(html, limit)
+    return ""
+
+def _split_headers(raw: bytes, start: int, end: int) -> Tuple[Message, int]:
+    crlf = raw.find(b"\r\n\r\n", start, end)
+    lf = raw.find(b"\n\n", start, end)
+    if crlf != -1 and (lf == -1 or crlf <= lf):
+        header_end, body_start = crlf, crlf + 4
+    elif lf != -1:
+        header_end, body_start = lf, lf + 2
+    else:
+        header_end, body_start = end, end
+    return _header_parser.parsebytes(raw[start:header_end]), body_start
+
+def _iter_parts(raw: bytes, start: int, end: int, boundary: bytes) -> Iterator[Tuple[int, int]]:
+    delimiter = b"--" + boundary
+    pos = raw.find(delimiter, start, end)
+    while pos != -1:
+        if raw.startswith(b"--", pos + len(delimiter)):
+            return
+        line_end = raw.find(b"\n", pos, end)
+        if line_end == -1:
+            return
+        part_start = line_end + 1
+
+        nxt = raw.find(b"\n" + delimiter, part_start - 1, end)
+        if nxt == -1:
+            yield part_start, end
+            return
+        part_end = nxt - 1 if nxt > part_start and raw[nxt - 1:nxt] == b"\r" else nxt
+        yield part_start, max(part_start, part_end)
+        pos = nxt + 1
+
+def _scan(raw: bytes, start: int, end: int, headers: Message, limit: int, depth: int) -> Tuple[Optional[str], Optional[str]]:
+    if headers.get_content_disposition() == "attachment":
+        return None, None
+
+    content_type = headers.get_content_type()
+    if content_type.startswith("multipart/"):
+        boundary = headers.get_param("boundary")
+        if not boundary or depth >= MAX_MULTIPART_DEPTH:
+            return None, None
+        html = None
+        for part_start, part_end in _iter_parts(raw, start, end, boundary.encode("ascii", "ignore")):
+            part_headers, body_start = _split_headers(raw, part_start, part_end)
+            text, part_html = _scan(raw, body_start, part_end, part_headers, limit, depth + 1)
+            if text is not None:
+                return text, None
+            if html is None:
+                html = part_html
+        return None, html
+
+    if content_type == "text/plain":
+        return _decode(raw, start, end, headers, limit), None
+    if content_type == "text/html":
+        return None, _decode(raw, start, end, headers, limit * HTML_SOURCE_FACTOR)
+    return None, None
+
+def _decode(raw: bytes, start: int, end: int, headers: Message, limit: int) -> str:
+    encoding = (headers.get("Content-Transfer-Encoding") or "").strip().lower()
+    try:
+        if encoding == "base64":
+            data = b"".join(raw[start:min(end, start + limit * 2)].split())
+            payload = binascii.a2b_base64(data[:len(data) // 4 * 4])
+        elif encoding == "quoted-printable":
+            payload = quopri.decodestring(raw[start:min(end, start + limit * 3)])
+        else:
+            payload = raw[start:min(end, start + limit)]
+    except (binascii.Error, ValueError):
+        return ""
+
+    payload = payload[:limit]
+    charset = headers.get_content_charset() or "utf-8"
+    try:
+        return payload.decode(charset, errors="ignore")
+    except LookupError:
+        return payload.decode("utf-8", errors="ignore")
+
+class _TextExtractor(HTMLParser):
+    def __init__(self, limit: int):
+        super().__init__(convert_charrefs=True)
+        self.limit = limit
+        self.parts = []
+        self.size = 0
+        self.skipping = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in _SKIP_TAGS:
+            self.skipping += 1
+        elif tag in _BLOCK_TAGS:
+            self.parts.append(" ")
+
+    def handle_endtag(self, tag):
+        if tag in _SKIP_TAGS and self.skipping:
+            self.skipping -= 1
+
+    def handle_data(self, data):
+        if not self.skipping and self.size < self.limit:
+            self.parts.append(data)
+            self.size += len(data)
+
+def html_to_text(html: str, limit: Optional[int] = None) -> str:
+    """Visible text of an HTML fragment; input is capped so the work is linear and bounded"""
+    limit = limit or BODY_LIMIT
+    html = html[:limit * HTML_SOURCE_FACTOR]
+    parser = _TextExtractor(limit)
+    try:
+        for i in range(0, len(html), 4096):
+            parser.feed(html[i:i + 4096])
+            if parser.size >= limit:
+                break
+        parser.close()
+    except Exception:
+        pass
+    return "".join(parser.parts)[:limit]
@@ -0,0 +1,205 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+import struct
+import threading
+from array import array
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional
+
+from email_record import EmailRecord, pack_records, unpack_records
+
+_RESULT_HEADER = struct.Struct("<II")
+
+def slim_result(emails: List[EmailRecord], clusters: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Strip emails down to what rendering and archiving need before storing a result"""
+    return indexed_result([email.slim() for email in emails], clusters)
+
+def indexed_result(rows: List[EmailRecord], clusters: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Build a result from slim rows and clusters that reference them by email_indices.
+    Each email is stored once; clusters keep their members as compact index arrays."""
+    slim_clusters = []
+    for cluster in clusters:
+        slim = {k: v for k, v in cluster.items() if k != "email_indices"}
+        slim["email_indices"] = array("I", (idx for idx in cluster["email_indices"] if 0 <= idx < len(rows)))
+        slim_clusters.append(slim)
+    return {"email_count": len(rows), "emails": rows, "clusters": slim_clusters}
+
+def cluster_members(result: Dict[str, Any], cluster: Dict[str, Any], start: int = 0, stop: Optional[int] = None) -> List[EmailRecord]:
+    """The stored emails of one cluster, optionally just a slice of them"""
+    emails = result["emails"]
+    return [emails[idx] for idx in cluster["email_indices"][start:stop]]
+
+def result_size(result: Dict[str, Any]) -> int:
+    """Approximate bytes held by a result, for the store's size cap"""
+    indices = sum(len(c["email_indices"]) * c["email_indices"].itemsize for c in result["clusters"])
+    return sum(email.size() for email in result["emails"]) + indices
+
+def pack_result(result: Dict[str, Any]) -> bytes:
+    """Binary form for SqliteResultStore: JSON cluster metadata, packed records, then the index arrays"""
+    meta = {
+        "email_count": result["email_count"],
+        "clusters": [{k: v for k, v in c.items() if k != "email_indices"} for c in result["clusters"]],
+        "index_counts": [len(c["email_indices"]) for c in result["clusters"]],
+    }
+    meta_bytes = json.dumps(meta, default=str).encode("utf-8")
+    records = pack_records(result["emails"])
+    indices = b"".join(c["email_indices"].tobytes() for c in result["clusters"])
+    return _RESULT_HEADER.pack(len(meta_bytes), len(records)) + meta_bytes + records + indices
+
+def unpack_result(data: bytes) -> Dict[str, Any]:
+    meta_len, records_len = _RESULT_HEADER.unpack_from(data)
+    pos = _RESULT_HEADER.size
+    meta = json.loads(data[pos:pos + meta_len])
+    pos += meta_len
+    emails = unpack_records(data[pos:pos + records_len])
+    pos += records_len
+    for cluster, count in zip(meta["clusters"], meta["index_counts"]):
+        indices = array("I")
+        indices.frombytes(data[pos:pos + count * indices.itemsize])
+        pos += count * indices.itemsize
+        cluster["email_indices"] = indices
+    return {"email_count": meta["email_count"], "emails": emails, "clusters": meta["clusters"]}
+
+class ResultStore:
+    """In-process LRU of cluster results with a TTL, an entry cap and a size cap"""
+
+    def __init__(self, max_entries: Optional[int] = None, max_bytes: Optional[int] = None, ttl: Optional[float] = None):
+        self.max_entries = max_entries or int(os.getenv("RESULT_STORE_MAX_ENTRIES", "500"))
+        self.max_bytes = max_bytes or int(os.getenv("RESULT_STORE_MAX_BYTES", str(64 * 1024 * 1024)))
+        self.ttl = ttl or float(os.getenv("RESULT_STORE_TTL", "3600"))
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._owners: Dict[str, str] = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def put(self, owner: str, result: Dict[str, Any]) -> str:
+        """Store a result for an owner (session), replacing the owner's previous result"""
+        result_id = uuid.uuid4().hex
+        size = result_size(result)
+        with self._lock:
+            previous = self._owners.get(owner)
+            if previous:
+                self._remove(previous)
+            self._entries[result_id] = {"owner": owner, "result": result, "size": size, "created_at": time.time()}
+            self._owners[owner] = result_id
+            self._bytes += size
+            self._evict()
+        return result_id
+
+    def get(self, result_id: Optional[str], owner: str) -> Optional[Dict[str, Any]]:
+        if not result_id:
+            return None
+        with self._lock:
+            entry = self._entries.get(result_id)
+            if entry is None or entry["owner"] != owner:
+                return None
+            if time.time() - entry["created_at"] > self.ttl:
+                self._remove(result_id)
+                return None
+            self._entries.move_to_end(result_id)
+            return entry["result"]
+
+    def delete(self, result_id: str):
+        with self._lock:
+            self._remove(result_id)
+
+    def _remove(self, result_id: str):
+        entry = self._entries.pop(result_id, None)
+        if entry is None:
+            return
+        self._bytes -= entry["size"]
+        if self._owners.get(entry["owner"]) == result_id:
+            del self._owners[entry["owner"]]
+
+    def _evict(self):
+        cutoff = time.time() - self.ttl
+        for result_id, entry in list(self._entries.items()):
+            if entry["created_at"] < cutoff:
+                self._remove(result_id)
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            self._remove(next(iter(self._entries)))
+
+class SqliteResultStore:
+    """SQLite-backed result store with the same interface, for results that should survive restarts"""
+
+    def __init__(self, path: Optional[str] = None, max_entries: Optional[int] = None, max_bytes: Optional[int] = None, ttl: Optional[float] = None):
+        self.path = path or os.getenv("RESULT_STORE_PATH", "results.db")
+        self.max_entries = max_entries or int(os.getenv("RESULT_STORE_MAX_ENTRIES", "500"))
+        self.max_bytes = max_bytes or int(os.getenv("RESULT_STORE_MAX_BYTES", str(64 * 1024 * 1024)))
+        self.ttl = ttl or float(os.getenv("RESULT_STORE_TTL", "3600"))
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS results (
+                id TEXT PRIMARY KEY,
+                owner TEXT NOT NULL,
+                data BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS results_owner ON results (owner);
+            CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed_at);
+        """)
+        self._conn.commit()
+
+    def put(self, owner: str, result: Dict[str, Any]) -> str:
+        result_id = uuid.uuid4().hex
+        data = pack_result(result)
+        now = time.time()
+        with self._lock:
+            self._conn.execute("DELETE FROM results WHERE owner = ?", (owner,))
+            self._conn.execute("INSERT INTO results VALUES (?, ?, ?, ?, ?, ?)", (result_id, owner, data, len(data), now, now))
+            self._evict(now)
+            self._conn.commit()
+        return result_id
+
+    def get(self, result_id: Optional[str], owner: str) -> Optional[Dict[str, Any]]:
+        if not result_id:
+            return None
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT data FROM results WHERE id = ? AND owner = ? AND created_at >= ?",
+                (result_id, owner, now - self.ttl)
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute("UPDATE results SET accessed_at = ? WHERE id = ?", (now, result_id))
+            self._conn.commit()
+        return unpack_result(row[0])
+
+    def delete(self, result_id: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM results WHERE id = ?", (result_id,))
+            self._conn.commit()
+
+    def _evict(self, now: float):
+        self._conn.execute("DELETE FROM results WHERE created_at < ?", (now - self.ttl,))
+        count, total = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results").fetchone()
+        if count <= self.max_entries and total <= self.max_bytes:
+            return
+        for result_id, size in self._conn.execute("SELECT id, size FROM results ORDER BY accessed_at").fetchall():
+            if count <= self.max_entries and total <= self.max_bytes:
+                break
+            self._conn.execute("DELETE FROM results WHERE id = ?", (result_id,))
+            count -= 1
+            total -= size
+
+# Global store instance
+result_store = None
+
+def init_result_store():
+    """Initialize global result store (RESULT_STORE_BACKEND=memory|sqlite)"""
+    global result_store
+    if result_store is None:
+        if os.getenv("RESULT_STORE_BACKEND", "memory") == "sqlite":
+            result_store = SqliteResultStore()
+        else:
+            result_store = ResultStore()
+    return result_store
@@ -0,0 +1,250 @@
+import os
+import re
+import json
+import hashlib
+from email.utils import parseaddr
+from typing import List, Dict, Any, Optional, Tuple, Iterable
+
+from email_record import EmailRecord
+
+# Stand-ins for the LLM when it is unavailable or fails; with CLUSTER_RULES_PRECLUSTER_DEFAULTS they also pre-classify
+DEFAULT_RULES: List[Dict[str, Any]] = [
+    {
+        "name": "Newsletters & Updates",
+        "description": "Marketing emails and newsletters - consider unsubscribing from unwanted ones",
+        "action": "Archive",
+        "priority": "low",
+        "match": {
+            "from": ["newsletter", "digest", "update", "weekly", "daily", "unsubscribe"],
+            "subject": ["newsletter", "digest", "update", "weekly", "daily", "unsubscribe"],
+            "list_id": ["*"],
+            "unsubscribe": True,
+        },
+    },
+    {
+        "name": "Automated Notifications",
+        "description": "System notifications and automated messages",
+        "action": "Archive",
+        "priority": "low",
+        "match": {
+            "from": ["notification", "alert", "noreply", "no-reply", "automated"],
+            "precedence": ["bulk", "junk", "auto_reply"],
+        },
+    },
+    {
+        "name": "Personal Emails",
+        "description": "Emails from individuals - review for important messages",
+        "action": "Review",
+        "priority": "high",
+        "match": {"domain": ["gmail.com", "yahoo.com", "outlook.com"]},
+    },
+]
+
+OTHER_CLUSTER = {
+    "name": "Other Emails",
+    "description": "Miscellaneous emails to review",
+    "action": "Review",
+    "priority": "medium",
+}
+
+# Substring fields are matched with one compiled pattern each; the rest by exact or domain-suffix lookup
+TEXT_FIELDS = ("from", "subject")
+SUFFIX_FIELDS = ("domain", "list_id")
+FIELDS = TEXT_FIELDS + SUFFIX_FIELDS + ("precedence", "unsubscribe")
+
+# Distinct senders remembered with their From/domain hits before the memo is reset
+_SENDER_MEMO_SIZE = 10000
+
+def _trie_pattern(words: Iterable[str]) -> str:
+    """One regex alternation for many literals, factored into a prefix tree so each position is tried once;
+    at a given position it matches the longest of the words starting there"""
+    trie: Dict[str, Any] = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[""] = {}
+
+    def build(node: Dict[str, Any]) -> str:
+        end = "" in node
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ""
+        body = branches[0] if len(branches) == 1 and (not end or len(branches[0]) == 1) else f"(?:{'|'.join(branches)})"
+        return f"{body}?" if end else body
+
+    return build(trie)
+
+def _suffixes(domain: str) -> List[str]:
+    """news.example.com -> news.example.com, example.com, com"""
+    labels = domain.split(".")
+    return [".".join(labels[i:]) for i in range(len(labels))]
+
+class Rule:
+    def __init__(self, spec: Dict[str, Any], precluster: bool):
+        self.name = spec["name"]
+        self.description = spec.get("description", "")
+        self.action = spec.get("action", "Review")
+        self.priority = spec.get("priority", "medium")
+        self.require_all = spec.get("mode", "any") == "all"
+        self.precluster = spec.get("precluster", precluster)
+        self.match = spec.get("match", {})
+        unknown = set(self.match) - set(FIELDS)
+        if unknown:
+            raise ValueError(f"rule {self.name!r} matches unknown fields {sorted(unknown)}")
+        # One bit per condition, assigned by RuleEngine
+        self.mask = 0
+
+    def matches(self, hits: int) -> bool:
+        if self.require_all:
+            return hits & self.mask == self.mask
+        return bool(hits & self.mask)
+
+class RuleEngine:
+    """User and default rules compiled into a single matcher. Each (rule, field) condition is a bit;
+    one pass over an email's fields collects the bits it hits and the first satisfied rule wins.
+
+    A rule's `match` maps fields to patterns and matches when any field does (all, with "mode": "all"):
+    from/subject - case-insensitive substrings; domain/list_id - the sender domain or List-Id, or a
+    parent domain of it ("*" for any List-Id); precedence - Precedence header values; unsubscribe - true
+    when a List-Unsubscribe header is present."""
+
+    def __init__(self, rules: Optional[List[Dict[str, Any]]] = None, defaults: Optional[List[Dict[str, Any]]] = None, precluster_defaults: bool = False):
+        rules = rules or []
+        defaults = DEFAULT_RULES if defaults is None else defaults
+        self.rules = [Rule(spec, True) for spec in rules] + [Rule(spec, precluster_defaults) for spec in defaults]
+        # Part of clustering cache keys, so editing rules invalidates results they shaped
+        self.fingerprint = hashlib.sha256(json.dumps([rules, defaults, precluster_defaults], sort_keys=True).encode()).hexdigest()[:16]
+
+        keywords: Dict[str, Dict[str, int]] = {field: {} for field in TEXT_FIELDS}
+        self._lookups: Dict[str, Dict[str, int]] = {field: {} for field in SUFFIX_FIELDS + ("precedence",)}
+        self._unsubscribe = 0
+        bit = 1
+        for rule in self.rules:
+            for field, patterns in rule.match.items():
+                rule.mask |= bit
+                if field == "unsubscribe":
+                    if patterns:
+                        self._unsubscribe |= bit
+                else:
+                    table = keywords[field] if field in TEXT_FIELDS else self._lookups[field]
+                    for pattern in ([patterns] if isinstance(patterns, str) else patterns):
+                        pattern = pattern.strip().lower()
+                        if pattern:
+                            table[pattern] = table.get(pattern, 0) | bit
+                bit <<= 1
+
+        # A match at a position is the longest keyword starting there, so it also carries the bits of
+        # every keyword that is a prefix of it
+        self._patterns: Dict[str, Optional[re.Pattern]] = {}
+        self._keyword_masks: Dict[str, Dict[str, int]] = {}
+        for field, table in keywords.items():
+            masks = {}
+            for word in table:
+                mask = 0
+                for other, other_mask in table.items():
+                    if word.startswith(other):
+                        mask |= other_mask
+                masks[word] = mask
+            self._keyword_masks[field] = masks
+            self._patterns[field] = re.compile(f"(?=({_trie_pattern(table)}))") if table else None
+
+        self._precluster = [i for i, rule in enumerate(self.rules) if rule.precluster]
+        self._sender_hits: Dict[str, int] = {}
+
+    def _text_hits(self, field: str, text: str) -> int:
+        pattern = self._patterns[field]
+        if pattern is None or not text:
+            return 0
+        masks = self._keyword_masks[field]
+        hits = 0
+        for word in pattern.findall(text.lower()):
+            hits |= masks[word]
+        return hits
+
+    def _from_hits(self, sender: str) -> int:
+        hits = self._sender_hits.get(sender)
+        if hits is None:
+            hits = self._text_hits("from", sender)
+            domain = parseaddr(sender)[1].lower().partition("@")[2]
+            if domain and self._lookups["domain"]:
+                for suffix in _suffixes(domain):
+                    hits |= self._lookups["domain"].get(suffix, 0)
+            if len(self._sender_hits) >= _SENDER_MEMO_SIZE:
+                self._sender_hits.clear()
+            self._sender_hits[sender] = hits
+        return hits
+
+    def match(self, email: EmailRecord, fallback: bool = False) -> int:
+        """Index of the first rule the email satisfies, or -1. Only pre-classifying rules are considered
+        unless `fallback`, when every rule is."""
+        hits = self._from_hits(email.sender) | self._text_hits("subject", email.subject)
+        lists = self._lookups["list_id"]
+        if lists and email.source.startswith("list:"):
+            hits |= lists.get("*", 0)
+            for suffix in _suffixes(email.source[5:]):
+                hits |= lists.get(suffix, 0)
+        if email.precedence:
+            hits |= self._lookups["precedence"].get(email.precedence.strip().lower(), 0)
+        if email.list_unsubscribe:
+            hits |= self._unsubscribe
+        if not hits:
+            return -1
+
+        for i in (range(len(self.rules)) if fallback else self._precluster):
+            if self.rules[i].matches(hits):
+                return i
+        return -1
+
+    def partition(self, emails: List[EmailRecord], fallback: bool = False) -> Tuple[Dict[int, List[int]], List[int]]:
+        """Positions of matched emails per rule index, and positions of the emails no rule matched"""
+        matched: Dict[int, List[int]] = {}
+        rest = []
+        for i, email in enumerate(emails):
+            rule = self.match(email, fallback)
+            if rule < 0:
+                rest.append(i)
+            else:
+                matched.setdefault(rule, []).append(i)
+        return matched, rest
+
+    def cluster(self, rule: int, indices: List[int]) -> Dict[str, Any]:
+        spec = self.rules[rule]
+        return {
+            "name": spec.name,
+            "description": spec.description,
+            "action": spec.action,
+            "email_indices": indices,
+            "count": len(indices),
+            "priority": spec.priority,
+        }
+
+    def clusters(self, matched: Dict[int, List[int]]) -> List[Dict[str, Any]]:
+        """Clusters for partition() output, in rule order"""
+        return [self.cluster(rule, matched[rule]) for rule in sorted(matched)]
+
+def load_rules(path: Optional[str] = None) -> List[Dict[str, Any]]:
+    """User rules from a JSON list of rule objects; a missing file means no user rules"""
+    path = path or os.getenv("CLUSTER_RULES_PATH", "cluster_rules.json")
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        rules = json.load(f)
+    if not isinstance(rules, list):
+        raise ValueError(f"{path} must contain a list of rules")
+    return rules
+
+# Global rule engine instance
+rule_engine: Optional[RuleEngine] = None
+
+def init_rule_engine():
+    """Initialize global rule engine"""
+    global rule_engine
+    if rule_engine is None:
+        precluster_defaults = os.getenv("CLUSTER_RULES_PRECLUSTER_DEFAULTS", "false").lower() == "true"
+        try:
+            rule_engine = RuleEngine(load_rules(), precluster_defaults=precluster_defaults)
+        except Exception as e:
+            print(f"Error loading cluster rules, using defaults: {e}")
+            rule_engine = RuleEngine(precluster_defaults=precluster_defaults)
+    return rule_engine
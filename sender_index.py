@@ -0,0 +1,71 @@
+import re
+from array import array
+from email.utils import parseaddr
+from typing import List, Dict, Optional
+
+from email_record import EmailRecord
+
+# Local parts automated mail is sent from even without list headers
+_AUTOMATED_RE = re.compile(r"(^|[-_.+])(no-?reply|do-?not-?reply|notifications?|alerts?|mailer-daemon|newsletters?|digest|updates|news)([-_.+]|$)")
+# Per-message bounce addresses (bounce+a1b2c3@, msg-48213@) differ per message, so these collapse by domain
+_VERP_RE = re.compile(r"[+=]|\d{4,}|[0-9a-f]{12,}")
+_LIST_ID_RE = re.compile(r"<([^>]+)>")
+
+def bulk_source(sender: str, list_id: Optional[str] = None, list_unsubscribe: Optional[str] = None, precedence: Optional[str] = None) -> str:
+    """Aggregation key for mail sent in bulk: list:<List-Id>, sender:<address> or domain:<domain>.
+    Person-to-person mail gets "" and is never collapsed."""
+    if list_id:
+        match = _LIST_ID_RE.search(list_id)
+        return "list:" + (match.group(1) if match else list_id).strip().lower()
+
+    address = parseaddr(sender)[1].lower()
+    local, _, domain = address.partition("@")
+    bulk = bool(list_unsubscribe) or (precedence or "").strip().lower() in ("bulk", "list", "junk") or bool(_AUTOMATED_RE.search(local))
+    if not bulk or not domain:
+        return ""
+    if _VERP_RE.search(local):
+        return f"domain:{domain}"
+    return f"sender:{address}"
+
+class SenderIndex:
+    """Collapses messages from the same bulk source into one weighted entry, newest message first.
+    Entries index into `representatives`; expand() maps entry positions back to message positions."""
+
+    def __init__(self, emails: Optional[List[EmailRecord]] = None):
+        self.representatives: List[EmailRecord] = []
+        self.members: List[array] = []
+        self._by_key: Dict[str, int] = {}
+        self.email_count = 0
+        if emails:
+            self.add(emails)
+
+    def add(self, emails: List[EmailRecord]):
+        for email in emails:
+            position = self.email_count
+            self.email_count += 1
+            entry = self._by_key.get(email.source) if email.source else None
+            if entry is None:
+                entry = len(self.representatives)
+                self.representatives.append(email)
+                self.members.append(array("I"))
+                if email.source:
+                    self._by_key[email.source] = entry
+            self.members[entry].append(position)
+
+    @property
+    def weights(self) -> List[int]:
+        return [len(members) for members in self.members]
+
+    @property
+    def collapsed(self) -> int:
+        """Messages folded into another message's entry"""
+        return self.email_count - len(self.representatives)
+
+    def expand(self, entries: List[int]) -> List[int]:
+        positions = []
+        for entry in entries:
+            if 0 <= entry < len(self.members):
+                positions.extend(self.members[entry])
+        positions.sort()
+        return positions
+
@@ -0,0 +1,108 @@
+from email_graph import MemoryEmailGraph
+from email_record import EmailRecord
+from email_clusterer import EmailClusterer
+from llm import LLMClient
+from llm_cache import LLMResponseCache
+from assignment_store import AssignmentStore
+from rules import RuleEngine
+from benchmarks.fake_llm import FakeChatModel
+
+ACCOUNT = "me@example.com"
+
+def email(sender: str, subject: str = "Hello", message_id: str = "", thread: str = "") -> EmailRecord:
+    return EmailRecord(uid=message_id or subject, message_id=message_id, subject=subject, sender=sender, thread=thread or message_id, _body="body text")
+
+def cluster(name: str, indices, **fields):
+    return {"name": name, "description": f"{name} mail", "action": "Review", "priority": "medium", "email_indices": list(indices), **fields}
+
+def placed(clusters):
+    """{email position: cluster name}"""
+    return {i: c["name"] for c in clusters for i in c["email_indices"]}
+
+def test_sender_needs_min_count_and_min_share():
+    graph = MemoryEmailGraph(min_share=0.8, min_count=2)
+    history = [email("Bob <bob@example.com>")] * 4 + [email("carol@example.com")] + [email("dave@example.com")] * 3
+    graph.record(ACCOUNT, history, [cluster("Friends", [0, 1, 2, 3, 4]), cluster("Work", [5]), cluster("Projects", [6, 7])])
+
+    # dave@ is split 1 / 2, below min_share; carol@ was seen only once, below min_count
+    window = [email("bob@example.com"), email("carol@example.com"), email("dave@example.com"), email("erin@example.com")]
+    clusters, rest = graph.classify(ACCOUNT, window)
+    assert placed(clusters) == {0: "Friends"}
+    assert rest == [1, 2, 3]
+    assert clusters[0]["description"] == "Friends mail" and clusters[0]["count"] == 1
+
+def test_thread_wins_over_sender():
+    graph = MemoryEmailGraph(min_count=1)
+    history = [email("bob@example.com", message_id="<a@x>"), email("bob@example.com", message_id="<b@x>", thread="<root@x>")]
+    graph.record(ACCOUNT, history, [cluster("Friends", [0]), cluster("Trip planning", [1])])
+
+    # bob@ leans Friends by count, but a reply in a known thread follows the thread, whoever sent it
+    graph.record(ACCOUNT, [email("bob@example.com")] * 3, [cluster("Friends", [0, 1, 2])])
+    window = [email("bob@example.com", message_id="<c@x>", thread="<root@x>"), email("bob@example.com"), email("zed@example.com", message_id="<d@x>", thread="<root@x>")]
+    clusters, rest = graph.classify(ACCOUNT, window)
+    assert placed(clusters) == {0: "Trip planning", 1: "Friends", 2: "Trip planning"}
+    assert rest == []
+
+def test_record_replaces_sender_and_thread_edges():
+    graph = MemoryEmailGraph(min_count=1)
+    graph.record(ACCOUNT, [email("bob@example.com", message_id="<r@x>", thread="<root@x>")], [cluster("Old", [0])])
+    graph.record(ACCOUNT, [email("bob@example.com", message_id="<s@x>", thread="<root@x>")], [cluster("New", [0])])
+
+    senders, threads = graph.lookup(ACCOUNT, ["bob@example.com"], ["<root@x>"])
+    assert senders["bob@example.com"]["name"] == "New"
+    assert (senders["bob@example.com"]["count"], senders["bob@example.com"]["total"]) == (1, 1)
+    assert threads["<root@x>"]["name"] == "New"
+
+def test_graph_is_per_account_and_skips_thread_roots():
+    graph = MemoryEmailGraph(min_count=1)
+    # A thread's first message is found by its own Message-ID, so only replies are recorded as thread edges
+    graph.record(ACCOUNT, [email("bob@example.com", message_id="<root@x>")], [cluster("Friends", [0])])
+
+    assert graph.lookup(ACCOUNT, [], ["<root@x>"]) == ({}, {})
+    assert graph.lookup("other@example.com", ["bob@example.com"], []) == ({}, {})
+
+def test_lookup_skips_edges_without_a_cluster():
+    graph = MemoryEmailGraph(min_count=1)
+    graph.record(ACCOUNT, [email("bob@example.com", message_id="<r@x>", thread="<root@x>")], [cluster("Friends", [0])])
+    graph._clusters.clear()
+
+    assert graph.lookup(ACCOUNT, ["bob@example.com"], ["<root@x>"]) == ({}, {})
+    clusters, rest = graph.classify(ACCOUNT, [email("bob@example.com", message_id="<s@x>", thread="<root@x>")])
+    assert clusters == [] and rest == [0]
+
+class RecordingModel(FakeChatModel):
+    def __init__(self):
+        super().__init__()
+        self.prompts = []
+
+    def _respond(self, prompt, key=None):
+        self.prompts.append(prompt)
+        return super()._respond(prompt, key)
+
+def test_clusterer_applies_rules_then_graph_then_llm(tmp_path):
+    graph = MemoryEmailGraph(min_count=1)
+    rules = RuleEngine([{"name": "Receipts", "match": {"from": "billing@"}}], defaults=[])
+    # The graph knows both senders, but a rule match is final
+    graph.record(ACCOUNT, [email("billing@shop.example"), email("alice@friends.example")], [cluster("Shopping", [0]), cluster("Friends", [1])])
+
+    model = RecordingModel()
+    clusterer = EmailClusterer(
+        strategy="map_reduce", graph=graph, rules=rules,
+        cache=LLMResponseCache(str(tmp_path / "llm.db")), assignments=AssignmentStore(str(tmp_path / "assignments.db")),
+    )
+    clusterer.llm = LLMClient(model=model)
+    window = [email("billing@shop.example", "Invoice 1"), email("alice@friends.example", "Dinner?"), email("news@letters.example", "Weekly digest"), email("alerts@ci.example", "Build failed")]
+
+    clusters = clusterer.cluster_emails(window, ACCOUNT)
+    names = placed(clusters)
+    assert names[0] == "Receipts"
+    assert names[1] == "Friends"
+    assert set(names) == {0, 1, 2, 3}
+    # Only the emails neither a rule nor the graph placed reach the LLM
+    prompts = "\n".join(model.prompts)
+    assert "letters.example" in prompts and "ci.example" in prompts
+    assert "shop.example" not in prompts and "friends.example" not in prompts
+
+    # The finished clustering is written back, so the LLM's answer places those senders next time
+    senders, _ = graph.lookup(ACCOUNT, ["news@letters.example"], [])
+    assert senders["news@letters.example"]["name"] == names[2]